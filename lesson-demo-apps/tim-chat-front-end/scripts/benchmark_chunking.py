@@ -0,0 +1,312 @@
+"""Micro-benchmarks for the chunking utilities in data_utils.py.
+
+Each benchmark runs the current implementation against the implementation it replaced on a
+synthetic document, checks that both produce the same output, and prints the best timing of
+each over a number of repetitions.
+
+    python benchmark_chunking.py --benchmark merge_chunks_serially --repeat 5
+"""
+import argparse
+import html
+import random
+import re
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import markdown
+from bs4 import BeautifulSoup
+from langchain.text_splitter import MarkdownTextSplitter
+
+from data_utils import (
+    IMG_REGEX, SENTENCE_ENDINGS, TEXT_NORMALIZER, TOKEN_ESTIMATOR, URL_REGEX, WORDS_BREAKS, HTMLTitleExtractor, MarkdownParser,
+    PdfTextSplitter, chunk_content_helper, cleanup_content, mask_urls_and_imgs, merge_chunks_serially, table_to_html, unmask_urls_and_imgs
+)
+
+WORDS = ["the", "index", "search", "vector", "chunk", "token", "document", "azure", "model", "query"]
+
+
+def link_dense_document(num_paragraphs: int, links_per_paragraph: int, seed: int = 0) -> str:
+    """Builds an html document in the shape of a cracked documentation page with many links and images."""
+    rng = random.Random(seed)
+    paragraphs = []
+    for i in range(num_paragraphs):
+        words = []
+        for j in range(links_per_paragraph):
+            words.extend(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+            words.append(f"https://learn.example.com/docs/{i}/{j}/{rng.choice(WORDS)}?view=v{rng.randint(1, 9)}")
+        words.append(rng.choice(SENTENCE_ENDINGS))
+        paragraphs.append(" ".join(words))
+        if i % 10 == 0:
+            paragraphs.append(f'<img src="IMG_{i}.jpg">Figure {i}: {" ".join(rng.choice(WORDS) for _ in range(8))}</img>')
+    return "\n\n".join(paragraphs)
+
+
+def financial_table(num_rows: int, num_columns: int, seed: int = 0) -> SimpleNamespace:
+    """Builds a table in the shape of a layout model result, with the cells in no particular order."""
+    rng = random.Random(seed)
+    cells = [
+        SimpleNamespace(row_index=r, column_index=c, kind="columnHeader" if r == 0 else "content",
+                        content=rng.choice(WORDS) if r == 0 or c == 0 else f"{rng.uniform(-1e6, 1e6):,.2f}",
+                        row_span=1, column_span=1)
+        for r in range(num_rows) for c in range(num_columns)
+    ]
+    rng.shuffle(cells)
+    return SimpleNamespace(row_count=num_rows, column_count=num_columns, cells=cells)
+
+
+def html_export(num_sections: int, title: bool, headings: bool, seed: int = 0) -> str:
+    """Builds an html page in the shape of a documentation export, with or without a <title> and headings."""
+    rng = random.Random(seed)
+    head = "<head><meta charset='utf-8'><style>body { font-family: sans-serif; }</style>"
+    head += f"<title>{rng.choice(WORDS).title()} guide</title></head>" if title else "</head>"
+    sections = []
+    for i in range(num_sections):
+        if headings:
+            sections.append(f"<h2 id='s{i}'>Section {i}</h2>" if i else f"<h1>{rng.choice(WORDS).title()} overview</h1>")
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+        sections.append(f"<div class='section'><p>{words} &amp; <a href='https://learn.example.com/{i}'>more</a>.</p>"
+                        f"<ul><li>{rng.choice(WORDS)}</li><li>{rng.choice(WORDS)}</li></ul><!-- section {i} --></div>")
+    return f"<!DOCTYPE html><html>{head}<body>{''.join(sections)}</body></html>"
+
+
+def markdown_document(num_sections: int, seed: int = 0) -> str:
+    """Builds a markdown page in the shape of a documentation article, with headings, lists, tables and code."""
+    rng = random.Random(seed)
+    sections = [f"# {rng.choice(WORDS).title()} overview"]
+    for i in range(num_sections):
+        sections.append(f"## Section {i}")
+        sections.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))) + f" [more](https://learn.example.com/{i}).")
+        sections.append("\n".join(f"- {rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(3)))
+        if i % 5 == 0:
+            sections.append("| name | value |\n| --- | --- |\n" + "\n".join(f"| {rng.choice(WORDS)} | {rng.randint(0, 99)} |" for _ in range(4)))
+        if i % 7 == 0:
+            sections.append(f"```python\nprint('{rng.choice(WORDS)}')\n```")
+    return "\n\n".join(sections)
+
+
+def text_export(num_paragraphs: int, seed: int = 0) -> str:
+    """Builds a text file in the shape of a document exported to text, with padded columns, blank lines and rules."""
+    rng = random.Random(seed)
+    paragraphs = []
+    for i in range(num_paragraphs):
+        paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))))
+        if i % 4 == 0:
+            paragraphs.append("\n".join(f"{rng.choice(WORDS):<12}\t{rng.randint(0, 999):>8}    {rng.choice(WORDS)}" for _ in range(5)))
+        if i % 10 == 0:
+            paragraphs.append("-" * rng.randint(10, 80))
+    return "\n\n\n".join(paragraphs)
+
+
+def legacy_cleanup_content(content: str) -> str:
+    output = re.sub(r"\n{2,}", "\n", content)
+    output = re.sub(r"[^\S\n]{2,}", " ", output)
+    output = re.sub(r"-{2,}", "--", output)
+    return output.strip()
+
+
+def legacy_html_title(content: str) -> Tuple[Optional[str], Optional[str]]:
+    soup = BeautifulSoup(content, 'html.parser')
+    if soup.title and soup.title.string:
+        return str(soup.title.string), "title"
+    title, tag = "", None
+    h1_tag = soup.find('h1')
+    if h1_tag:
+        title, tag = h1_tag.get_text(strip=True), "h1"
+    else:
+        h2_tag = soup.find('h2')
+        if h2_tag:
+            title, tag = h2_tag.get_text(strip=True), "h2"
+    if title:
+        return title, tag
+    try:
+        return next(soup.stripped_strings), "string"
+    except StopIteration:
+        return None, None
+
+
+def legacy_chunk_markdown(content: str, num_tokens: int) -> List[Tuple[str, int, str]]:
+    def parse(text):
+        # every chunk was rendered with freshly loaded extensions and parsed into a tree for a title it then dropped
+        html_content = markdown.markdown(text, extensions=['fenced_code', 'toc', 'tables', 'sane_lists'])
+        title, _ = legacy_html_title(html_content)
+        return cleanup_content(html_content), title
+
+    _, title = parse(content)
+    splitter = MarkdownTextSplitter(chunk_size=num_tokens, chunk_overlap=0, length_function=TOKEN_ESTIMATOR.estimate_tokens)
+    return [(parse(chunk)[0], size, title) for chunk, size in merge_chunks_serially(splitter.split_text(content), num_tokens)]
+
+
+def legacy_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span and cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span and cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def legacy_mask_urls_and_imgs(text) -> Tuple[Dict[str, str], str]:
+    content_dict = {}
+    masked_text = text
+    urls = set(x[0] for x in re.findall(URL_REGEX, text))
+    for i, url in enumerate(urls):
+        masked_text = masked_text.replace(url, f"##URL{i}##")
+        content_dict[f"##URL{i}##"] = url
+
+    imgs = set(re.findall(IMG_REGEX, text, re.DOTALL))
+    for i, img in enumerate(imgs):
+        masked_text = masked_text.replace(img, f"##IMG{i}##")
+        content_dict[f"##IMG{i}##"] = img
+
+    return content_dict, masked_text
+
+
+def legacy_unmask_urls_and_imgs(text, content_dict={}):
+    if "##URL" in text or "##IMG" in text:
+        for key, value in content_dict.items():
+            text = text.replace(key, value)
+    return text
+
+
+def legacy_merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
+    current_chunk = ""
+    total_size = 0
+    for chunked_content in chunked_content_list:
+        chunked_content = legacy_unmask_urls_and_imgs(chunked_content, content_dict)
+        chunk_size = len(TOKEN_ESTIMATOR.GPT2_TOKENIZER.encode(chunked_content, allowed_special="all"))
+        if total_size > 0:
+            new_size = total_size + chunk_size
+            if new_size > num_tokens:
+                yield current_chunk, total_size
+                current_chunk = ""
+                total_size = 0
+        total_size += chunk_size
+        current_chunk += chunked_content
+    if total_size > 0:
+        yield current_chunk, total_size
+
+
+def best_time(fn: Callable[[], object], repeat: int) -> Tuple[float, object]:
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        # time every run with a cold token cache, as for a file seen for the first time
+        TOKEN_ESTIMATOR.clear_cache()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(name: str, size: int, legacy: Tuple[float, object], current: Tuple[float, object]) -> None:
+    if legacy[1] != current[1]:
+        raise Exception(f"{name}: the current implementation does not match the legacy one")
+    print(f"{name}: {size / 1e6:.2f} MB, legacy={legacy[0] * 1000:.1f} ms, current={current[0] * 1000:.1f} ms, "
+          f"speedup={legacy[0] / current[0]:.1f}x")
+
+
+def benchmark_merge_chunks_serially(args) -> None:
+    text = link_dense_document(args.num_paragraphs, args.links_per_paragraph)
+    splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=args.chunk_size, chunk_overlap=0)
+    content_dict, masked_text = splitter.mask_urls_and_imgs(text)
+    pieces = splitter.chunk_rest(masked_text)
+
+    legacy = best_time(lambda: list(legacy_merge_chunks_serially(pieces, args.chunk_size, content_dict)), args.repeat)
+    current = best_time(lambda: list(merge_chunks_serially(pieces, args.chunk_size, content_dict)), args.repeat)
+    report(f"merge_chunks_serially ({len(pieces)} pieces, {len(content_dict)} masked items)", len(text), legacy, current)
+
+
+def benchmark_mask_urls_and_imgs(args) -> None:
+    text = link_dense_document(args.num_paragraphs, args.links_per_paragraph)
+
+    # the placeholder numbering differs, so compare the round trip through masking and unmasking
+    def legacy_round_trip():
+        content_dict, masked_text = legacy_mask_urls_and_imgs(text)
+        return legacy_unmask_urls_and_imgs(masked_text, content_dict)
+
+    def current_round_trip():
+        content_dict, masked_text = mask_urls_and_imgs(text)
+        return unmask_urls_and_imgs(masked_text, content_dict)
+
+    legacy = best_time(legacy_round_trip, args.repeat)
+    current = best_time(current_round_trip, args.repeat)
+    report("mask_urls_and_imgs + unmask_urls_and_imgs", len(text), legacy, current)
+
+
+def benchmark_table_to_html(args) -> None:
+    table = financial_table(args.table_rows, args.table_columns)
+    legacy = best_time(lambda: legacy_table_to_html(table), args.repeat)
+    current = best_time(lambda: table_to_html(table), args.repeat)
+    report(f"table_to_html ({args.table_rows}x{args.table_columns} cells)", len(current[1]), legacy, current)
+
+
+def benchmark_html_title(args) -> None:
+    # the fallback order is exercised by pages with a <title>, with headings only, and with neither
+    corpus = [html_export(args.html_sections, title=i % 3 == 0, headings=i % 3 != 2, seed=i) for i in range(args.html_documents)]
+    extractor = HTMLTitleExtractor()
+    legacy = best_time(lambda: [legacy_html_title(content) for content in corpus], args.repeat)
+    current = best_time(lambda: [extractor.extract(content) for content in corpus], args.repeat)
+    report(f"html title ({len(corpus)} pages)", sum(len(content) for content in corpus), legacy, current)
+
+
+def benchmark_markdown_chunks(args) -> None:
+    content = markdown_document(args.markdown_sections)
+
+    def current_chunks():
+        return [(chunk, size, doc.title) for chunk, size, doc in chunk_content_helper(content, "markdown", None, 0, args.chunk_size)]
+
+    legacy = best_time(lambda: legacy_chunk_markdown(content, args.chunk_size), args.repeat)
+    current = best_time(current_chunks, args.repeat)
+    report(f"markdown chunks ({len(current[1])} chunks)", len(content), legacy, current)
+
+
+def benchmark_cleanup_content(args) -> None:
+    corpora = {
+        "markdown html": MarkdownParser().to_html(markdown_document(args.markdown_sections)),
+        "text export": text_export(args.num_paragraphs * 10),
+    }
+    for name, content in corpora.items():
+        legacy = best_time(lambda: legacy_cleanup_content(content), args.repeat)
+        current = best_time(lambda: cleanup_content(content), args.repeat)
+        pieces = [content[i:i + args.stream_piece_size] for i in range(0, len(content), args.stream_piece_size)]
+        stream = best_time(lambda: "".join(TEXT_NORMALIZER.normalize_stream(pieces)), args.repeat)
+        report(f"cleanup_content ({name})", len(content), legacy, current)
+        report(f"cleanup_content streamed ({name})", len(content), legacy, stream)
+        print(f"    throughput: legacy={len(content) / legacy[0] / 1e6:.0f} MB/s, current={len(content) / current[0] / 1e6:.0f} MB/s, "
+              f"streamed={len(content) / stream[0] / 1e6:.0f} MB/s")
+
+
+BENCHMARKS = {
+    "merge_chunks_serially": benchmark_merge_chunks_serially,
+    "mask_urls_and_imgs": benchmark_mask_urls_and_imgs,
+    "table_to_html": benchmark_table_to_html,
+    "html_title": benchmark_html_title,
+    "markdown_chunks": benchmark_markdown_chunks,
+    "cleanup_content": benchmark_cleanup_content,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", choices=list(BENCHMARKS.keys()), action="append", help="Benchmark to run. Default: all")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs of each implementation. Default=3")
+    parser.add_argument("--num-paragraphs", type=int, default=500, help="Number of paragraphs in the synthetic document. Default=500")
+    parser.add_argument("--links-per-paragraph", type=int, default=8, help="Number of links in each paragraph. Default=8")
+    parser.add_argument("--table-rows", type=int, default=2000, help="Number of rows in the synthetic table. Default=2000")
+    parser.add_argument("--table-columns", type=int, default=12, help="Number of columns in the synthetic table. Default=12")
+    parser.add_argument("--html-documents", type=int, default=30, help="Number of pages in the synthetic html corpus. Default=30")
+    parser.add_argument("--html-sections", type=int, default=300, help="Number of sections in each synthetic html page. Default=300")
+    parser.add_argument("--markdown-sections", type=int, default=2000, help="Number of sections in the synthetic markdown page. Default=2000")
+    parser.add_argument("--stream-piece-size", type=int, default=1 << 16, help="Size of the pieces of a streamed text. Default=65536")
+    parser.add_argument("--chunk-size", type=int, default=512, help="Chunk size in tokens. Default=512")
+    args = parser.parse_args()
+
+    for name in args.benchmark or BENCHMARKS.keys():
+        BENCHMARKS[name](args)
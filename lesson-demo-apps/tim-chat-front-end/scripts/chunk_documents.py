@@ -8,7 +8,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.keyvault.secrets import SecretClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
-from data_utils import chunk_directory
+from data_utils import ChunkingStats, iter_chunk_directory
 
 def get_document_intelligence_client(config, secret_client):
     print("Setting up Document Intelligence client...")
@@ -69,26 +69,31 @@ if __name__ == "__main__":
         # Crack and chunk documents
         print("Cracking and chunking documents...")
 
-        chunking_result = chunk_directory(
+        stats = ChunkingStats()
+        file_chunks = iter_chunk_directory(
                             directory_path=args.input_data_path, 
                             num_tokens=index_config.get("chunk_size", 1024),
                             token_overlap=index_config.get("token_overlap", 128),
                             form_recognizer_client=document_intelligence_client,
                             use_layout=index_config.get("use_layout", False),
-                            njobs=1)
-        
-        print(f"Processed {chunking_result.total_files} files")
-        print(f"Unsupported formats: {chunking_result.num_unsupported_format_files} files")
-        print(f"Files with errors: {chunking_result.num_files_with_errors} files")
-        print(f"Found {len(chunking_result.chunks)} chunks")
+                            use_token_window=index_config.get("use_token_window", False),
+                            njobs=1,
+                            stats=stats)
 
+        # write the chunks of each file as soon as it is chunked
         print("Writing chunking result to {}...".format(args.output_file_path))
         with open(args.output_file_path, "w") as f:
-            for chunk in chunking_result.chunks:
-                id = 0
-                d = dataclasses.asdict(chunk)
-                # add id to documents
-                d.update({"id": str(id)})
-                f.write(json.dumps(d) + "\n")
-                id += 1
+            for chunks in file_chunks:
+                for chunk in chunks:
+                    id = 0
+                    d = dataclasses.asdict(chunk)
+                    # add id to documents
+                    d.update({"id": str(id)})
+                    f.write(json.dumps(d) + "\n")
+                    id += 1
+
+        print(f"Processed {stats.total_files} files")
+        print(f"Unsupported formats: {stats.num_unsupported_format_files} files")
+        print(f"Files with errors: {stats.num_files_with_errors} files")
+        print(f"Found {stats.num_chunks} chunks")
         print("Chunking result written to {}.".format(args.output_file_path))
@@ -14,7 +14,7 @@ from azure.search.documents import SearchClient
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-from data_utils import chunk_directory, chunk_blob_container
+from data_utils import AnalysisCache, CaptionCache, ChunkingStats, IngestionManifest, RateLimiter, iter_chunk_blob_container, iter_chunk_directory, latency_percentiles
 
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
@@ -277,23 +277,10 @@ def create_or_update_search_index(
     return True
 
 
-def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = 50, admin_key=None):
+def get_search_client(service_name, subscription_id, resource_group, index_name, credential=None, admin_key=None):
     if credential is None and admin_key is None:
         raise ValueError("credential and admin_key cannot be None")
     
-    to_upload_dicts = []
-
-    id = 0
-    for d in docs:
-        if type(d) is not dict:
-            d = dataclasses.asdict(d)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
-        if "contentVector" in d and d["contentVector"] is None:
-            del d["contentVector"]
-        to_upload_dicts.append(d)
-        id += 1
-    
     endpoint = "https://{}.search.windows.net/".format(service_name)
     if not admin_key:
         admin_key = json.loads(
@@ -304,14 +291,17 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
             ).stdout
         )["primaryKey"]
 
-    search_client = SearchClient(
+    return SearchClient(
         endpoint=endpoint,
         index_name=index_name,
         credential=AzureKeyCredential(admin_key),
     )
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."):
-        batch = to_upload_dicts[i: i + upload_batch_size]
+
+
+def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = 50, admin_key=None, use_document_ids=False):
+    search_client = get_search_client(service_name, subscription_id, resource_group, index_name, credential=credential, admin_key=admin_key)
+
+    def upload_batch(batch):
         results = search_client.upload_documents(documents=batch)
         num_failures = 0
         errors = set()
@@ -324,6 +314,38 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
             raise Exception(f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
                             f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
 
+    # Upload the documents in batches of upload_batch_size. docs can be a generator of chunks as they are
+    # produced, so only one batch is held in memory at a time.
+    batch = []
+    id = 0
+    with tqdm(desc="Indexing Chunks...", unit=" chunks") as progress:
+        for d in docs:
+            if type(d) is not dict:
+                d = dataclasses.asdict(d)
+            # add id to documents, unless they come with stable ids
+            d.update({"@search.action": "upload", "id": d["id"] if use_document_ids else str(id)})
+            if "contentVector" in d and d["contentVector"] is None:
+                del d["contentVector"]
+            batch.append(d)
+            id += 1
+            if len(batch) == upload_batch_size:
+                upload_batch(batch)
+                progress.update(len(batch))
+                batch = []
+        if batch:
+            upload_batch(batch)
+            progress.update(len(batch))
+
+def delete_documents_from_index(service_name, subscription_id, resource_group, index_name, ids, credential=None, delete_batch_size = 1000, admin_key=None):
+    if not ids:
+        return
+    search_client = get_search_client(service_name, subscription_id, resource_group, index_name, credential=credential, admin_key=admin_key)
+    for i in tqdm(range(0, len(ids), delete_batch_size), desc="Deleting stale chunks..."):
+        results = search_client.delete_documents(documents=[{"id": id} for id in ids[i: i + delete_batch_size]])
+        num_failures = sum(1 for result in results if not result.succeeded)
+        if num_failures > 0:
+            raise Exception(f"DELETION FAILED for {num_failures} documents.")
+
 def validate_index(service_name, subscription_id, resource_group, index_name):
     api_version = "2024-03-01-Preview"
     admin_key = json.loads(
@@ -364,7 +386,7 @@ def validate_index(service_name, subscription_id, resource_group, index_name):
                 print(f"Request failed. Please investigate. Status code: {response.status_code}")
             break
 
-def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None):
+def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None, crack_concurrency=8, file_timeout=None, max_tasks_per_child=None):
     service_name = config["search_service_name"]
     subscription_id = config["subscription_id"]
     resource_group = config["resource_group"]
@@ -411,29 +433,76 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
         if config.get("vector_config_name") and embedding_model_endpoint:
             add_embeddings = True
 
+        # with a manifest, only the files that changed since the last run are chunked and uploaded
+        manifest = None
+        if config.get("manifest_path"):
+            # images are only captioned in local directories
+            captioned = captioning_model_endpoint and captioning_model_key and "blob.core" not in data_config["path"]
+            manifest = IngestionManifest(config["manifest_path"], source=f"{index_name}|{data_config['path']}",
+                                         config_fingerprint=IngestionManifest.config_fingerprint(
+                                             config["chunk_size"], config.get("token_overlap",0), embedding_model_endpoint if add_embeddings else None,
+                                             use_layout, config.get("use_token_window", False), url_prefix=data_config["url_prefix"],
+                                             captioning_model_endpoint=captioning_model_endpoint if captioned else None))
+
+        stats = ChunkingStats()
         if "blob.core" in data_config["path"]:
-            result = chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+            file_chunks = iter_chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                                 azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"])
+                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
+                                use_token_window=config.get("use_token_window", False), stats=stats, manifest=manifest,
+                                crack_concurrency=crack_concurrency, file_timeout=file_timeout, max_tasks_per_child=max_tasks_per_child)
         elif os.path.exists(data_config["path"]):
-            result = chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+            file_chunks = iter_chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                                     azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
                                     add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
-                                    captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
+                                    captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key,
+                                    use_token_window=config.get("use_token_window", False), stats=stats, manifest=manifest,
+                                    crack_concurrency=crack_concurrency, file_timeout=file_timeout, max_tasks_per_child=max_tasks_per_child)
         else:
             raise Exception(f"Path {data_config['path']} does not exist and is not a blob URL. Please check the path and try again.")
 
-        if len(result.chunks) == 0:
-            raise Exception("No chunks found. Please check the data path and chunk size.")
-
-        print(f"Processed {result.total_files} files")
-        print(f"Unsupported formats: {result.num_unsupported_format_files} files")
-        print(f"Files with errors: {result.num_files_with_errors} files")
-        print(f"Found {len(result.chunks)} chunks")
+        def documents():
+            for chunks in file_chunks:
+                for chunk in chunks:
+                    if manifest:
+                        # stable ids, so re-ingested files overwrite their previous chunks
+                        chunk.id = manifest.document_id(chunk.filepath, int(json.loads(chunk.metadata)["chunk_id"]))
+                    yield chunk
 
-        # upload documents to index
+        # upload the documents to the index as the files are chunked
         print("Uploading documents to index...")
-        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential)
+        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, documents(), credential,
+                                  use_document_ids=manifest is not None)
+
+        if manifest:
+            delete_documents_from_index(service_name, subscription_id, resource_group, index_name, manifest.stale_document_ids(), credential)
+            manifest.commit()
+            manifest.close()
+
+        if stats.num_chunks == 0 and stats.num_unchanged_files == 0:
+            raise Exception("No chunks found. Please check the data path and chunk size.")
+
+        print(f"Processed {stats.total_files} files")
+        print(f"Unchanged files skipped: {stats.num_unchanged_files} files")
+        print(f"Unsupported formats: {stats.num_unsupported_format_files} files")
+        print(f"Files with errors: {stats.num_files_with_errors} files")
+        print(f"Found {stats.num_chunks} chunks")
+        if add_embeddings and os.getenv("EMBEDDING_CACHE_PATH"):
+            print(f"Embedding cache: {stats.embedding_cache_hits} hits, {stats.embedding_cache_misses} misses")
+        analysis_cache = AnalysisCache.from_env()
+        if analysis_cache and analysis_cache.hits + analysis_cache.misses:
+            print(f"Analysis cache: {analysis_cache.hits} hits, {analysis_cache.misses} misses")
+        caption_cache = CaptionCache.from_env()
+        if caption_cache and caption_cache.hits + caption_cache.misses:
+            print(f"Caption cache: {caption_cache.hits} hits, {caption_cache.misses} misses")
+        if stats.embedding_latencies:
+            percentiles = ", ".join(f"{name}={value * 1000:.0f} ms" for name, value in latency_percentiles(stats.embedding_latencies).items())
+            print(f"Embedding requests: {len(stats.embedding_latencies)}, latency {percentiles}")
+        if stats.peak_rss_by_file:
+            peak_file = max(stats.peak_rss_by_file, key=stats.peak_rss_by_file.get)
+            print(f"Peak memory of a chunking process: {stats.peak_rss_by_file[peak_file] >> 20} MB, after {peak_file}")
+        if stats.queue_depths:
+            print("Peak queue depths: " + ", ".join(f"{name}={depth}" for name, depth in stats.queue_depths.items()))
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -454,9 +523,28 @@ if __name__ == "__main__":
     parser.add_argument("--form-rec-key", type=str, help="Key for your Form Recognizer resource to use for PDF cracking.")
     parser.add_argument("--form-rec-use-layout", default=True, action='store_true', help="Whether to use Layout model for PDF cracking, if False will use Read model.")
     parser.add_argument("--njobs", type=valid_range, default=4, help="Number of jobs to run (between 1 and 32). Default=4")
+    parser.add_argument("--crack-concurrency", type=int, default=8, help="Number of files read, analyzed by Form Recognizer or captioned at a time, with njobs > 1. Default=8")
+    parser.add_argument("--file-timeout", type=float, help="Number of seconds after which the chunking of a file fails. Default: no timeout")
+    parser.add_argument("--max-tasks-per-child", type=int, help="Number of files after which a chunking process is replaced, to cap its memory, with njobs > 1. Default: never")
     parser.add_argument("--embedding-model-endpoint", type=str, help="Endpoint for the embedding model to use for vector search. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<Ada deployment name>/embeddings?api-version=2024-03-01-Preview'")
     parser.add_argument("--embedding-model-key", type=str, help="Key for the embedding model to use for vector search.")
     parser.add_argument("--search-admin-key", type=str, help="Admin key for the search service. If not provided, will use Azure CLI to get the key.")
+    parser.add_argument("--embedding-cache-path", type=str, help="Path to a local SQLite file to cache embeddings in, across files and runs.")
+    parser.add_argument("--embedding-cache-max-mb", type=int, default=1024, help="Size of the embedding cache above which the least recently used embeddings are evicted. Default=1024")
+    parser.add_argument("--pdf-shard-pages", type=int, help="Number of pages above which a PDF is analyzed by Form Recognizer in page ranges of at most that many pages, in parallel. Default: no sharding")
+    parser.add_argument("--pdf-shard-max-mb", type=float, help="Size above which a PDF is analyzed by Form Recognizer in page ranges of about that size, in parallel. Default: no sharding")
+    parser.add_argument("--pdf-text-layer", action="store_true", help="Whether to read the pages of PDFs with a usable text layer locally, and send only scanned pages to Form Recognizer.")
+    parser.add_argument("--figure-max-pixels", type=int, help="Largest width or height of the images of the figures found by Form Recognizer. Default=2048")
+    parser.add_argument("--figure-jpeg-quality", type=int, help="JPEG quality of the images of the figures found by Form Recognizer, from 1 to 100. Default=75")
+    parser.add_argument("--analysis-cache-path", type=str, help="Path to a local SQLite file to cache Document Intelligence results in, so that files are analyzed only once across runs.")
+    parser.add_argument("--analysis-cache-max-mb", type=int, default=4096, help="Size of the analysis cache above which the least recently used results are evicted. Default=4096")
+    parser.add_argument("--caption-cache-path", type=str, help="Path to a local SQLite file to cache image captions in, so that unchanged images are captioned only once across runs.")
+    parser.add_argument("--caption-cache-max-mb", type=int, default=256, help="Size of the caption cache above which the least recently used captions are evicted. Default=256")
+    parser.add_argument("--embedding-max-concurrency", type=int, default=8, help="Number of embedding requests in flight in each job. Default=8")
+    parser.add_argument("--embedding-rpm", type=int, help="Requests per minute quota of the embedding deployment, shared by all jobs. Default: no limit")
+    parser.add_argument("--embedding-tpm", type=int, help="Tokens per minute quota of the embedding deployment, shared by all jobs. Default: no limit")
+    parser.add_argument("--captioning-rpm", type=int, help="Requests per minute quota of the image captioning deployment, shared by all jobs. Default: no limit")
+    parser.add_argument("--captioning-tpm", type=int, help="Tokens per minute quota of the image captioning deployment, shared by all jobs. Default: no limit")
     parser.add_argument("--azure-openai-endpoint", type=str, help="Endpoint for the (Azure) OpenAI API. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<vision model name>/chat/completions?api-version=2024-04-01-preview'")
     parser.add_argument("--azure-openai-key", type=str, help="Key for the (Azure) OpenAI API.")
     args = parser.parse_args()
@@ -471,6 +559,35 @@ if __name__ == "__main__":
     if args.search_admin_key:
         os.environ["AZURE_SEARCH_ADMIN_KEY"] = args.search_admin_key
 
+    if args.embedding_cache_path:
+        os.environ["EMBEDDING_CACHE_PATH"] = args.embedding_cache_path
+        os.environ["EMBEDDING_CACHE_MAX_MB"] = str(args.embedding_cache_max_mb)
+
+    if args.pdf_shard_pages:
+        os.environ["PDF_SHARD_PAGES"] = str(args.pdf_shard_pages)
+    if args.pdf_shard_max_mb:
+        os.environ["PDF_SHARD_MAX_MB"] = str(args.pdf_shard_max_mb)
+
+    if args.pdf_text_layer:
+        os.environ["PDF_TEXT_LAYER"] = "1"
+
+    if args.figure_max_pixels:
+        os.environ["FIGURE_MAX_PIXELS"] = str(args.figure_max_pixels)
+    if args.figure_jpeg_quality:
+        os.environ["FIGURE_JPEG_QUALITY"] = str(args.figure_jpeg_quality)
+
+    if args.caption_cache_path:
+        os.environ["CAPTION_CACHE_PATH"] = args.caption_cache_path
+        os.environ["CAPTION_CACHE_MAX_MB"] = str(args.caption_cache_max_mb)
+
+    if args.analysis_cache_path:
+        os.environ["ANALYSIS_CACHE_PATH"] = args.analysis_cache_path
+        os.environ["ANALYSIS_CACHE_MAX_MB"] = str(args.analysis_cache_max_mb)
+
+    os.environ["EMBEDDING_MAX_CONCURRENCY"] = str(args.embedding_max_concurrency)
+    RateLimiter.configure("embedding", args.embedding_rpm, args.embedding_tpm)
+    RateLimiter.configure("captioning", args.captioning_rpm, args.captioning_tpm)
+
     if args.form_rec_resource and args.form_rec_key:
         os.environ["FORM_RECOGNIZER_ENDPOINT"] = f"https://{args.form_rec_resource}.cognitiveservices.azure.com/"
         os.environ["FORM_RECOGNIZER_KEY"] = args.form_rec_key
@@ -483,7 +600,7 @@ if __name__ == "__main__":
         if index_config.get("vector_config_name") and not args.embedding_model_endpoint:
             raise Exception("ERROR: Vector search is enabled in the config, but no embedding model endpoint and key were provided. Please provide these values or disable vector search.")
     
-        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key)
+        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key, crack_concurrency=args.crack_concurrency, file_timeout=args.file_timeout, max_tasks_per_child=args.max_tasks_per_child)
         print("Data preparation for index", index_config["index_name"], "completed")
 
     print(f"Data preparation script completed. {len(config)} indexes updated.")
\ No newline at end of file
@@ -1,21 +1,41 @@
 """Data utilities for index preparation."""
 import ast
+import asyncio
+import bisect
+import hashlib
 import html
+import html.entities
+import html.parser
+import inspect
 import json
+import math
+import multiprocessing
 import os
+import queue
+import random
 import re
+import signal
+import sqlite3
 import ssl
 import subprocess
+import sys
 import tempfile
+import threading
 import time
-import urllib.request
+import unicodedata
+import zlib
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
-from functools import partial
-from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
-from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from typing import IO, Any, Callable, Dict, Generator, List, Optional, Tuple, Union
+from azure.ai.documentintelligence.models import AnalyzeResult
 import fitz
+import httpx
 import requests
 import base64
 
@@ -23,15 +43,21 @@ import markdown
 import requests
 import tiktoken
 from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import ContainerClient
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AzureOpenAI
 from tqdm import tqdm
 
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
 
@@ -54,22 +80,153 @@ FILE_FORMAT_DICT = {
 
 RETRY_COUNT = 5
 
+# status codes of a failed request that are worth retrying, besides the 5xx server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+# (max inputs, max tokens) of an embedding request per FLAG_EMBEDDING_MODEL
+EMBEDDING_BATCH_LIMITS = {
+    "AOAI": (2048, 300000),
+    "COHERE": (96, None),
+}
+
+DOCUMENT_INTELLIGENCE_HEADERS = {"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"}
+
+# relative cost of processing a file, in bytes of plain text, to start the most expensive files of a pipeline first
+PDF_PAGE_COST = 200000
+IMAGE_FILE_COST = 1000000
+FILE_FORMAT_COST_FACTORS = {"html": 2, "docx": 20, "pptx": 20}
+
+# number of shards of a PDF analyzed at a time, when PDF_SHARD_PAGES or PDF_SHARD_MAX_MB split it in page ranges
+PDF_SHARD_CONCURRENCY = 8
+
+# with PDF_TEXT_LAYER set, pages with at least this many characters in their text layer and at most this fraction of
+# their area covered by images are read locally instead of by Document Intelligence, see pdf_text_layer_pages
+PDF_TEXT_LAYER_MIN_CHARS = 32
+PDF_TEXT_LAYER_MAX_IMAGE_COVERAGE = 0.5
+# font sizes, relative to the size of the body text, from which the short paragraphs of a text layer are headers, and the
+# length above which a paragraph is not a header, see pdf_text_layer_analyses
+PDF_TEXT_LAYER_TITLE_SCALE = 1.5
+PDF_TEXT_LAYER_HEADING_SCALE = 1.15
+PDF_TEXT_LAYER_HEADING_MAX_CHARS = 200
+
+# largest width or height, in pixels, and JPEG quality of the images of figures, see render_figures
+FIGURE_MAX_PIXELS = 2048
+FIGURE_JPEG_QUALITY = 75
+
+# the prompt of get_caption, part of the key of its CaptionCache
+CAPTION_SYSTEM_PROMPT = "You are a captioning model that helps uses find descriptive captions."
+CAPTION_USER_PROMPT = "Describe this image as if you were describing it to someone who can't see it. "
+# images are scaled down to fit the resolution the vision model works at before they are sent, see downscale_image
+CAPTION_MAX_PIXELS = 2048
+CAPTION_MAX_SHORT_SIDE = 768
+CAPTION_JPEG_QUALITY = 85
+
+# tokens counted against the captioning quota for the prompt and for an image at high detail (4 tiles)
+CAPTION_PROMPT_TOKENS = 50
+CAPTION_IMAGE_TOKENS = 765
+
+# durations of the x-ratelimit-reset-* headers, e.g. "1s", "6m0s" or "250ms"
+RATE_LIMIT_RESET_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
 SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
 
-HTML_TABLE_TAGS = {"table_open": "<table>", "table_close": "</table>", "row_open":"<tr>"}
+HTML_TABLE_TAGS = {"table_open": "<table>", "table_close": "</table>", "row_open":"<tr>", "row_close":"</tr>"}
 
 PDF_HEADERS = {
     "title": "h1",
     "sectionHeading": "h2"
 }
 
+URL_REGEX = r"(?i:\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’])))"
+IMG_REGEX = r'(<img\s+src="[^"]+"[^>]*>.*?</img>)'
+MASK_PATTERN = re.compile(f"(?P<img>{IMG_REGEX})|(?P<url>{URL_REGEX})", re.DOTALL)
+MASK_PLACEHOLDER_PATTERN = re.compile(r"##(?:URL|IMG)\d+##")
+HTML_TAG_REGEX = r"<[^<>]+>"
+MARKDOWN_LINK_REGEX = r"!?\[[^\]\n]*\]\([^)\n]*\)"
+
+# separators and spans that must not be cut, per file format, for the token window splitter
+TOKEN_WINDOW_FORMATS = {
+    "text": {"protected_patterns": [URL_REGEX]},
+    "markdown": {"protected_patterns": [URL_REGEX, MARKDOWN_LINK_REGEX]},
+    "html_pdf": {
+        "separators": ["</table>", "</tr>", "\n\n", "\n"] + SENTENCE_ENDINGS + WORDS_BREAKS,
+        "protected_patterns": [URL_REGEX, IMG_REGEX, HTML_TAG_REGEX]
+    }
+}
+
 class TokenEstimator(object):
+    """Counts GPT-2 tokens, memoizing counts in a bounded LRU cache keyed by content hash.
+
+    The chunking path asks for the size of the same text several times (the full document,
+    every split, every merged chunk), so repeated counts are served from the cache and cache
+    misses are encoded together with tiktoken's batch API.
+    """
     GPT2_TOKENIZER = tiktoken.get_encoding("gpt2")
+    CACHE_SIZE = 8192
+
+    def __init__(self, cache_size: int = CACHE_SIZE) -> None:
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _content_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def _cache_get(self, key: bytes) -> Optional[int]:
+        with self._lock:
+            num_tokens = self._cache.get(key)
+            if num_tokens is not None:
+                self._cache.move_to_end(key)
+            return num_tokens
+
+    def _cache_put(self, key: bytes, num_tokens: int) -> None:
+        with self._lock:
+            self._cache[key] = num_tokens
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
     def estimate_tokens(self, text: Union[str, List]) -> int:
-
-        return len(self.GPT2_TOKENIZER.encode(text, allowed_special="all"))
+        if not isinstance(text, str):
+            return sum(self.estimate_tokens_batch(list(text)))
+
+        key = self._content_key(text)
+        num_tokens = self._cache_get(key)
+        if num_tokens is None:
+            num_tokens = len(self.GPT2_TOKENIZER.encode(text, allowed_special="all"))
+            self._cache_put(key, num_tokens)
+        return num_tokens
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def estimate_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Returns the token count of each text, encoding all cache misses in one batch call.
+        Args:
+            texts (List[str]): The texts to count.
+        Returns:
+            List[int]: The token counts, in the same order as texts.
+        """
+        keys = [self._content_key(text) for text in texts]
+        counts = [self._cache_get(key) for key in keys]
+
+        # de-duplicate the misses so repeated texts are only encoded once
+        missing = {}
+        for key, text, num_tokens in zip(keys, texts, counts):
+            if num_tokens is None and key not in missing:
+                missing[key] = text
+        if missing:
+            encoded = self.GPT2_TOKENIZER.encode_batch(list(missing.values()), allowed_special="all")
+            for key, tokens in zip(missing.keys(), encoded):
+                self._cache_put(key, len(tokens))
+                missing[key] = len(tokens)
+            counts = [missing[key] if num_tokens is None else num_tokens for key, num_tokens in zip(keys, counts)]
+
+        return counts
 
     def construct_tokens_with_size(self, tokens: str, numofTokens: int) -> str:
         newTokens = self.GPT2_TOKENIZER.decode(
@@ -79,6 +236,45 @@ class TokenEstimator(object):
 
 TOKEN_ESTIMATOR = TokenEstimator()
 
+class _TableHeaders:
+    """The headers of a table, i.e. the first match of TABLE_HEADER_PATTERN in its header rows, found as the rows are added.
+
+    Only the new text is searched once a match is found: the match can then only grow up to the last </th> of its line.
+    """
+    # the header cells of a row, from the first opening tag to the last closing one. Opening tags may contain rowspan/colspan
+    TABLE_HEADER_PATTERN = re.compile("<th.*>.*</th>")
+
+    def __init__(self) -> None:
+        self.headers = ""
+        # the unmatched end of the last line, before a match is found, or the text after the match on its line
+        self._line = ""
+        self._matched = False
+        self._done = False
+
+    def add(self, text: str) -> None:
+        if self._done:
+            return
+        if not self._matched:
+            text = self._line + text
+            match = self.TABLE_HEADER_PATTERN.search(text) if "<th" in text else None
+            if match is None:
+                self._line = text[text.rfind("\n") + 1:]
+                return
+            self.headers = match.group()
+            self._matched = True
+            text = text[match.end():]
+            self._line = ""
+        line_end = text.find("\n")
+        if line_end >= 0:
+            text = text[:line_end]
+            self._done = True
+        close = text.rfind("</th>")
+        if close >= 0:
+            self.headers += self._line + text[:close + len("</th>")]
+            self._line = text[close + len("</th>"):]
+        else:
+            self._line += text
+
 class PdfTextSplitter(TextSplitter):
     def __init__(self, length_function: Callable[[str], int] =TOKEN_ESTIMATOR.estimate_tokens, separator: str = "\n\n", **kwargs: Any):
         """Create a new TextSplitter for htmls from extracted pdfs."""
@@ -118,31 +314,7 @@ class PdfTextSplitter(TextSplitter):
         return caption
     
     def mask_urls_and_imgs(self, text) -> Tuple[Dict[str, str], str]:
-
-        def find_urls(string):
-            regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-            urls = re.findall(regex, string)
-            return [x[0] for x in urls]
-        
-        def find_imgs(string):
-            regex = r'(<img\s+src="[^"]+"[^>]*>.*?</img>)'
-            imgs = re.findall(regex, string, re.DOTALL)
-            return imgs
-        
-        content_dict = {}
-        masked_text = text
-        urls = set(find_urls(text))
-
-        for i, url in enumerate(urls):
-            masked_text = masked_text.replace(url, f"##URL{i}##")
-            content_dict[f"##URL{i}##"] = url
-
-        imgs = set(find_imgs(text))
-        for i, img in enumerate(imgs):
-            masked_text = masked_text.replace(img, f"##IMG{i}##")
-            content_dict[f"##IMG{i}##"] = img
-
-        return content_dict, masked_text
+        return mask_urls_and_imgs(text)
 
     def split_text(self, text: str) -> List[str]:
         content_dict, masked_text = self.mask_urls_and_imgs(text)
@@ -206,19 +378,34 @@ class PdfTextSplitter(TextSplitter):
         return chunks
         
     def chunk_table(self, table, caption):
+        """Splits a html table into mini-tables within the chunk size, repeating the caption and the header rows in each.
+        Args:
+            table (str): The html of the table.
+            caption (str): The caption to prefix each mini-table with.
+        Returns:
+            List[str]: The mini-tables.
+        """
         if self._length_function("\n".join([caption, table])) < self._chunk_size - self._noise:
             return ["\n".join([caption, table])]
         else:
-            headers = ""
-            if re.search("<th.*>.*</th>", table):
-                headers += re.search("<th.*>.*</th>", table).group() # extract the header out. Opening tag may contain rowspan/colspan
-            splits = table.split(self._table_tags["row_open"]) #split by row tag
+            # the header rows are the rows at the top of the table that have header cells
+            table_headers = _TableHeaders()
+            num_header_parts = 0
+            in_header_rows = True
             tables = []
             current_table = caption + "\n"
-            for part in splits:
+            table_tags = [self._table_tags["table_open"], self._table_tags["table_close"], self._table_tags["table_open"] + self._table_tags["table_close"]]
+            for part in table.split(self._table_tags["row_open"]): #split by row tag
+                if in_header_rows:
+                    if "<th" not in part and self._table_tags["row_close"] in part:
+                        in_header_rows = False
+                    else:
+                        # the header rows are joined with the row tag
+                        table_headers.add(self._table_tags["row_open"] + part if num_header_parts else part)
+                        num_header_parts += 1
                 if len(part)>0:
                     if self._length_function(current_table + self._table_tags["row_open"] + part) < self._chunk_size: # if current table length is within permissible limit, keep adding rows
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]: # need add the separator (row tag) when the part is not a table tag
+                        if part not in table_tags: # need add the separator (row tag) when the part is not a table tag
                             current_table += self._table_tags["row_open"]
                         current_table += part
                         
@@ -229,8 +416,8 @@ class PdfTextSplitter(TextSplitter):
                         tables.append(current_table)
 
                         # start a new table
-                        current_table = "\n".join([caption, self._table_tags["table_open"], headers])
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]:
+                        current_table = "\n".join([caption, self._table_tags["table_open"], table_headers.headers])
+                        if part not in table_tags:
                             current_table += self._table_tags["row_open"]
                         current_table += part
 
@@ -244,6 +431,122 @@ class PdfTextSplitter(TextSplitter):
                 tables.append(current_table)
             return tables
 
+
+class TokenWindowSplitter(TextSplitter):
+    """Splits text into windows of GPT-2 tokens, tokenizing the text only once.
+
+    Every chunk is a slice of the text spanning at most chunk_size of the document's tokens, and
+    each chunk starts up to chunk_overlap tokens before the end of the previous one. Chunk ends
+    are moved back to the best break point in the second half of the window, preferring
+    separators listed earlier, and never fall inside a match of one of the protected patterns
+    (e.g. an url or an html tag) unless the match is longer than the window. A chunk that starts
+    inside a token spans the end of that token as well, so with a chunk_size of 1 it may span 2 tokens.
+    """
+    _UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+    _MID_CHARACTER = -2
+    _PROTECTED = -1
+
+    def __init__(self, separators: Optional[List[str]] = None, protected_patterns: Optional[List[str]] = None, **kwargs: Any):
+        """Create a new TextSplitter that cuts on token boundaries."""
+        super().__init__(**kwargs)
+        if self._chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1 token, got {self._chunk_size}")
+        self._separators = separators if separators is not None else ["\n\n", "\n"] + SENTENCE_ENDINGS + WORDS_BREAKS
+        self._protected_patterns = [re.compile(pattern, re.DOTALL) for pattern in protected_patterns or []]
+        self._tokenizer = TokenEstimator.GPT2_TOKENIZER
+
+    def _token_boundaries(self, tokens: List[int]) -> Tuple[List[int], List[int]]:
+        """Returns the character offset of every token boundary, and whether the text may be cut there."""
+        positions = []
+        ranks = []
+        text_len = 0
+        for token in self._tokenizer.decode_tokens_bytes(tokens):
+            # a token starting with a UTF-8 continuation byte shares its first character with the previous token
+            is_continuation = 0x80 <= token[0] < 0xC0
+            positions.append(max(0, text_len - is_continuation))
+            ranks.append(self._MID_CHARACTER if is_continuation else 0)
+            text_len += len(token.translate(None, self._UTF8_CONTINUATION_BYTES))
+        positions.append(text_len)
+        ranks.append(0)
+        return positions, ranks
+
+    def _rank_breaks(self, text: str, positions: List[int], ranks: List[int]) -> List[int]:
+        """Ranks every token boundary in place: higher for separators earlier in the list, 0 for a plain
+        character boundary and negative where the text should not be cut.
+        Returns the character offset at which to cut for each boundary. This is the boundary itself,
+        unless a better separator ends inside the token before it (e.g. "</tr>" in a "><" token).
+        """
+        cut_positions = list(positions)
+        for priority, separator in zip(range(len(self._separators), 0, -1), self._separators):
+            if not separator:
+                continue
+            for match in re.finditer(re.escape(separator), text):
+                # GPT-2 attaches leading whitespace to the next word, so whitespace also breaks before itself
+                break_positions = (match.start(), match.end()) if separator.isspace() else (match.end(),)
+                for position in break_positions:
+                    i = bisect.bisect_left(positions, position)
+                    if 0 < i < len(positions) and ranks[i] < priority and (positions[i] == position or ranks[i] >= 0):
+                        ranks[i] = priority
+                        cut_positions[i] = position
+
+        for pattern in self._protected_patterns:
+            for match in pattern.finditer(text):
+                first = bisect.bisect_right(cut_positions, match.start())
+                last = bisect.bisect_left(cut_positions, match.end())
+                for i in range(first, last):
+                    ranks[i] = min(ranks[i], self._PROTECTED)
+        return cut_positions
+
+    def _find_chunk_end(self, ranks: List[int], start: int, max_tokens: int) -> int:
+        num_tokens = len(ranks) - 1
+        limit = start + max_tokens
+        if limit >= num_tokens:
+            return num_tokens
+        # max() keeps the first best candidate, so walk backwards to prefer the latest break point
+        lower = start + max(1, max_tokens // 2)
+        end = max(range(limit, lower - 1, -1), key=ranks.__getitem__)
+        if ranks[end] < 0:
+            end = max(range(limit, start, -1), key=ranks.__getitem__)
+        return end
+
+    def _find_next_start(self, ranks: List[int], start: int, end: int) -> int:
+        # start the overlap on the first break point, or at least a character boundary, after end - chunk_overlap
+        first = max(end - self._chunk_overlap, start + 1)
+        for min_rank in (1, 0):
+            for i in range(first, end):
+                if ranks[i] >= min_rank:
+                    return i
+        return end
+
+    def split_text_with_sizes(self, text: str) -> List[Tuple[str, int]]:
+        """Splits the given text into token windows.
+        Args:
+            text (str): The text to split.
+        Returns:
+            List[Tuple[str, int]]: The chunks and their number of tokens.
+        """
+        tokens = self._tokenizer.encode(text, allowed_special="all")
+        if not tokens:
+            return []
+        positions, ranks = self._token_boundaries(tokens)
+        cut_positions = self._rank_breaks(text, positions, ranks)
+
+        chunks = []
+        start = 0
+        while True:
+            # a chunk starting inside a token also spans the end of the previous token
+            partial_token = int(cut_positions[start] < positions[start])
+            # every chunk takes at least one whole token, even if the partial one already fills the window
+            end = self._find_chunk_end(ranks, start, max(1, self._chunk_size - partial_token))
+            chunks.append((text[cut_positions[start]:cut_positions[end]], end - start + partial_token))
+            if end >= len(tokens):
+                break
+            start = self._find_next_start(ranks, start, end)
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, _ in self.split_text_with_sizes(text)]
+
     
 @dataclass
 class Document(object):
@@ -267,6 +570,69 @@ class Document(object):
     contentVector: Optional[List[float]] = None
     image_mapping: Optional[Dict] = None
 
+class TextNormalizer(object):
+    """Collapses runs of newlines to one newline, runs of other whitespace to one space and runs of dashes to "--", then
+    strips the ends. The three runs are made of disjoint characters so the transforms do not interact; each is compiled
+    once and skipped when a substring test, far cheaper than a regex scan, shows it cannot change the content.
+    """
+    NEWLINES_REGEX = re.compile(r"\n\n+")
+    BLANKS_REGEX = re.compile(r"[^\S\n]{2,}")
+    # ascii text without other whitespace than spaces and newlines only has runs of spaces, which a literal prefix finds fast
+    SPACES_REGEX = re.compile(r"  +")
+    OTHER_ASCII_BLANKS = "\t\r\x0b\x0c\x1c\x1d\x1e\x1f"
+    # "--" is already normalized
+    DASHES_REGEX = re.compile(r"---+")
+
+    def _normalize_runs(self, content: str) -> str:
+        if "\n\n" in content:
+            content = self.NEWLINES_REGEX.sub("\n", content)
+        if content.isascii() and not any(blank in content for blank in self.OTHER_ASCII_BLANKS):
+            if "  " in content:
+                content = self.SPACES_REGEX.sub(" ", content)
+        else:
+            content = self.BLANKS_REGEX.sub(" ", content)
+        if "---" in content:
+            content = self.DASHES_REGEX.sub("--", content)
+        return content
+
+    def normalize(self, content: str) -> str:
+        """Normalizes the given content.
+        Args:
+            content (str): The content to normalize.
+        Returns:
+            str: The normalized content.
+        """
+        return self._normalize_runs(content).strip()
+
+    def normalize_stream(self, pieces) -> Generator[str, None, None]:
+        """Normalizes a text given in pieces, for texts too large to hold twice in memory.
+        Args:
+            pieces (Iterable[str]): The pieces of the text.
+        Returns:
+            Generator[str, None, None]: Pieces whose concatenation is the normalized text.
+        """
+        carry = ""
+        started = False
+        for piece in pieces:
+            text = carry + piece
+            # a run can continue in the next piece, and trailing whitespace is stripped if nothing follows it
+            end = len(text)
+            while end and (text[end - 1] == "-" or text[end - 1].isspace()):
+                end -= 1
+            # the carry is normalized to stay small, the runs it ends with still merge with the next piece the same way
+            carry = self._normalize_runs(text[end:])
+            if end:
+                head = self._normalize_runs(text[:end])
+                if not started:
+                    head = head.lstrip()
+                    started = True
+                yield head
+        tail = carry.rstrip() if started else carry.strip()
+        if tail:
+            yield tail
+
+TEXT_NORMALIZER = TextNormalizer()
+
 def cleanup_content(content: str) -> str:
     """Cleans up the given content using regexes
     Args:
@@ -274,11 +640,7 @@ def cleanup_content(content: str) -> str:
     Returns:
         str: The cleaned up content.
     """
-    output = re.sub(r"\n{2,}", "\n", content)
-    output = re.sub(r"[^\S\n]{2,}", " ", output)
-    output = re.sub(r"-{2,}", "--", output)
-
-    return output.strip()
+    return TEXT_NORMALIZER.normalize(content)
 
 class BaseParser(ABC):
     """A parser parses content to produce a document."""
@@ -321,9 +683,17 @@ class BaseParser(ABC):
 class MarkdownParser(BaseParser):
     """Parses Markdown content."""
 
+    EXTENSIONS = ['fenced_code', 'toc', 'tables', 'sane_lists']
+
     def __init__(self) -> None:
         super().__init__()
         self._html_parser = HTMLParser()
+        # Loading the extensions dominates rendering a short chunk, so one configured instance is reset between documents
+        self._markdown = markdown.Markdown(extensions=self.EXTENSIONS)
+
+    def to_html(self, content: str) -> str:
+        """Renders the given markdown content to HTML."""
+        return self._markdown.reset().convert(content)
 
     def parse(self, content: str, file_name: Optional[str] = None) -> Document:
         """Parses the given content.
@@ -333,10 +703,216 @@ class MarkdownParser(BaseParser):
         Returns:
             Document: The parsed document.
         """
-        html_content = markdown.markdown(content, extensions=['fenced_code', 'toc', 'tables', 'sane_lists'])
+        html_content = self.to_html(content)
 
         return self._html_parser.parse(html_content, file_name)
 
+    def parse_chunk(self, content: str) -> str:
+        """Renders and cleans up a chunk of a document already parsed, whose title is the document's.
+        Args:
+            content (str): The markdown content of the chunk.
+        Returns:
+            str: The content of the chunk as parse would give it.
+        """
+        return cleanup_content(self.to_html(content))
+
+
+class _TitleFound(Exception):
+    pass
+
+class HTMLTitleExtractor(html.parser.HTMLParser):
+    """Finds the title of an HTML document the way a BeautifulSoup tree of it would give it: the string of the first <title>,
+    else the text of the first <h1>, else of the first <h2>, else the first string that is not blank. Unlike a tree, it stops
+    parsing as soon as no tag before the one it found in that order can come later.
+
+    Strings inside <script>, <style>, <template>, <rt> and <rp>, comments, declarations and processing instructions are not
+    text, as for BeautifulSoup.get_text.
+    """
+    # tags that are never opened, as BeautifulSoup's html.parser builder has them
+    EMPTY_ELEMENT_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta", "param",
+                          "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer"}
+    # tags whose strings are not text
+    STRING_CONTAINER_TAGS = {"script", "style", "template", "rt", "rp"}
+    PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+    ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+    TAG_PATTERNS = {name: re.compile(f"<{name}[\\s/>]", re.IGNORECASE) for name in ("title", "h1", "h2")}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+
+    def extract(self, content: str) -> Tuple[Optional[str], Optional[str]]:
+        """Returns the title of an HTML document and the tag it comes from, "title", "h1" or "h2", or "string" for the first
+        string, or (None, None) if the document has no string."""
+        self.reset()
+        self._stack = []
+        # empty element tags opened without a "/>", whose next end tag is ignored
+        self._closed_empty_elements = []
+        self._data = []
+        self._num_containers = 0
+        self._num_preserve_whitespace = 0
+        # the nodes of the first <title> as nested lists of strings, and the texts of the first <h1> and <h2>
+        self._title_nodes = None
+        self._title_depth = None
+        self._title = None
+        self._texts = {"h1": None, "h2": None}
+        self._text_depths = {"h1": None, "h2": None}
+        self._first_string = None
+        self._may_have = {name: pattern.search(content) is not None for name, pattern in self.TAG_PATTERNS.items()}
+        try:
+            self.feed(content)
+            self.close()
+            self._end_data()
+            self._end_tags(0)
+            return self._answer(final=True)
+        except _TitleFound as found:
+            return found.args
+        finally:
+            self.reset()
+
+    def _answer(self, final: bool = False) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Returns the title and its tag once no tag before it in the order of precedence can come, or None while one can."""
+        if self._title_nodes is not None or (self._may_have["title"] and not final):
+            if self._title is None and not final:
+                return None
+            if self._title:
+                return self._title, "title"
+        for name in ("h1", "h2"):
+            if self._texts[name] is not None or self._text_depths[name] is not None:
+                if self._text_depths[name] is not None and not final:
+                    return None
+                if self._texts[name]:
+                    return self._texts[name], name
+                break
+            if self._may_have[name] and not final:
+                return None
+        if self._first_string is not None:
+            return self._first_string, "string"
+        return None if not final else (None, None)
+
+    def _check(self) -> None:
+        answer = self._answer()
+        if answer is not None:
+            raise _TitleFound(*answer)
+
+    def _end_data(self, kind: str = "text") -> None:
+        """Ends the current string, as BeautifulSoup ends a NavigableString, and adds it where it belongs."""
+        if not self._data:
+            return
+        data = "".join(self._data)
+        self._data = []
+        if not data.translate(self.ASCII_SPACES) and not self._num_preserve_whitespace:
+            data = "\n" if "\n" in data else " "
+        if self._title_nodes is not None and self._title is None:
+            self._title_nodes[-1].append(data)
+        if kind in ("text", "cdata") and not self._num_containers:
+            stripped = data.strip()
+            if stripped:
+                for name in ("h1", "h2"):
+                    if self._text_depths[name] is not None:
+                        self._texts[name].append(stripped)
+                if self._first_string is None:
+                    self._first_string = stripped
+                    self._check()
+
+    def _end_tags(self, depth: int) -> None:
+        """Closes the open tags from the deepest down to the one at depth."""
+        while len(self._stack) > depth:
+            name = self._stack.pop()
+            if name in self.STRING_CONTAINER_TAGS:
+                self._num_containers -= 1
+            if name in self.PRESERVE_WHITESPACE_TAGS:
+                self._num_preserve_whitespace -= 1
+            if self._title_depth is not None:
+                if len(self._stack) == self._title_depth:
+                    self._title = self._node_string(self._title_nodes[0]) or ""
+                    self._title_depth = None
+                else:
+                    node = self._title_nodes.pop()
+                    self._title_nodes[-1].append(node)
+            for text_name in ("h1", "h2"):
+                if self._text_depths[text_name] == len(self._stack):
+                    self._texts[text_name] = "".join(self._texts[text_name])
+                    self._text_depths[text_name] = None
+
+    @staticmethod
+    def _node_string(node: list) -> Optional[str]:
+        # as Tag.string: the only child string, or the string of the only child tag
+        while len(node) == 1:
+            if isinstance(node[0], str):
+                return node[0]
+            node = node[0]
+        return None
+
+    def handle_starttag(self, tag, attrs, self_closing=False):
+        self._end_data()
+        if tag in self.EMPTY_ELEMENT_TAGS:
+            if self._title_depth is not None:
+                self._title_nodes[-1].append([])
+            if not self_closing:
+                self._closed_empty_elements.append(tag)
+            return
+        if self._title_depth is not None:
+            self._title_nodes.append([])
+        elif tag == "title" and self._title_nodes is None:
+            self._title_nodes = [[]]
+            self._title_depth = len(self._stack)
+        if tag in ("h1", "h2") and self._texts[tag] is None:
+            self._texts[tag] = []
+            self._text_depths[tag] = len(self._stack)
+        self._stack.append(tag)
+        if tag in self.STRING_CONTAINER_TAGS:
+            self._num_containers += 1
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self._num_preserve_whitespace += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, self_closing=True)
+        self._end_tag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_empty_elements:
+            self._closed_empty_elements.remove(tag)
+            return
+        self._end_tag(tag)
+
+    def _end_tag(self, tag: str) -> None:
+        self._end_data()
+        # as BeautifulSoup, close the most recent open tag of that name and the tags in it, or ignore the end tag
+        for depth in range(len(self._stack) - 1, -1, -1):
+            if self._stack[depth] == tag:
+                self._end_tags(depth)
+                self._check()
+                return
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_entityref(self, name):
+        # unknown entities are kept as text, without their semicolon, as BeautifulSoup does
+        self._data.append(html.entities.html5.get(f"{name};", f"&{name}"))
+
+    def handle_charref(self, name):
+        self._data.append(html.unescape(f"&#{name};"))
+
+    def _handle_string(self, data: str, kind: str) -> None:
+        self._end_data()
+        self._data.append(data)
+        self._end_data(kind)
+
+    def handle_comment(self, data):
+        self._handle_string(data, "comment")
+
+    def handle_decl(self, decl):
+        self._handle_string(decl[len("DOCTYPE "):], "declaration")
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self._handle_string(data[len("CDATA["):], "cdata")
+        else:
+            self._handle_string(data, "declaration")
+
+    def handle_pi(self, data):
+        self._handle_string(data, "declaration")
 
 class HTMLParser(BaseParser):
     """Parses HTML content."""
@@ -345,7 +921,8 @@ class HTMLParser(BaseParser):
 
     def __init__(self) -> None:
         super().__init__()
-        self.token_estimator = TokenEstimator()
+        self.token_estimator = TOKEN_ESTIMATOR
+        self._title_extractor = HTMLTitleExtractor()
 
     def parse(self, content: str, file_name: Optional[str] = None) -> Document:
         """Parses the given content.
@@ -355,31 +932,12 @@ class HTMLParser(BaseParser):
         Returns:
             Document: The parsed document.
         """
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # Extract the title
-        title = ''
-        if soup.title and soup.title.string:
-            title = soup.title.string
-        else:
-            # Try to find the first <h1> tag
-            h1_tag = soup.find('h1')
-            if h1_tag:
-                title = h1_tag.get_text(strip=True)
-            else:
-                h2_tag = soup.find('h2')
-                if h2_tag:
-                    title = h2_tag.get_text(strip=True)
-        if title is None or title == '':
-            # if title is still not found, guess using the next string
-            try:
-                title = next(soup.stripped_strings)
-                title = self.token_estimator.construct_tokens_with_size(title, self.TITLE_MAX_TOKENS)
-
-            except StopIteration:
-                title = file_name
-
-                # Helper function to process text nodes
+        # Extract the title: the <title>, else the first <h1> or <h2>, else the first string
+        title, title_tag = self._title_extractor.extract(content)
+        if title_tag == "string":
+            title = self.token_estimator.construct_tokens_with_size(title, self.TITLE_MAX_TOKENS)
+        elif title_tag is None:
+            title = file_name
 
         # Parse the content as it is without any formatting changes
         result = content
@@ -488,6 +1046,18 @@ class UnsupportedFormatError(Exception):
 
     pass
 
+class FileTimeoutError(Exception):
+    """Exception raised when a file takes longer than the per-file timeout to process."""
+
+    pass
+
+class EmbeddingRequestError(Exception):
+    """Exception raised when an embedding request fails for good, with the status code of its last response, if any."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
 @dataclass
 class ChunkingResult:
     """Data model for chunking result
@@ -498,6 +1068,12 @@ class ChunkingResult:
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        embedding_cache_hits (int): Number of embeddings found in the embedding cache.
+        embedding_cache_misses (int): Number of embeddings not found in the embedding cache.
+        embedding_latencies (List[float]): Latency of each embedding request, in seconds.
+        chunk_sizes (List[int]): Number of tokens of each chunk.
+        peak_rss (int): Peak resident memory of the process that chunked the file, by the time it was chunked, in bytes.
+        stale_document_ids (List[str]): With a manifest, the ids of the stored chunks of deleted and changed files to delete.
     """
     chunks: List[Document]
     total_files: int
@@ -505,6 +1081,215 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    embedding_cache_hits: int = 0
+    embedding_cache_misses: int = 0
+    embedding_latencies: List[float] = field(default_factory=list)
+    chunk_sizes: List[int] = field(default_factory=list)
+    peak_rss: Optional[int] = None
+    stale_document_ids: List[str] = field(default_factory=list)
+
+@dataclass
+class ChunkingStats:
+    """Running totals of a streaming chunking run
+
+    Attributes:
+        total_files (int): Number of files processed so far.
+        num_unsupported_format_files (int): Number of files with unsupported format so far.
+        num_files_with_errors (int): Number of files with errors so far.
+        skipped_chunks (int): Number of chunks skipped so far.
+        num_chunks (int): Number of chunks yielded so far.
+        num_unchanged_files (int): Number of files skipped because the manifest has them unchanged.
+        embedding_cache_hits (int): Number of embeddings found in the embedding cache so far.
+        embedding_cache_misses (int): Number of embeddings not found in the embedding cache so far.
+        embedding_latencies (List[float]): Latency of each embedding request so far, in seconds.
+        queue_depths (Dict[str, int]): Peak number of files waiting in each queue of the ChunkingPipeline.
+        peak_rss_by_file (Dict[str, int]): Peak resident memory of the process that chunked each file, by the time it was chunked, in bytes.
+    """
+    total_files: int = 0
+    num_unsupported_format_files: int = 0
+    num_files_with_errors: int = 0
+    skipped_chunks: int = 0
+    num_chunks: int = 0
+    num_unchanged_files: int = 0
+    embedding_cache_hits: int = 0
+    embedding_cache_misses: int = 0
+    embedding_latencies: List[float] = field(default_factory=list)
+    queue_depths: Dict[str, int] = field(default_factory=dict)
+    peak_rss_by_file: Dict[str, int] = field(default_factory=dict)
+
+@dataclass
+class CrackedFile:
+    """The content of a file read by crack_file, on its way from the cracking to the chunking stage of the ChunkingPipeline
+
+    Attributes:
+        file_path (str): Path of the file.
+        content (str): The content of the file, or of its cracked pdf.
+        image_mapping (Dict[str, str]): The images of the image tags in the content.
+        cracked_pdf (bool): Whether the file was cracked with Document Intelligence.
+        analysis (dict): The Document Intelligence result of a cracked file, from which the chunking stage builds its content
+                         with pdf_content_from_analysis, so that the cracking stage only waits on the service.
+    """
+    file_path: str
+    content: str
+    image_mapping: Dict[str, str]
+    cracked_pdf: bool
+    analysis: Optional[dict] = None
+
+@dataclass
+class ManifestReport:
+    """Data model for the files of a directory compared to an ingestion manifest
+
+    Attributes:
+        added (List[str]): Files that are not in the manifest.
+        changed (List[str]): Files whose content or config fingerprint changed since they were ingested.
+        deleted (List[str]): Files in the manifest that are no longer in the directory.
+        unchanged (List[str]): Files that were ingested with the same content and config, and are skipped.
+        previous_num_chunks (Dict[str, int]): Number of chunks the changed and deleted files had when they were ingested.
+    """
+    added: List[str]
+    changed: List[str]
+    deleted: List[str]
+    unchanged: List[str]
+    previous_num_chunks: Dict[str, int]
+
+# files are hashed a block at a time, so that large files are not read into memory
+FILE_HASH_BLOCK_SIZE = 1 << 20
+
+def _file_sha256(file_path: str) -> str:
+    """Returns the sha256 hex digest of the content of a file."""
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(partial(f.read, FILE_HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+class IngestionManifest:
+    """A local SQLite manifest of the files ingested from a source, used to skip the files that did not change.
+
+    Files are compared by size and mtime first, and by content hash only when those differ, so that a refresh
+    of an unchanged share does not read it. Records of the processed files are staged until commit is called,
+    which callers should only do once the chunks are stored, so an interrupted run redoes the files instead of
+    losing them.
+    """
+    def __init__(self, manifest_path: str, source: str, config_fingerprint: str) -> None:
+        """
+        Args:
+            manifest_path (str): The path of the SQLite file. It is created if it does not exist.
+            source (str): The data source the files belong to, e.g. a data path or blob url. One manifest can track several sources.
+            config_fingerprint (str): The fingerprint of the chunking config, see config_fingerprint.
+        """
+        self.source = source
+        self.fingerprint = config_fingerprint
+        self.report = None
+        self._file_info = {}
+        self._recorded = {}
+        self._connection = sqlite3.connect(manifest_path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (source TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, "
+            "content_hash TEXT, config_fingerprint TEXT, num_chunks INTEGER, PRIMARY KEY (source, path))")
+        self._connection.commit()
+
+    # number of added, changed and deleted paths listed by print_report, the rest are only counted
+    REPORT_SAMPLE_SIZE = 10
+
+    @staticmethod
+    def config_fingerprint(num_tokens: int, token_overlap: int, embedding_endpoint: Optional[str], use_layout: bool, use_token_window: bool = False,
+                           url_prefix: Optional[str] = None, captioning_model_endpoint: Optional[str] = None, min_chunk_size: int = 10,
+                           extensions_to_process: Optional[List[str]] = None) -> str:
+        """Returns a fingerprint of the settings that change the chunks of a file, i.e. those that crack_file and
+        process_cracked_file take. captioning_model_endpoint is the endpoint images are captioned with, or None if they are not.
+        """
+        if extensions_to_process is None:
+            extensions_to_process = FILE_FORMAT_DICT.keys()
+        # the api version of the captioning endpoint does not change the model
+        captioning_model = captioning_model_endpoint.split("?")[0] if captioning_model_endpoint else None
+        config = [num_tokens, token_overlap, embedding_endpoint, bool(use_layout), bool(use_token_window),
+                  url_prefix, captioning_model, min_chunk_size, sorted(extensions_to_process)]
+        return hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest()
+
+    def compare(self, directory_path: str, file_paths: List[str]) -> List[str]:
+        """Compares the files of a directory to the manifest and sets self.report.
+        Args:
+            directory_path (str): The directory the files are in. Paths are tracked relative to it.
+            file_paths (List[str]): The files of the directory.
+        Returns:
+            List[str]: The added and changed files, to be processed.
+        """
+        previous = {}
+        for path, size, mtime_ns, content_hash, fingerprint, num_chunks in self._connection.execute(
+                "SELECT path, size, mtime_ns, content_hash, config_fingerprint, num_chunks FROM files WHERE source = ?", (self.source,)):
+            previous[path] = (size, mtime_ns, content_hash, fingerprint, num_chunks)
+
+        report = ManifestReport(added=[], changed=[], deleted=[], unchanged=[], previous_num_chunks={})
+        files_to_process = []
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, directory_path)
+            stat = os.stat(file_path)
+            entry = previous.pop(rel_path, None)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns) and entry[3] == self.fingerprint:
+                report.unchanged.append(rel_path)
+                continue
+            content_hash = _file_sha256(file_path)
+            self._file_info[rel_path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+            if entry is None:
+                report.added.append(rel_path)
+            elif entry[2] == content_hash and entry[3] == self.fingerprint:
+                # only the mtime changed, e.g. a fresh download of a blob container
+                report.unchanged.append(rel_path)
+                self._recorded[rel_path] = entry[4]
+                continue
+            else:
+                report.changed.append(rel_path)
+                report.previous_num_chunks[rel_path] = entry[4]
+            files_to_process.append(file_path)
+
+        for rel_path, entry in previous.items():
+            report.deleted.append(rel_path)
+            report.previous_num_chunks[rel_path] = entry[4]
+
+        self.report = report
+        return files_to_process
+
+    def record(self, rel_path: str, num_chunks: int) -> None:
+        """Stages the record of a file that was processed. Files that failed should not be recorded, so they are retried."""
+        self._recorded[rel_path] = num_chunks
+
+    def document_id(self, rel_path: str, chunk_index: int) -> str:
+        """Returns a stable id for a chunk of a file, so that re-ingested files overwrite their previous chunks."""
+        return hashlib.sha1(json.dumps([self.source, rel_path, chunk_index]).encode("utf-8")).hexdigest()
+
+    def stale_document_ids(self) -> List[str]:
+        """Returns the ids of the chunks of the deleted files, and of the chunks that changed files no longer have."""
+        ids = []
+        for rel_path in self.report.deleted:
+            ids.extend(self.document_id(rel_path, i) for i in range(self.report.previous_num_chunks[rel_path]))
+        for rel_path in self.report.changed:
+            if rel_path in self._recorded:
+                ids.extend(self.document_id(rel_path, i) for i in range(self._recorded[rel_path], self.report.previous_num_chunks[rel_path]))
+        return ids
+
+    def commit(self) -> None:
+        """Writes the staged records and removes the deleted files from the manifest."""
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.source, rel_path, *self._file_info[rel_path], self.fingerprint, num_chunks) for rel_path, num_chunks in self._recorded.items()])
+            if self.report:
+                self._connection.executemany("DELETE FROM files WHERE source = ? AND path = ?", [(self.source, rel_path) for rel_path in self.report.deleted])
+        self._recorded = {}
+
+    def print_report(self) -> None:
+        """Prints the number of added, changed, deleted and unchanged files, and the first REPORT_SAMPLE_SIZE paths of each change."""
+        print(f"Manifest: {len(self.report.added)} added, {len(self.report.changed)} changed, {len(self.report.deleted)} deleted, "
+              f"{len(self.report.unchanged)} unchanged files")
+        for name, rel_paths in [("Added", self.report.added), ("Changed", self.report.changed), ("Deleted", self.report.deleted)]:
+            for rel_path in rel_paths[:self.REPORT_SAMPLE_SIZE]:
+                print(f"  {name}: {rel_path}")
+            if len(rel_paths) > self.REPORT_SAMPLE_SIZE:
+                print(f"  {name}: ... and {len(rel_paths) - self.REPORT_SAMPLE_SIZE} more")
+
+    def close(self) -> None:
+        self._connection.close()
 
 def extractStorageDetailsFromUrl(url):
     matches = re.fullmatch(r'https:\/\/([^\/.]*)\.blob\.core\.windows\.net\/([^\/]*)\/(.*)', url)
@@ -569,19 +1354,24 @@ def _get_file_format(file_name: str, extensions_to_process: List[str]) -> Option
     return FILE_FORMAT_DICT.get(file_extension, None)
 
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # group the cells by row in one pass; the sort below is stable, so cells sharing a column keep their order
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+
+    table_html = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span and cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span and cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
 
 def polygon_to_bbox(polygon, dpi=72):
     x_coords = polygon[0::2]
@@ -590,14 +1380,596 @@ def polygon_to_bbox(polygon, dpi=72):
     x1, y1 = max(x_coords)*dpi, max(y_coords)*dpi
     return x0, y0, x1, y1
 
-def extract_pdf_content(file_path, form_recognizer_client, use_layout=False): 
+def _page_text_from_spans(content: str, page_offset: int, page_length: int, tables_on_page: List, header_tags: Dict[int, str], header_positions: List[int],
+                          figure_tags: Optional[Dict[int, Tuple[int, str]]] = None, figure_positions: List[int] = (), substituted_tags: Optional[set] = None) -> str:
+    """Builds the text of a page from the analyzed content, replacing table spans with the table html, figure spans with
+    their image tags and inserting header tags, by joining slices of the content instead of copying it char by char.
+    Args:
+        content (str): The content of the analyze result.
+        page_offset (int): The offset of the page in content.
+        page_length (int): The length of the page in content.
+        tables_on_page (List): The tables of the page. Where spans overlap, the later table wins.
+        header_tags (Dict[int, str]): The header tags to insert before the character at each offset.
+        header_positions (List[int]): The sorted keys of header_tags.
+        figure_tags (Dict[int, Tuple[int, str]]): The end offset and image tag of the figure starting at each offset. Figures that
+                                                  are not within the text of a page outside of tables are left as text.
+        figure_positions (List[int]): The sorted keys of figure_tags.
+        substituted_tags (set): Where to add the image tags that were substituted.
+    Returns:
+        str: The page text, without the trailing separator.
+    """
+    page_end = page_offset + page_length
+
+    # split the page into runs of characters owned by the same table (or by no table, -1)
+    events = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start, end = max(span.offset, page_offset), min(span.offset + span.length, page_end)
+            if start < end:
+                events.append((start, 1, table_id))
+                events.append((end, -1, table_id))
+    events.sort()
+    runs = []
+    active = {}
+    run_start = page_offset
+    for position, change, table_id in events:
+        if position > run_start:
+            runs.append((run_start, position, max(active) if active else -1))
+            run_start = position
+        active[table_id] = active.get(table_id, 0) + change
+        if active[table_id] == 0:
+            del active[table_id]
+    if page_end > run_start:
+        runs.append((run_start, page_end, -1))
+
+    parts = []
+    added_tables = set()
+    for start, end, table_id in runs:
+        if table_id == -1:
+            cursor = start
+            h, h_end = bisect.bisect_left(header_positions, start), bisect.bisect_left(header_positions, end)
+            f, f_end = bisect.bisect_left(figure_positions, start), bisect.bisect_left(figure_positions, end)
+            while h < h_end or f < f_end:
+                # a header tag at the start of a figure goes before its image tag
+                if f == f_end or (h < h_end and header_positions[h] <= figure_positions[f]):
+                    position = header_positions[h]
+                    h += 1
+                    parts.append(content[cursor:position])
+                    parts.append(header_tags[position])
+                    cursor = position
+                    continue
+                position = figure_positions[f]
+                f += 1
+                figure_end, img_tag = figure_tags[position]
+                if figure_end > end or position < cursor:
+                    continue
+                parts.append(content[cursor:position])
+                parts.append(img_tag)
+                substituted_tags.add(img_tag)
+                cursor = figure_end
+                # the header tags within the figure go with its text
+                while h < h_end and header_positions[h] < figure_end:
+                    h += 1
+            parts.append(content[cursor:end])
+        elif table_id not in added_tables:
+            parts.append(table_to_html(tables_on_page[table_id]))
+            added_tables.add(table_id)
+    return "".join(parts)
+
+def get_form_recognizer_client() -> Optional[DocumentIntelligenceClient]:
+    """Returns the Document Intelligence client of this process configured by FORM_RECOGNIZER_ENDPOINT and FORM_RECOGNIZER_KEY,
+    or None if they are not set."""
+    url = os.getenv("FORM_RECOGNIZER_ENDPOINT")
+    key = os.getenv("FORM_RECOGNIZER_KEY")
+    if not url or not key:
+        return None
+    return _form_recognizer_client(url, key, os.getpid())
+
+@lru_cache(maxsize=None)
+def _form_recognizer_client(url: str, key: str, pid: int) -> DocumentIntelligenceClient:
+    # keyed by the pid, so that forked worker processes do not share the connections of their parent
+    return DocumentIntelligenceClient(endpoint=url, credential=AzureKeyCredential(key), headers=DOCUMENT_INTELLIGENCE_HEADERS)
+
+def create_async_form_recognizer_client() -> Optional[AsyncDocumentIntelligenceClient]:
+    """Returns a new async Document Intelligence client configured by FORM_RECOGNIZER_ENDPOINT and FORM_RECOGNIZER_KEY,
+    or None if they are not set. The client belongs to the event loop it is used on, and the caller closes it."""
+    url = os.getenv("FORM_RECOGNIZER_ENDPOINT")
+    key = os.getenv("FORM_RECOGNIZER_KEY")
+    if not url or not key:
+        return None
+    return AsyncDocumentIntelligenceClient(endpoint=url, credential=AzureKeyCredential(key), headers=DOCUMENT_INTELLIGENCE_HEADERS)
+
+class _SqliteCache:
+    """A persistent cache of values in a table of a local SQLite file, shared by the processes of a run and across runs.
+
+    Values are evicted least recently used first once they take more than max_bytes. Connections are per process, so
+    the cache can be used from ProcessPoolExecutor workers, and from the threads of the stages of a ChunkingPipeline.
+    Subclasses set the table, the env vars that configure the cache of a process, and how values are stored.
+    """
+    TABLE = None
+    VALUE_COLUMN = None
+    ENV_PREFIX = None
+    DEFAULT_MAX_MB = None
+    EVICTION_CHECK_INTERVAL = 16
+    # entries used again within this interval keep their last use time, to save a write per hit
+    TOUCH_INTERVAL_SECONDS = 0
+
+    _instance = None
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None) -> None:
+        self.path = path
+        self.max_bytes = max_bytes if max_bytes is not None else self.DEFAULT_MAX_MB << 20
+        self.hits = 0
+        self.misses = 0
+        self._pid = None
+        self._connection = None
+        self._num_puts = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Returns the cache of this process configured by <ENV_PREFIX>_PATH and <ENV_PREFIX>_MAX_MB, or None if it is not set."""
+        path = os.getenv(f"{cls.ENV_PREFIX}_PATH")
+        if not path:
+            return None
+        if cls._instance is None or cls._instance.path != path:
+            cls._instance = cls(path, max_bytes=int(os.getenv(f"{cls.ENV_PREFIX}_MAX_MB", cls.DEFAULT_MAX_MB)) << 20)
+        return cls._instance
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # a connection must not be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            with self._connection:
+                self._connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.TABLE} (key TEXT PRIMARY KEY, {self.VALUE_COLUMN} BLOB NOT NULL, last_used REAL NOT NULL)")
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_last_used ON {self.TABLE} (last_used)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str):
+        with self._lock:
+            row = self.connection.execute(f"SELECT {self.VALUE_COLUMN}, last_used FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            data, last_used = row
+            now = time.time()
+            if now - last_used >= self.TOUCH_INTERVAL_SECONDS:
+                with self.connection:
+                    self.connection.execute(f"UPDATE {self.TABLE} SET last_used = ? WHERE key = ?", (now, key))
+        return self._decode(data)
+
+    def put(self, key: str, value) -> None:
+        data = self._encode(value)
+        with self._lock:
+            with self.connection:
+                self.connection.execute(f"INSERT OR REPLACE INTO {self.TABLE} VALUES (?, ?, ?)", (key, data, time.time()))
+            self._num_puts += 1
+            if self._num_puts % self.EVICTION_CHECK_INTERVAL == 0 or len(data) > self.max_bytes / self.EVICTION_CHECK_INTERVAL:
+                self._evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the values take at most 90% of max_bytes."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        total_bytes = self.connection.execute(f"SELECT COALESCE(SUM(LENGTH({self.VALUE_COLUMN})), 0) FROM {self.TABLE}").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        # keeps the most recently used entries that fit in 90% of max_bytes
+        with self.connection:
+            self.connection.execute(
+                f"DELETE FROM {self.TABLE} WHERE key IN (SELECT key FROM (SELECT key, SUM(LENGTH({self.VALUE_COLUMN})) "
+                f"OVER (ORDER BY last_used DESC, rowid DESC) AS kept_bytes FROM {self.TABLE}) WHERE kept_bytes > ?)", (0.9 * self.max_bytes,))
+
+    def _encode(self, value) -> bytes:
+        raise NotImplementedError
+
+    def _decode(self, data: bytes):
+        raise NotImplementedError
+
+class AnalysisCache(_SqliteCache):
+    """A persistent cache of Document Intelligence analyze results, so that a file is analyzed only once whatever the
+    chunking settings of later runs. Results are stored zlib-compressed, keyed by the hash of the file content, the
+    model and the api version.
+    """
+    TABLE = "results"
+    VALUE_COLUMN = "result"
+    ENV_PREFIX = "ANALYSIS_CACHE"
+    DEFAULT_MAX_MB = 4096
+
+    _instance = None
+
+    @staticmethod
+    def key(file_hash: str, model: str, api_version: Optional[str]) -> str:
+        return hashlib.sha256(json.dumps([file_hash, model, api_version]).encode("utf-8")).hexdigest()
+
+    def _encode(self, result: AnalyzeResult) -> bytes:
+        return zlib.compress(json.dumps(result.as_dict()).encode("utf-8"))
+
+    def _decode(self, data: bytes) -> AnalyzeResult:
+        return AnalyzeResult(json.loads(zlib.decompress(data)))
+
+class CaptionCache(_SqliteCache):
+    """A persistent cache of image captions, configured by CAPTION_CACHE_PATH and CAPTION_CACHE_MAX_MB, so that unchanged
+    images are captioned only once across runs. Captions are keyed by the hash of the image, the prompt and the captioning
+    deployment.
+    """
+    TABLE = "captions"
+    VALUE_COLUMN = "caption"
+    ENV_PREFIX = "CAPTION_CACHE"
+    DEFAULT_MAX_MB = 256
+
+    _instance = None
+
+    @staticmethod
+    def key(image_hash: str, prompt: str, captioning_model_endpoint: str) -> str:
+        # the api version of the endpoint does not change the model
+        return hashlib.sha256(json.dumps([image_hash, prompt, captioning_model_endpoint.split("?")[0]]).encode("utf-8")).hexdigest()
+
+    def _encode(self, caption: str) -> bytes:
+        return caption.encode("utf-8")
+
+    def _decode(self, data: bytes) -> str:
+        return data.decode("utf-8")
+
+def _analysis_cache_key(file_path: str, form_recognizer_client, model: str) -> Optional[str]:
+    """Returns the key of the analysis of a file in the AnalysisCache, or None if there is no cache."""
+    if not AnalysisCache.from_env():
+        return None
+    api_version = getattr(getattr(form_recognizer_client, "_config", None), "api_version", None)
+    return AnalysisCache.key(_file_sha256(file_path), model, api_version)
+
+def _analysis_cache_model(file_path: str, model: str) -> str:
+    # analyses with pages read from the text layer differ from those of the service alone
+    if os.getenv("PDF_TEXT_LAYER") and file_path.lower().endswith(".pdf"):
+        return f"{model}+text-layer"
+    return model
+
+def pdf_shard_ranges(file_path: str, file_size: int) -> List[Tuple[int, int]]:
+    """Returns the page ranges [start, end) to analyze a PDF in, so that no range has more than PDF_SHARD_PAGES pages
+    or about PDF_SHARD_MAX_MB megabytes. Returns a single range for other files, or when neither is set or exceeded.
+    """
+    max_pages = int(os.getenv("PDF_SHARD_PAGES") or 0)
+    max_bytes = float(os.getenv("PDF_SHARD_MAX_MB") or 0) * (1 << 20)
+    if not file_path.lower().endswith(".pdf") or not (max_pages or max_bytes):
+        return [(0, None)]
+    with fitz.open(file_path) as document:
+        page_count = document.page_count
+    num_shards = max(math.ceil(page_count / max_pages) if max_pages else 1, math.ceil(file_size / max_bytes) if max_bytes else 1)
+    if num_shards <= 1 or page_count <= 1:
+        return [(0, None)]
+    shard_pages = math.ceil(page_count / min(num_shards, page_count))
+    return [(start, min(start + shard_pages, page_count)) for start in range(0, page_count, shard_pages)]
+
+def _pdf_shard(file_path: str, start: int, end: int) -> bytes:
+    """Returns a PDF with the pages [start, end) of a PDF file."""
+    with fitz.open(file_path) as document, fitz.open() as shard:
+        shard.insert_pdf(document, from_page=start, to_page=end - 1)
+        return shard.tobytes(garbage=3, deflate=True)
+
+def _has_text_layer(page) -> bool:
+    text = page.get_text("text")
+    num_chars = sum(not char.isspace() for char in text)
+    # glyphs of fonts without a unicode mapping are extracted as U+FFFD
+    if num_chars < PDF_TEXT_LAYER_MIN_CHARS or text.count("\ufffd") > 0.05 * num_chars:
+        return False
+    page_area = abs(page.rect)
+    image_area = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+    return not page_area or image_area / page_area <= PDF_TEXT_LAYER_MAX_IMAGE_COVERAGE
+
+def pdf_text_layer_pages(file_path: str) -> List[bool]:
+    """Returns whether each page of a PDF has a usable text layer: enough characters with a unicode mapping, and not so much
+    of the page covered by images that it is likely a scan, whose text would be better read by OCR, or mostly figures."""
+    with fitz.open(file_path) as document:
+        return [_has_text_layer(page) for page in document]
+
+def pdf_analysis_ranges(file_path: str, file_size: int) -> List[Tuple[int, Optional[int], bool]]:
+    """Returns the page ranges [start, end) to analyze a file in, and whether each range is read from the text layer of the PDF
+    instead of by Document Intelligence. Without PDF_TEXT_LAYER set, or when no page has a usable text layer, these are the
+    ranges of pdf_shard_ranges; otherwise runs of pages with and without a text layer, the latter split at the shard boundaries.
+    """
+    shard_ranges = pdf_shard_ranges(file_path, file_size)
+    text_layer = pdf_text_layer_pages(file_path) if os.getenv("PDF_TEXT_LAYER") and file_path.lower().endswith(".pdf") else []
+    if not any(text_layer):
+        return [(start, end, False) for start, end in shard_ranges]
+    shard_starts = {start for start, _ in shard_ranges}
+    ranges = []
+    for page_index, local in enumerate(text_layer):
+        if ranges and ranges[-1][2] == local and (local or page_index not in shard_starts):
+            ranges[-1] = (ranges[-1][0], page_index + 1, local)
+        else:
+            ranges.append((page_index, page_index + 1, local))
+    return ranges
+
+def _text_layer_table(table) -> Dict[str, Any]:
+    """Returns a table found by PyMuPDF in the shape of a table of the Layout model, without its spans. A merged cell spans
+    the rows and columns that start within its bounding box."""
+    texts = table.extract()
+    column_starts = [min((row.cells[column][0] for row in table.rows if row.cells[column]), default=math.inf) for column in range(table.col_count)]
+    row_starts = [row.bbox[1] for row in table.rows]
+    cells = []
+    for row_index, row in enumerate(table.rows):
+        for column_index, bbox in enumerate(row.cells):
+            if bbox is None:
+                continue
+            cells.append({
+                "kind": "columnHeader" if row_index == 0 and not table.header.external else "content",
+                "rowIndex": row_index,
+                "columnIndex": column_index,
+                "rowSpan": sum(1 for start in row_starts[row_index:] if start < bbox[3] - 1) or 1,
+                "columnSpan": sum(1 for start in column_starts[column_index:] if start < bbox[2] - 1) or 1,
+                "content": " ".join((texts[row_index][column_index] or "").split()),
+            })
+    return {"rowCount": table.row_count, "columnCount": table.col_count, "cells": cells}
+
+def _text_layer_page_items(page, use_layout: bool) -> List[Tuple[str, Any]]:
+    """Returns the paragraphs of a page, as ("paragraph", lines) with the (text, font size, bold) of each line, and with use_layout
+    its tables, as ("table", table), in the order of the content stream, which is the reading order of most generated PDFs."""
+    tables = [(fitz.Rect(table.bbox), _text_layer_table(table)) for table in page.find_tables().tables] if use_layout else []
+    items = []
+    added_tables = set()
+    for block in page.get_text("dict")["blocks"]:
+        if block["type"] != 0:
+            continue
+        bbox = fitz.Rect(block["bbox"])
+        center = (bbox.tl + bbox.br) / 2
+        # the text of a table is replaced by the table, where its first line is
+        table_index = next((i for i, (table_bbox, _) in enumerate(tables) if center in table_bbox), None)
+        if table_index is not None:
+            if table_index not in added_tables:
+                items.append(("table", tables[table_index][1]))
+                added_tables.add(table_index)
+            continue
+        lines = []
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            if text:
+                spans = [span for span in line["spans"] if span["text"].strip()]
+                lines.append((text, max(span["size"] for span in spans), all(span["flags"] & 16 for span in spans)))
+        if lines:
+            items.append(("paragraph", lines))
+    items.extend(("table", table) for i, (_, table) in enumerate(tables) if i not in added_tables)
+    return items
+
+def _text_layer_role(lines: List[Tuple[str, float, bool]], body_size: float, title_size: float) -> Optional[str]:
+    size = max(line_size for _, line_size, _ in lines)
+    if len(lines) > 3 or sum(len(text) for text, _, _ in lines) > PDF_TEXT_LAYER_HEADING_MAX_CHARS:
+        return None
+    if size >= title_size:
+        return "title"
+    if size >= body_size * PDF_TEXT_LAYER_HEADING_SCALE or (size >= body_size and all(bold for _, _, bold in lines)):
+        return "sectionHeading"
+    return None
+
+def pdf_text_layer_analyses(file_path: str, page_ranges: List[Tuple[int, int]], use_layout: bool = False) -> List[AnalyzeResult]:
+    """Reads page ranges of a PDF from its text layer into results in the shape of Document Intelligence analyses, which
+    stitch_analyze_results joins with the analyses of the other pages: one line of content per line of text, and the paragraphs
+    of the pages. With use_layout, as the Layout model, the tables of the pages are found from their ruling lines, and the
+    paragraphs of short lines set larger than the body text, or in bold, are given the roles of titles and section headings.
+    The largest of these, if it is PDF_TEXT_LAYER_TITLE_SCALE times the body text, are titles.
+    Args:
+        file_path (str): Path of the PDF.
+        page_ranges (List[Tuple[int, int]]): The page ranges [start, end) to read.
+        use_layout (bool): Whether to find tables and headers.
+    Returns:
+        List[AnalyzeResult]: The analysis of each range.
+    """
+    with fitz.open(file_path) as document:
+        page_items = [[_text_layer_page_items(document[page_index], use_layout) for page_index in range(start, end)] for start, end in page_ranges]
+
+    # the body text is the size most characters are set in, the title the largest size of a header
+    chars_by_size = {}
+    for pages in page_items:
+        for items in pages:
+            for kind, lines in items:
+                if kind == "paragraph":
+                    for text, size, _ in lines:
+                        chars_by_size[round(size, 1)] = chars_by_size.get(round(size, 1), 0) + len(text)
+    body_size = max(chars_by_size, key=chars_by_size.get, default=0)
+    title_size = max(max(chars_by_size, default=0), body_size * PDF_TEXT_LAYER_TITLE_SCALE)
+
+    results = []
+    for pages in page_items:
+        lines, result = [], {"modelId": "text-layer", "pages": [], "paragraphs": []}
+        if use_layout:
+            result["tables"] = []
+        offset = 0
+
+        def add_lines(texts):
+            nonlocal offset
+            start = offset
+            for text in texts:
+                lines.append(text)
+                offset += len(text) + 1
+            return {"offset": start, "length": offset - 1 - start}
+
+        for page_number, items in enumerate(pages, start=1):
+            page_start = offset
+            for kind, item in items:
+                if kind == "table":
+                    span = add_lines([cell["content"] for cell in item["cells"]])
+                    result["tables"].append(dict(item, spans=[span]))
+                    continue
+                span = add_lines([text for text, _, _ in item])
+                paragraph = {"content": " ".join(text for text, _, _ in item), "spans": [span]}
+                role = _text_layer_role(item, body_size, title_size) if use_layout else None
+                if role:
+                    paragraph["role"] = role
+                result["paragraphs"].append(paragraph)
+            # the page ends with the new line after its last line, so that a table at the end of a page is within it
+            result["pages"].append({"pageNumber": page_number, "spans": [{"offset": page_start, "length": offset - page_start}]})
+        result["content"] = "".join(line + "\n" for line in lines)
+        results.append(AnalyzeResult(result))
+    return results
+
+def _stitch_analysis_ranges(ranges: List[Tuple[int, Optional[int], bool]], local_results: List[AnalyzeResult], remote_results: List[AnalyzeResult]) -> AnalyzeResult:
+    local_results, remote_results = iter(local_results), iter(remote_results)
+    results = [next(local_results) if local else next(remote_results) for _, _, local in ranges]
+    return stitch_analyze_results(results, [start for start, _, _ in ranges])
+
+def _shift_analysis(value: Any, offset: int, page_offset: int, element_offsets: Dict[str, int]) -> None:
+    """Shifts, in place, the spans, page numbers and element references of a shard analysis to where the shard is in the stitched analysis."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "pageNumber":
+                value[key] = item + page_offset
+            elif key == "offset" and "length" in value:
+                value[key] = item + offset
+            elif key == "elements":
+                # references like "/paragraphs/12"
+                value[key] = [_shift_element(element, element_offsets) for element in item]
+            else:
+                _shift_analysis(item, offset, page_offset, element_offsets)
+    elif isinstance(value, list):
+        for item in value:
+            _shift_analysis(item, offset, page_offset, element_offsets)
+
+def _shift_element(element: str, element_offsets: Dict[str, int]) -> str:
+    _, collection, index = element.split("/", 2)
+    return f"/{collection}/{int(index) + element_offsets.get(collection, 0)}"
+
+def stitch_analyze_results(results: List[AnalyzeResult], page_offsets: List[int]) -> AnalyzeResult:
+    """Stitches the analyses of the page ranges of a document into the analysis of the whole document: contents are joined
+    by new lines, and spans, page numbers and element references are shifted so that the text of each page, and the page and
+    bounding box of each figure, are where they would be in a single analysis.
+    Args:
+        results (List[AnalyzeResult]): The analyses of the page ranges, in page order.
+        page_offsets (List[int]): The number of pages of the document before each range.
+    Returns:
+        AnalyzeResult: The analysis of the whole document.
+    """
+    stitched = {}
+    contents = []
     offset = 0
-    page_map = []
+    for result, page_offset in zip(results, page_offsets):
+        shard = result.as_dict()
+        element_offsets = {key: len(items) for key, items in stitched.items() if isinstance(items, list)}
+        _shift_analysis(shard, offset, page_offset, element_offsets)
+        for figure in shard.get("figures", []):
+            # figure ids are "<page number>.<index on the page>"
+            page_number, _, index = figure.get("id", "").partition(".")
+            if page_number.isdigit():
+                figure["id"] = f"{int(page_number) + page_offset}.{index}"
+        for key, value in shard.items():
+            if key == "content":
+                continue
+            if isinstance(value, list):
+                stitched.setdefault(key, []).extend(value)
+            else:
+                stitched.setdefault(key, value)
+        contents.append(shard.get("content", ""))
+        offset += len(contents[-1]) + 1
+    stitched["content"] = "\n".join(contents)
+    return AnalyzeResult(stitched)
+
+def _analyze_body(form_recognizer_client, model: str, body: Union[bytes, IO[bytes]]) -> AnalyzeResult:
+    """Analyzes an open file, streamed as the raw body of the request, or the bytes of a shard, without base64 copies of them."""
+    poller = form_recognizer_client.begin_analyze_document(model, body, content_type="application/octet-stream")
+    return poller.result()
+
+def _analyze_shard(form_recognizer_client, model: str, file_path: str, shard_range: Tuple[int, int]) -> AnalyzeResult:
+    # the shard is built by the thread that sends it, so that only the shards in flight are in memory
+    return _analyze_body(form_recognizer_client, model, _pdf_shard(file_path, *shard_range))
+
+async def _analyze_body_async(form_recognizer_client, model: str, body: Union[bytes, IO[bytes]], semaphore: asyncio.Semaphore) -> AnalyzeResult:
+    async with semaphore:
+        poller = await form_recognizer_client.begin_analyze_document(model, body, content_type="application/octet-stream")
+        return await poller.result()
+
+async def _analyze_shard_async(form_recognizer_client, model: str, file_path: str, shard_range: Tuple[int, int], semaphore: asyncio.Semaphore) -> AnalyzeResult:
+    async with semaphore:
+        # the shard is built once a slot is free, so that only the shards in flight are in memory
+        shard = await asyncio.get_running_loop().run_in_executor(None, _pdf_shard, file_path, *shard_range)
+        poller = await form_recognizer_client.begin_analyze_document(model, shard, content_type="application/octet-stream")
+        del shard
+        return await poller.result()
+
+def analyze_document(file_path: str, form_recognizer_client, use_layout: bool = False,
+                     ranges: Optional[List[Tuple[int, Optional[int], bool]]] = None) -> AnalyzeResult:
+    """Analyzes a file with the Layout or Read model of Document Intelligence, waiting for the result.
+    PDFs above PDF_SHARD_PAGES pages or PDF_SHARD_MAX_MB megabytes are analyzed in page ranges, in parallel, and stitched back.
+    With PDF_TEXT_LAYER set, the pages of a PDF with a usable text layer are read locally and only the others are sent to the
+    service, see pdf_analysis_ranges, so that no client is needed when every page is read locally. The result is looked up
+    in and added to the AnalysisCache, if ANALYSIS_CACHE_PATH is set. The ranges are computed if not given."""
     model = "prebuilt-layout" if use_layout else "prebuilt-read"
-    
-    base64file = base64.b64encode(open(file_path, "rb").read()).decode()
-    poller = form_recognizer_client.begin_analyze_document(model, AnalyzeDocumentRequest(bytes_source=base64file))
-    form_recognizer_results = poller.result()
+    if ranges is None:
+        ranges = pdf_analysis_ranges(file_path, os.path.getsize(file_path))
+    remote_ranges = [(start, end) for start, end, local in ranges if not local]
+    cache_key = _analysis_cache_key(file_path, form_recognizer_client if remote_ranges else None, _analysis_cache_model(file_path, model))
+    analysis_cache = AnalysisCache.from_env()
+    if cache_key:
+        result = analysis_cache.get(cache_key)
+        if result is not None:
+            return result
+    local_ranges = [(start, end) for start, end, local in ranges if local]
+    if not remote_ranges:
+        result = _stitch_analysis_ranges(ranges, pdf_text_layer_analyses(file_path, local_ranges, use_layout=use_layout), [])
+    elif len(ranges) > 1:
+        with ThreadPoolExecutor(min(len(remote_ranges), PDF_SHARD_CONCURRENCY)) as executor:
+            remote_results = executor.map(partial(_analyze_shard, form_recognizer_client, model, file_path), remote_ranges)
+            # the text layer is read while the other pages are analyzed
+            local_results = pdf_text_layer_analyses(file_path, local_ranges, use_layout=use_layout)
+            result = _stitch_analysis_ranges(ranges, local_results, list(remote_results))
+    else:
+        with open(file_path, "rb") as f:
+            result = _analyze_body(form_recognizer_client, model, f)
+    if cache_key:
+        analysis_cache.put(cache_key, result)
+    return result
+
+async def analyze_document_async(file_path: str, form_recognizer_client: AsyncDocumentIntelligenceClient, use_layout: bool = False) -> AnalyzeResult:
+    """Analyzes a file like analyze_document with an async client, so that many analyses can be polled on one event loop."""
+    loop = asyncio.get_running_loop()
+    model = "prebuilt-layout" if use_layout else "prebuilt-read"
+    ranges = await loop.run_in_executor(None, pdf_analysis_ranges, file_path, os.path.getsize(file_path))
+    remote_ranges = [(start, end) for start, end, local in ranges if not local]
+    cache_key = await loop.run_in_executor(None, _analysis_cache_key, file_path, form_recognizer_client if remote_ranges else None,
+                                           _analysis_cache_model(file_path, model))
+    analysis_cache = AnalysisCache.from_env()
+    if cache_key:
+        result = await loop.run_in_executor(None, analysis_cache.get, cache_key)
+        if result is not None:
+            return result
+    local_ranges = [(start, end) for start, end, local in ranges if local]
+    semaphore = asyncio.Semaphore(PDF_SHARD_CONCURRENCY)
+    if not remote_ranges:
+        local_results = await loop.run_in_executor(None, partial(pdf_text_layer_analyses, file_path, local_ranges, use_layout=use_layout))
+        result = _stitch_analysis_ranges(ranges, local_results, [])
+    elif len(ranges) > 1:
+        remote_results = asyncio.gather(*(_analyze_shard_async(form_recognizer_client, model, file_path, shard_range, semaphore)
+                                          for shard_range in remote_ranges))
+        try:
+            # the text layer is read while the other pages are analyzed
+            local_results = await loop.run_in_executor(None, partial(pdf_text_layer_analyses, file_path, local_ranges, use_layout=use_layout))
+            result = _stitch_analysis_ranges(ranges, local_results, await remote_results)
+        finally:
+            # if reading the text layer failed, the analyses are stopped, and awaited so that their errors are retrieved
+            remote_results.cancel()
+            await asyncio.gather(remote_results, return_exceptions=True)
+    else:
+        with open(file_path, "rb") as f:
+            result = await _analyze_body_async(form_recognizer_client, model, f, semaphore)
+    if cache_key:
+        await loop.run_in_executor(None, analysis_cache.put, cache_key, result)
+    return result
+
+def extract_pdf_content(file_path, form_recognizer_client, use_layout=False, ranges=None):
+    form_recognizer_results = analyze_document(file_path, form_recognizer_client, use_layout=use_layout, ranges=ranges)
+    return pdf_content_from_analysis(file_path, form_recognizer_results, use_layout=use_layout)
+
+def pdf_content_from_analysis(file_path: str, form_recognizer_results: AnalyzeResult, use_layout: bool = False) -> Tuple[str, Dict[str, str]]:
+    """Builds the text of a file analyzed by Document Intelligence, with html tables and headers if use_layout, and the images of its figures.
+    Returns:
+        Tuple[str, Dict[str, str]]: The text, and the base64 image of each image tag in it.
+    """
+    offset = 0
+    page_map = []
 
     # (if using layout) mark all the positions of headers
     roles_start = {}
@@ -609,6 +1981,34 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
             roles_start[para_start] = paragraph.role
             roles_end[para_end] = paragraph.role
 
+    # the html tags to insert before the character at each position, opening tags first
+    header_tags = {}
+    for position, role in roles_start.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = f"<{PDF_HEADERS[role]}>"
+    for position, role in roles_end.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = header_tags.get(position, "") + f"</{PDF_HEADERS[role]}>"
+    header_positions = sorted(header_tags.keys())
+
+    # the image tag of each figure, substituted for its text while the pages are built
+    figure_tags = {}
+    figure_regions = {}
+    if "figures" in form_recognizer_results.keys() and file_path.endswith(".pdf"):
+        for figure in form_recognizer_results["figures"]:
+            replace_start = figure["spans"][0]["offset"]
+            replace_end = figure["spans"][0]["offset"] + figure["spans"][0]["length"]
+
+            # Sometimes the figure doesn't correspond to any text, in which case we skip it
+            if replace_start == replace_end:
+                continue
+
+            img_tag = image_content_to_tag(form_recognizer_results.content[replace_start:replace_end])
+            figure_tags[replace_start] = (replace_end, img_tag)
+            figure_regions[img_tag] = figure.bounding_regions[0]
+    figure_positions = sorted(figure_tags.keys())
+    substituted_tags = set()
+
     for page_num, page in enumerate(form_recognizer_results.pages):
         page_offset = page.spans[0].offset
         page_length = page.spans[0].length
@@ -625,181 +2025,691 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
         else:
             tables_on_page = []
 
-        # (if using layout) mark all positions of the table spans in the page
-        table_chars = [-1]*page_length
-        for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                # replace all table spans with "table_id" in table_chars array
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if idx >=0 and idx < page_length:
-                        table_chars[idx] = table_id
-
-        # build page text by replacing charcters in table spans with table html and replace the characters corresponding to headers with html headers, if using layout
-        page_text = ""
-        added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                position = page_offset + idx
-                if position in roles_start.keys():
-                    role = roles_start[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"<{PDF_HEADERS[role]}>"
-                if position in roles_end.keys():
-                    role = roles_end[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"</{PDF_HEADERS[role]}>"
-
-                page_text += form_recognizer_results.content[page_offset + idx]
-                
-            elif not table_id in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
-                added_tables.add(table_id)
-
+        page_text = _page_text_from_spans(form_recognizer_results.content, page_offset, page_length, tables_on_page, header_tags, header_positions,
+                                          figure_tags, figure_positions, substituted_tags)
         page_text += " "
         page_map.append((page_num, offset, page_text))
         offset += len(page_text)
 
     full_text = "".join([page_text for _, _, page_text in page_map])
 
-    # Extract any images
-    image_mapping = {}
-
-    if "figures" in form_recognizer_results.keys() and file_path.endswith(".pdf"):
-        document = fitz.open(file_path)
+    # Extract the images of the figures in the text
+    image_mapping = render_figures(file_path, [(img_tag, region) for img_tag, region in figure_regions.items() if img_tag in substituted_tags])
 
-        for figure in form_recognizer_results["figures"]:
-            bounding_box = figure.bounding_regions[0]
+    return full_text, image_mapping
 
+def render_figures(file_path: str, figures: List[Tuple[str, Any]], max_pixels: Optional[int] = None, jpeg_quality: Optional[int] = None) -> Dict[str, str]:
+    """Renders the figures of a PDF as base64 jpg images, a page at a time, loading each page once however many figures it has.
+    Figures smaller than 3 inches are upscaled 2x, and no side of an image is larger than max_pixels.
+    Args:
+        file_path (str): Path of the PDF.
+        figures (List[Tuple[str, Any]]): The image tag and bounding region of each figure.
+        max_pixels (int): Largest width or height of an image. Default: FIGURE_MAX_PIXELS, or 2048.
+        jpeg_quality (int): JPEG quality of the images, from 1 to 100. Default: FIGURE_JPEG_QUALITY, or 75.
+    Returns:
+        Dict[str, str]: The base64 image of each image tag.
+    """
+    if not figures:
+        return {}
+    max_pixels = max_pixels or int(os.getenv("FIGURE_MAX_PIXELS", FIGURE_MAX_PIXELS))
+    jpeg_quality = jpeg_quality or int(os.getenv("FIGURE_JPEG_QUALITY", FIGURE_JPEG_QUALITY))
+    # the images are kept in the order of the figures
+    image_mapping = dict.fromkeys(img_tag for img_tag, _ in figures)
+    page = None
+    with fitz.open(file_path) as document:
+        # only the page of the current figures is kept loaded
+        for img_tag, bounding_box in sorted(figures, key=lambda figure: figure[1]['pageNumber']):
             page_number = bounding_box['pageNumber'] - 1  # Page numbers in PyMuPDF start from 0
-            x0, y0, x1, y1 = polygon_to_bbox(bounding_box['polygon'])
-
-            page = document.load_page(page_number)
-            bbox = fitz.Rect(x0, y0, x1, y1)
+            if page is None or page.number != page_number:
+                page = document.load_page(page_number)
+            bbox = fitz.Rect(*polygon_to_bbox(bounding_box['polygon']))
 
             # If either the width or height of the bounding box is less than 3 inches, we upscale by 2x
-            if bbox.width < 72*3 or bbox.height < 72*3:
-                zoom = 2.0
-            else:
-                zoom = 1.0 
-            mat = fitz.Matrix(zoom, zoom)
-            image = page.get_pixmap(matrix=mat, clip=bbox)
+            zoom = 2.0 if bbox.width < 72*3 or bbox.height < 72*3 else 1.0
+            if max(bbox.width, bbox.height) > 0:
+                zoom = min(zoom, max_pixels / max(bbox.width, bbox.height))
+            image = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=bbox)
 
             # Save the extracted image to a base64 string
-            image_data = image.tobytes(output='jpg')
-            image_base64 = base64.b64encode(image_data).decode("utf-8")
-            image_base64 = f"data:image/jpg;base64,{image_base64}"
+            image_base64 = base64.b64encode(image.tobytes(output='jpg', jpg_quality=jpeg_quality)).decode("utf-8")
+            image_mapping[img_tag] = f"data:image/jpg;base64,{image_base64}"
+    return image_mapping
 
-            # Identify the text that corresponds to the figure
-            replace_start = figure["spans"][0]["offset"]
-            replace_end = figure["spans"][0]["offset"] + figure["spans"][0]["length"]
-
-            # Sometimes the figure doesn't correspond to any text, in which case we skip it
-            if replace_start == replace_end:
-                continue
-            
-            # Now we get the image tag
-            original_text = form_recognizer_results.content[replace_start:replace_end]
-
-            if original_text not in full_text:
-                continue
-            
-            img_tag = image_content_to_tag(original_text)
-            
-            # We replace only the first occurrence of the original text
-            full_text = full_text.replace(original_text, img_tag, 1)
-            image_mapping[img_tag] = image_base64
+def mask_urls_and_imgs(text: str) -> Tuple[Dict[str, str], str]:
+    """Replaces urls and images in text with ##URL{n}## and ##IMG{n}## placeholders, in a single pass.
+    Repeated urls and images share a placeholder, numbered in order of first appearance.
+    Args:
+        text (str): The text to mask.
+    Returns:
+        Tuple[Dict[str, str], str]: The original content keyed by placeholder, used by unmask_urls_and_imgs, and the masked text.
+    """
+    placeholders = {}
+    counts = {"URL": 0, "IMG": 0}
+
+    def to_placeholder(match):
+        original = match.group(0)
+        placeholder = placeholders.get(original)
+        if placeholder is None:
+            kind = "IMG" if match.group("img") is not None else "URL"
+            placeholder = f"##{kind}{counts[kind]}##"
+            counts[kind] += 1
+            placeholders[original] = placeholder
+        return placeholder
+
+    masked_text = MASK_PATTERN.sub(to_placeholder, text)
+    content_dict = {placeholder: original for original, placeholder in placeholders.items()}
+    return content_dict, masked_text
+
+def unmask_urls_and_imgs(text: str, content_dict: Dict[str, str]) -> str:
+    """Replaces the ##URL{n}## and ##IMG{n}## placeholders in text with their original content, in a single pass."""
+    if not content_dict or ("##URL" not in text and "##IMG" not in text):
+        return text
+    return MASK_PLACEHOLDER_PATTERN.sub(lambda match: content_dict.get(match.group(0), match.group(0)), text)
 
-    return full_text, image_mapping
+def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}, chunk_sizes: Optional[List[int]]=None) -> Generator[Tuple[str, int], None, None]:
+    """Merges consecutive pieces into chunks of up to num_tokens tokens.
+    Args:
+        chunked_content_list (List[str]): The pieces to merge, possibly containing masked urls and images.
+        num_tokens (int): The maximum number of tokens in a merged chunk.
+        content_dict (Dict[str, str]): The masked urls and images, keyed by placeholder.
+        chunk_sizes (Optional[List[int]]): The token counts of the pieces, if the caller already has them.
+            Only used for pieces without placeholders, since unmasking changes the count.
+    Returns:
+        Generator[Tuple[str, int], None, None]: The merged chunks and their number of tokens.
+    """
+    # token overlap is not applied here, use_token_window splits with real token overlap (see TokenWindowSplitter)
+    unmasked_content_list = [unmask_urls_and_imgs(chunked_content, content_dict) for chunked_content in chunked_content_list]
+    if chunk_sizes is None:
+        chunk_sizes = TOKEN_ESTIMATOR.estimate_tokens_batch(unmasked_content_list)
+    else:
+        changed = [i for i, (masked, unmasked) in enumerate(zip(chunked_content_list, unmasked_content_list)) if masked is not unmasked]
+        chunk_sizes = list(chunk_sizes)
+        for i, chunk_size in zip(changed, TOKEN_ESTIMATOR.estimate_tokens_batch([unmasked_content_list[i] for i in changed])):
+            chunk_sizes[i] = chunk_size
 
-def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
-    def unmask_urls_and_imgs(text, content_dict={}):
-        if "##URL" in text or "##IMG" in text:
-            for key, value in content_dict.items():
-                text = text.replace(key, value)
-        return text
-    # TODO: solve for token overlap
-    current_chunk = ""
+    current_chunk = []
     total_size = 0
-    for chunked_content in chunked_content_list:
-        chunked_content = unmask_urls_and_imgs(chunked_content, content_dict)
-        chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
-        if total_size > 0:
-            new_size = total_size + chunk_size
-            if new_size > num_tokens:
-                yield current_chunk, total_size
-                current_chunk = ""
-                total_size = 0
+    for chunked_content, chunk_size in zip(unmasked_content_list, chunk_sizes):
+        if total_size > 0 and total_size + chunk_size > num_tokens:
+            yield "".join(current_chunk), total_size
+            current_chunk = []
+            total_size = 0
         total_size += chunk_size
-        current_chunk += chunked_content
+        current_chunk.append(chunked_content)
     if total_size > 0:
-        yield current_chunk, total_size
+        yield "".join(current_chunk), total_size
 
 def get_payload_and_headers_cohere(
-    text, aad_token) -> Tuple[Dict, Dict]:
+    texts, aad_token) -> Tuple[Dict, Dict]:
     oai_headers =  {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {aad_token}",
     }
 
-    cohere_body = { "texts": [text], "input_type": "search_document" }
+    cohere_body = { "texts": texts, "input_type": "search_document" }
     return cohere_body, oai_headers
     
-def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+class EmbeddingCache(_SqliteCache):
+    """A persistent cache of embeddings, configured by EMBEDDING_CACHE_PATH and EMBEDDING_CACHE_MAX_MB. Entries are keyed
+    by the hash of the normalized text and of the model, dimensions and provider flags used by get_embedding.
+    """
+    TABLE = "embeddings"
+    VALUE_COLUMN = "vector"
+    ENV_PREFIX = "EMBEDDING_CACHE"
+    DEFAULT_MAX_MB = 1024
+    EVICTION_CHECK_INTERVAL = 256
+    TOUCH_INTERVAL_SECONDS = 3600
+
+    _instance = None
+
+    @staticmethod
+    def key(text: str, embedding_model_endpoint: Optional[str] = None) -> str:
+        """Returns the cache key of the embedding that get_embedding would return for text."""
+        endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
+        provider = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
+        if provider == "AOAI":
+            # the api version does not change the embeddings of a deployment
+            model = endpoint.split("?")[0]
+            flag = os.getenv("FLAG_AOAI", "V3")
+            dimensions = int(os.getenv("VECTOR_DIMENSION", 1536)) if flag == "V3" else None
+        else:
+            model = endpoint
+            flag = os.getenv("FLAG_COHERE", "ENGLISH")
+            dimensions = None
+        text_hash = hashlib.sha256(unicodedata.normalize("NFC", text).encode("utf-8")).hexdigest()
+        return hashlib.sha256(json.dumps([text_hash, model, dimensions, provider, flag]).encode("utf-8")).hexdigest()
+
+    def _encode(self, vector: List[float]) -> bytes:
+        return array("d", vector).tobytes()
+
+    def _decode(self, data: bytes) -> List[float]:
+        return array("d", data).tolist()
+
+class _CachedTokenProvider:
+    """Returns an AAD token for a scope, getting a new one from the credential only shortly before the cached one expires."""
+    REFRESH_MARGIN_SECONDS = 300
+
+    def __init__(self, credential, scope: str) -> None:
+        self._credential = credential
+        self._scope = scope
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __call__(self) -> str:
+        with self._lock:
+            if self._token is None or self._token.expires_on - time.time() < self.REFRESH_MARGIN_SECONDS:
+                self._token = self._credential.get_token(self._scope)
+            return self._token.token
+
+class EmbeddingClientPool:
+    """A per-process registry of embedding and captioning clients, so that every request of a process reuses the same
+    HTTP connections and AAD token instead of building a client per call.
+
+    AOAI clients are keyed by endpoint, deployment, api version and credential. Cohere and captioning endpoints get a
+    requests.Session each, which keeps their connections alive. The async clients of an AsyncEmbeddingEngine are kept
+    per event loop as well, since their connections belong to the loop that opened them.
+    """
+    AAD_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+    _pid = None
+    _aoai_clients = {}
+    _async_aoai_clients = {}
+    _sessions = {}
+    _async_sessions = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _reset_if_forked(cls) -> None:
+        # clients and their connections must not be shared with forked worker processes
+        if cls._pid != os.getpid():
+            cls._pid = os.getpid()
+            cls._aoai_clients = {}
+            cls._async_aoai_clients = {}
+            cls._sessions = {}
+            cls._async_sessions = {}
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def parse_aoai_endpoint(endpoint: str) -> Tuple[str, str, str]:
+        """Returns the base url, deployment and api version of an AOAI embeddings endpoint."""
+        endpoint_parts = endpoint.split("/openai/deployments/")
+        base_url = endpoint_parts[0]
+        deployment_id = endpoint_parts[1].split("/embeddings")[0]
+        api_version = endpoint_parts[1].split("api-version=")[1].split("&")[0]
+        return base_url, deployment_id, api_version
+
+    @staticmethod
+    def _auth(api_key: Optional[str], azure_credential) -> Tuple[str, Any]:
+        if azure_credential is not None:
+            return ("aad", id(azure_credential))
+        return ("key", hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+
+    @classmethod
+    def aoai_client(cls, endpoint: str, api_key: Optional[str] = None, azure_credential = None) -> Tuple[AzureOpenAI, str]:
+        """Returns the client for an AOAI embeddings endpoint and its deployment."""
+        base_url, deployment_id, api_version = cls.parse_aoai_endpoint(endpoint)
+        with cls._lock:
+            cls._reset_if_forked()
+            key = (base_url, deployment_id, api_version, cls._auth(api_key, azure_credential))
+            if key not in cls._aoai_clients:
+                if azure_credential is not None:
+                    client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url,
+                                         azure_ad_token_provider=_CachedTokenProvider(azure_credential, cls.AAD_SCOPE))
+                else:
+                    client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
+                cls._aoai_clients[key] = client
+            return cls._aoai_clients[key], deployment_id
+
+    @classmethod
+    def async_aoai_client(cls, endpoint: str, api_key: Optional[str] = None, azure_credential = None) -> Tuple[AsyncAzureOpenAI, str]:
+        """Returns the async client of the running event loop for an AOAI embeddings endpoint and its deployment.
+        The client does not retry, since the AsyncEmbeddingEngine does its own retries."""
+        base_url, deployment_id, api_version = cls.parse_aoai_endpoint(endpoint)
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            cls._reset_if_forked()
+            key = (base_url, deployment_id, api_version, cls._auth(api_key, azure_credential), loop)
+            if key not in cls._async_aoai_clients:
+                if azure_credential is not None:
+                    client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=base_url, max_retries=0,
+                                              azure_ad_token_provider=_CachedTokenProvider(azure_credential, cls.AAD_SCOPE))
+                else:
+                    client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=base_url, max_retries=0, api_key=api_key)
+                cls._async_aoai_clients[key] = client
+            return cls._async_aoai_clients[key], deployment_id
+
+    @classmethod
+    def session(cls, endpoint: str) -> requests.Session:
+        """Returns the keep-alive session for an endpoint."""
+        with cls._lock:
+            cls._reset_if_forked()
+            if endpoint not in cls._sessions:
+                cls._sessions[endpoint] = requests.Session()
+            return cls._sessions[endpoint]
+
+    @classmethod
+    def async_session(cls, endpoint: str) -> httpx.AsyncClient:
+        """Returns the keep-alive async client of the running event loop for an endpoint."""
+        key = (endpoint, asyncio.get_running_loop())
+        with cls._lock:
+            cls._reset_if_forked()
+            if key not in cls._async_sessions:
+                cls._async_sessions[key] = httpx.AsyncClient(timeout=60)
+            return cls._async_sessions[key]
+
+def _embedding_key(endpoint: Optional[str], embedding_model_key=None, azure_credential=None) -> Optional[str]:
+    """Returns the key for the embedding provider in FLAG_EMBEDDING_MODEL, checking that the endpoint can be authenticated against."""
+    if os.getenv("FLAG_EMBEDDING_MODEL", "AOAI") == "COHERE":
+        if os.getenv("FLAG_COHERE", "ENGLISH") == "MULTILINGUAL":
+            key = embedding_model_key if embedding_model_key else os.getenv("COHERE_MULTILINGUAL_API_KEY")
+        else:
+            key = embedding_model_key if embedding_model_key else os.getenv("COHERE_ENGLISH_API_KEY")
+        if endpoint is None or key is None:
+            raise Exception("EMBEDDING_MODEL_ENDPOINT and a Cohere API key are required for embedding")
+    else:
+        key = embedding_model_key if embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
+        if endpoint is None or (azure_credential is None and key is None):
+            raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
+    return key
+
+def _request_embeddings(texts: List[str], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None) -> List[List[float]]:
     endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
     
     FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
-    FLAG_COHERE = os.getenv("FLAG_COHERE", "ENGLISH")
     FLAG_AOAI = os.getenv("FLAG_AOAI", "V3")
 
-    if azure_credential is None and (endpoint is None or key is None):
-        raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
+    key = _embedding_key(endpoint, embedding_model_key, azure_credential)
 
     try:
         if FLAG_EMBEDDING_MODEL == "AOAI":
-            endpoint_parts = endpoint.split("/openai/deployments/")
-            base_url = endpoint_parts[0]
-            deployment_id = endpoint_parts[1].split("/embeddings")[0]
-            api_version = endpoint_parts[1].split("api-version=")[1].split("&")[0]
-            if azure_credential is not None:
-                api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
-            else:
-                api_key = embedding_model_key if embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
-            
-            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
+            client, deployment_id = EmbeddingClientPool.aoai_client(endpoint, api_key=key, azure_credential=azure_credential)
             if FLAG_AOAI == "V2":
-                embeddings = client.embeddings.create(model=deployment_id, input=text)
+                embeddings = client.embeddings.create(model=deployment_id, input=texts)
             elif FLAG_AOAI == "V3":   
                 embeddings = client.embeddings.create(model=deployment_id, 
-                                                      input=text, 
+                                                      input=texts, 
                                                       dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)))
             
-            return embeddings.model_dump()['data'][0]['embedding']
+            # the embeddings are returned with the index of their input
+            data = sorted(embeddings.model_dump()['data'], key=lambda item: item['index'])
+            return [item['embedding'] for item in data]
         
         if FLAG_EMBEDDING_MODEL == "COHERE":
-            if FLAG_COHERE == "MULTILINGUAL":
-                key = embedding_model_key if embedding_model_key else os.getenv("COHERE_MULTILINGUAL_API_KEY")
-            elif FLAG_COHERE == "ENGLISH":
-                key = embedding_model_key if embedding_model_key else os.getenv("COHERE_ENGLISH_API_KEY")
-            data, headers = get_payload_and_headers_cohere(text, key)
-
-            body = str.encode(json.dumps(data))
-            req = urllib.request.Request(endpoint, body, headers)
-            response = urllib.request.urlopen(req)
-            result = response.read()
-            result_content = json.loads(result.decode('utf-8'))
+            data, headers = get_payload_and_headers_cohere(texts, key)
+
+            response = EmbeddingClientPool.session(endpoint).post(endpoint, json=data, headers=headers)
+            response.raise_for_status()
+            result_content = response.json()
                         
-            return result_content["embeddings"][0]   
+            return result_content["embeddings"]
         
 
     except Exception as e:
         raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
 
+def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+    return _request_embeddings([text], embedding_model_endpoint, embedding_model_key, azure_credential)[0]
+
+def pack_embedding_batches(texts: List[str], max_items: int, max_tokens: Optional[int] = None, sizes: Optional[List[int]] = None) -> List[List[int]]:
+    """Packs texts into batches for the embedding endpoint, in order.
+    Args:
+        texts (List[str]): The texts to embed.
+        max_items (int): The maximum number of texts in a batch.
+        max_tokens (int): The maximum number of tokens in a batch, if the provider has one. A longer text gets a batch of its own.
+        sizes (List[int]): The number of tokens of each text, if already known.
+    Returns:
+        List[List[int]]: The indices of the texts in each batch.
+    """
+    if sizes is None:
+        sizes = TOKEN_ESTIMATOR.estimate_tokens_batch(texts) if max_tokens else [0] * len(texts)
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, size in enumerate(sizes):
+        if batch and (len(batch) == max_items or (max_tokens and batch_tokens + size > max_tokens)):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def backoff_delay(attempt: int, headers=None, base_delay: float = 1.0, max_delay: float = 60.0) -> float:
+    """Returns the time to wait before retrying a request that failed attempt + 1 times: the wait asked for by the
+    headers of the response, if any, or an exponential backoff from base_delay up to max_delay with full jitter."""
+    delay = retry_delay_from_headers(headers)
+    if delay is not None:
+        # a little jitter keeps the workers that were told the same time from retrying together
+        return delay + random.uniform(0, min(1.0, 0.1 * delay))
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def retry_delay_from_headers(headers) -> Optional[float]:
+    """Returns how long a rate limited endpoint asks to wait before the next request, in seconds.
+    Reads retry-after-ms, Retry-After (seconds or an HTTP date) and the x-ratelimit-reset-requests and
+    x-ratelimit-reset-tokens durations (e.g. "1s", "6m0s", "250ms"), and returns the longest, or None if there is none.
+    """
+    if not headers:
+        return None
+    delays = []
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            delays.append(float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            delays.append(float(value))
+        except ValueError:
+            try:
+                delays.append(parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(name)
+        if value:
+            parts = RATE_LIMIT_RESET_PATTERN.findall(value.strip())
+            if parts and "".join(number + unit for number, unit in parts) == value.strip():
+                delays.append(sum(float(number) * DURATION_UNITS[unit] for number, unit in parts))
+    delays = [delay for delay in delays if delay >= 0]
+    return max(delays) if delays else None
+
+def latency_percentiles(latencies: List[float], percentiles=(50, 90, 99)) -> Dict[str, float]:
+    """Returns the nearest-rank percentiles of a list of latencies, keyed p50, p90, ..."""
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    return {f"p{p}": ordered[max(0, -(-p * len(ordered) // 100) - 1)] for p in percentiles}
+
+class RateLimiter:
+    """Token buckets of the requests and tokens per minute of an endpoint, shared by all the processes of a run.
+
+    The buckets live in shared memory and hold up to BURST_SECONDS of quota. Each request reserves its
+    tokens up front, which can take a bucket below zero, and then waits until the bucket has refilled, so
+    requests are served in order at the quota instead of bursting into it and being throttled. When the
+    endpoint throttles anyway, pause() holds back the requests of every process. A limit of None is not enforced.
+
+    Limiters are registered by name in the parent process with configure() and handed to the worker
+    processes by the initializer of their ProcessPoolExecutor, see install().
+    """
+    BURST_SECONDS = 10
+
+    _limiters = {}
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # requests and tokens in the buckets, time they were last refilled, time before which no request may be sent
+        self._state = multiprocessing.RawArray("d", [self._capacity(requests_per_minute), self._capacity(tokens_per_minute), time.monotonic(), 0])
+        self._lock = multiprocessing.Lock()
+
+    @classmethod
+    def _capacity(cls, per_minute: Optional[float]) -> float:
+        return per_minute * cls.BURST_SECONDS / 60 if per_minute else 0
+
+    @classmethod
+    def configure(cls, name: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None) -> Optional["RateLimiter"]:
+        """Registers the limiter of an endpoint, e.g. "embedding" or "captioning", or removes it if it has no limits."""
+        if not requests_per_minute and not tokens_per_minute:
+            cls._limiters.pop(name, None)
+            return None
+        cls._limiters[name] = cls(requests_per_minute, tokens_per_minute)
+        return cls._limiters[name]
+
+    @classmethod
+    def get(cls, name: str) -> Optional["RateLimiter"]:
+        return cls._limiters.get(name)
+
+    @classmethod
+    def limiters(cls) -> Dict[str, "RateLimiter"]:
+        return dict(cls._limiters)
+
+    @classmethod
+    def install(cls, limiters: Dict[str, "RateLimiter"]) -> None:
+        """Initializer of worker processes, which makes them share the limiters of the parent process."""
+        cls._limiters = dict(limiters)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserves a request of the given number of tokens and returns how long to wait before sending it, in seconds."""
+        with self._lock:
+            state = self._state
+            now = time.monotonic()
+            elapsed = now - state[2]
+            state[2] = now
+            wait = max(0.0, state[3] - now)
+            for i, per_minute, amount in ((0, self.requests_per_minute, 1), (1, self.tokens_per_minute, tokens)):
+                if per_minute:
+                    state[i] = min(self._capacity(per_minute), state[i] + elapsed * per_minute / 60) - amount
+                    if state[i] < 0:
+                        wait = max(wait, -state[i] * 60 / per_minute)
+            return wait
+
+    def acquire(self, tokens: int = 0) -> None:
+        time.sleep(self.reserve(tokens))
+
+    async def acquire_async(self, tokens: int = 0) -> None:
+        await asyncio.sleep(self.reserve(tokens))
+
+    def pause(self, seconds: float) -> None:
+        """Holds back the requests of every process for the given time, e.g. after the endpoint asked to retry later."""
+        with self._lock:
+            self._state[3] = max(self._state[3], time.monotonic() + seconds)
+
+class AsyncEmbeddingEngine:
+    """Embeds texts with up to max_concurrency requests in flight, on an event loop owned by the engine.
+
+    Requests that are rate limited (429), time out or fail on the server are retried up to max_retries times.
+    The engine waits as long as the Retry-After and x-ratelimit-reset-* headers ask, or else backs off
+    exponentially from base_delay up to max_delay, with full jitter so that parallel workers spread out.
+    Other errors are not retried. The latencies of the last MAX_LATENCIES requests are kept in latencies, and
+    num_requests counts every request, so that callers can get the latencies of their own calls with latencies_since.
+
+    Engines are shared per process by get(), and get their clients from the EmbeddingClientPool, so that clients and
+    connections are reused across files.
+    """
+    # number of latencies kept for the percentiles of a run, so that a long-lived engine does not grow without bound
+    MAX_LATENCIES = 100000
+
+    _pid = None
+    _engines = {}
+    _lock = threading.Lock()
+
+    def __init__(self, embedding_model_endpoint: str, embedding_model_key: Optional[str] = None, azure_credential = None,
+                 max_concurrency: int = 8, max_retries: int = RETRY_COUNT, base_delay: float = 1.0, max_delay: float = 60.0) -> None:
+        self.endpoint = embedding_model_endpoint
+        self.key = embedding_model_key
+        self.azure_credential = azure_credential
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latencies = deque(maxlen=self.MAX_LATENCIES)
+        self.num_requests = 0
+        self._loop = asyncio.new_event_loop()
+
+    @classmethod
+    def get(cls, embedding_model_endpoint: str, embedding_model_key: Optional[str] = None, azure_credential = None) -> "AsyncEmbeddingEngine":
+        """Returns the engine of this process for an endpoint, with EMBEDDING_MAX_CONCURRENCY requests in flight (default 8)."""
+        max_concurrency = max(1, int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8)))
+        auth = EmbeddingClientPool._auth(embedding_model_key, azure_credential)
+        with cls._lock:
+            # the event loop and its connections must not be shared with forked worker processes
+            if cls._pid != os.getpid():
+                cls._pid = os.getpid()
+                cls._engines = {}
+            key = (embedding_model_endpoint, os.getenv("FLAG_EMBEDDING_MODEL", "AOAI"), auth, max_concurrency)
+            if key not in cls._engines:
+                cls._engines[key] = cls(embedding_model_endpoint, embedding_model_key, azure_credential, max_concurrency=max_concurrency)
+            return cls._engines[key]
+
+    def embed(self, texts: List[str], token_counts: Optional[List[int]] = None, ignore_errors: bool = False) -> List[Optional[List[float]]]:
+        """Embeds texts, packed into requests within the provider limits in EMBEDDING_BATCH_LIMITS, and returns the embeddings in order.
+        The number of tokens of each text, if already known, saves estimating it for the batches and the "embedding" RateLimiter.
+        With ignore_errors, the texts of a request that fails for good get None instead of raising, and a request rejected
+        by the endpoint is split in halves, so that one bad text does not cost the embeddings of the others.
+        """
+        return self._loop.run_until_complete(self.embed_async(texts, token_counts, ignore_errors))
+
+    async def embed_async(self, texts: List[str], token_counts: Optional[List[int]] = None, ignore_errors: bool = False) -> List[Optional[List[float]]]:
+        max_items, max_tokens = EMBEDDING_BATCH_LIMITS.get(os.getenv("FLAG_EMBEDDING_MODEL", "AOAI"), (1, None))
+        limiter = RateLimiter.get("embedding")
+        if token_counts is None and (max_tokens or (limiter and limiter.tokens_per_minute)):
+            token_counts = TOKEN_ESTIMATOR.estimate_tokens_batch(texts)
+        batches = pack_embedding_batches(texts, max_items, max_tokens, token_counts)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*(self._embed_texts([texts[index] for index in batch], semaphore, limiter,
+                                                           [token_counts[index] for index in batch] if token_counts else None, ignore_errors)
+                                         for batch in batches),
+                                       return_exceptions=True)
+        embeddings = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, results):
+            if isinstance(batch_embeddings, BaseException):
+                raise batch_embeddings
+            if len(batch_embeddings) != len(batch):
+                raise Exception(f"Error getting embeddings for {len(batch)} chunks: got {len(batch_embeddings)} embeddings")
+            for index, embedding in zip(batch, batch_embeddings):
+                embeddings[index] = embedding
+        return embeddings
+
+    async def _embed_texts(self, texts: List[str], semaphore: asyncio.Semaphore, limiter: Optional[RateLimiter], token_counts: Optional[List[int]],
+                           ignore_errors: bool) -> List[Optional[List[float]]]:
+        try:
+            return await self._embed_batch(texts, semaphore, limiter, sum(token_counts) if token_counts else 0)
+        except EmbeddingRequestError as e:
+            if not ignore_errors:
+                raise
+            status_code = e.status_code
+            if len(texts) > 1 and status_code is not None and status_code < 500 and status_code not in RETRYABLE_STATUS_CODES:
+                # the endpoint rejects a whole request for one bad text, so the halves are sent apart to find it
+                middle = len(texts) // 2
+                first, second = await asyncio.gather(
+                    self._embed_texts(texts[:middle], semaphore, limiter, token_counts[:middle] if token_counts else None, ignore_errors),
+                    self._embed_texts(texts[middle:], semaphore, limiter, token_counts[middle:] if token_counts else None, ignore_errors))
+                return first + second
+            print(f"Skipping the embeddings of {len(texts)} chunks with error={e}")
+            return [None] * len(texts)
+
+    def latencies_since(self, num_requests: int) -> List[float]:
+        """Returns the latencies of the requests sent since num_requests was read, at most the last MAX_LATENCIES of them."""
+        num_latencies = min(self.num_requests - num_requests, len(self.latencies))
+        return list(self.latencies)[len(self.latencies) - num_latencies:]
+
+    def retry_delay(self, attempt: int, headers=None) -> float:
+        """Returns the time to wait before retrying a request that failed attempt + 1 times."""
+        return backoff_delay(attempt, headers, self.base_delay, self.max_delay)
+
+    async def _embed_batch(self, texts: List[str], semaphore: asyncio.Semaphore, limiter: Optional[RateLimiter] = None, num_tokens: int = 0) -> List[List[float]]:
+        for attempt in range(self.max_retries):
+            if limiter:
+                await limiter.acquire_async(num_tokens)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    return await self._request(texts)
+                except Exception as e:
+                    error = e
+                finally:
+                    self.latencies.append(time.perf_counter() - start)
+                    self.num_requests += 1
+            # the slot is released while waiting, so that other batches keep the endpoint busy
+            response = getattr(error, "response", None)
+            status_code = getattr(response, "status_code", None)
+            if status_code is not None and status_code not in RETRYABLE_STATUS_CODES and status_code < 500:
+                break
+            if attempt + 1 < self.max_retries:
+                delay = self.retry_delay(attempt, getattr(response, "headers", None))
+                if limiter and status_code == 429:
+                    # the other requests of every process would be throttled as well
+                    limiter.pause(delay)
+                print(f"Error getting embeddings for {len(texts)} chunks with error={error}, retrying in {delay:.1f}s, "
+                      f"current at {attempt + 1} retry, {self.max_retries - (attempt + 1)} retries left")
+                await asyncio.sleep(delay)
+        raise EmbeddingRequestError(f"Error getting embeddings for {len(texts)} chunks with endpoint={self.endpoint} with error={error}", status_code)
+
+    async def _request(self, texts: List[str]) -> List[List[float]]:
+        if os.getenv("FLAG_EMBEDDING_MODEL", "AOAI") == "COHERE":
+            data, headers = get_payload_and_headers_cohere(texts, self.key)
+            response = await EmbeddingClientPool.async_session(self.endpoint).post(self.endpoint, json=data, headers=headers)
+            response.raise_for_status()
+            return response.json()["embeddings"]
+
+        client, deployment_id = EmbeddingClientPool.async_aoai_client(self.endpoint, api_key=self.key, azure_credential=self.azure_credential)
+        if os.getenv("FLAG_AOAI", "V3") == "V2":
+            embeddings = await client.embeddings.create(model=deployment_id, input=texts)
+        else:
+            embeddings = await client.embeddings.create(model=deployment_id, input=texts,
+                                                        dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)))
+        # the embeddings are returned with the index of their input
+        data = sorted(embeddings.model_dump()['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+
+def get_embedding_engine(embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None) -> AsyncEmbeddingEngine:
+    """Returns the AsyncEmbeddingEngine of this process for an endpoint, defaulting to EMBEDDING_MODEL_ENDPOINT and the provider key."""
+    endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
+    key = _embedding_key(endpoint, embedding_model_key, azure_credential)
+    return AsyncEmbeddingEngine.get(endpoint, key, azure_credential)
+
+def get_embeddings(texts: List[str], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None, token_counts: Optional[List[int]] = None,
+                   ignore_errors: bool = False) -> List[Optional[List[float]]]:
+    """Embeds a list of texts with as few requests as the provider limits in EMBEDDING_BATCH_LIMITS allow,
+    sending up to EMBEDDING_MAX_CONCURRENCY requests at a time through the AsyncEmbeddingEngine of the process.
+    Args:
+        texts (List[str]): The texts to embed.
+        embedding_model_endpoint (str): The embedding endpoint. Defaults to EMBEDDING_MODEL_ENDPOINT.
+        embedding_model_key (str): The key of the embedding endpoint, if azure_credential is not used.
+        azure_credential: Optional credential to get an AAD token for the embedding endpoint.
+        token_counts (List[int]): The number of tokens of each text, if already known.
+        ignore_errors (bool): If true, the texts whose requests fail for good get None instead of raising, see AsyncEmbeddingEngine.embed.
+    Returns:
+        List[List[float]]: The embeddings, in the order of texts.
+    """
+    return get_embedding_engine(embedding_model_endpoint, embedding_model_key, azure_credential).embed(texts, token_counts, ignore_errors)
+
+def get_embeddings_with_cache(texts: List[str], embedding_cache: Optional[EmbeddingCache], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None, token_counts: Optional[List[int]] = None,
+                              ignore_errors: bool = False) -> List[Optional[List[float]]]:
+    """Embeds texts like get_embeddings, looking each distinct text up in the embedding cache first and caching the new embeddings.
+    Args:
+        texts (List[str]): The texts to embed.
+        embedding_cache (EmbeddingCache): The cache to use, or None to embed every distinct text.
+        token_counts (List[int]): The number of tokens of each text, if already known.
+        ignore_errors (bool): If true, the texts that could not be embedded get None instead of raising.
+    Returns:
+        List[List[float]]: The embeddings, in the order of texts.
+    """
+    embeddings_by_text = {}
+    token_counts_by_text = {}
+    cache_keys = {}
+    for i, text in enumerate(texts):
+        if text in embeddings_by_text:
+            continue
+        embeddings_by_text[text] = None
+        if token_counts is not None:
+            token_counts_by_text[text] = token_counts[i]
+        if embedding_cache:
+            cache_keys[text] = EmbeddingCache.key(text, embedding_model_endpoint)
+            embeddings_by_text[text] = embedding_cache.get(cache_keys[text])
+
+    missing_texts = [text for text, embedding in embeddings_by_text.items() if embedding is None]
+    if missing_texts:
+        embeddings = get_embeddings(missing_texts, embedding_model_endpoint=embedding_model_endpoint,
+                                    embedding_model_key=embedding_model_key, azure_credential=azure_credential,
+                                    token_counts=[token_counts_by_text[text] for text in missing_texts] if token_counts is not None else None,
+                                    ignore_errors=ignore_errors)
+        for text, embedding in zip(missing_texts, embeddings):
+            embeddings_by_text[text] = embedding
+            if embedding_cache and embedding is not None:
+                embedding_cache.put(cache_keys[text], embedding)
+    return [embeddings_by_text[text] for text in texts]
+
 
 def chunk_content_helper(
         content: str, file_format: str, file_name: Optional[str],
         token_overlap: int,
-        num_tokens: int = 256
+        num_tokens: int = 256,
+        use_token_window: bool = False
 ) -> Generator[Tuple[str, int, Document], None, None]:
     if num_tokens is None:
         num_tokens = 1000000000
@@ -811,29 +2721,37 @@ def chunk_content_helper(
     if doc_content_size < num_tokens or file_format in ["png", "jpg", "jpeg", "gif", "webp"]:
         yield doc.content, doc_content_size, doc
     else:
-        if file_format == "markdown":
-            splitter = MarkdownTextSplitter.from_tiktoken_encoder(
-                chunk_size=num_tokens, chunk_overlap=token_overlap)
+        if use_token_window and file_format in TOKEN_WINDOW_FORMATS:
+            splitter = TokenWindowSplitter(chunk_size=num_tokens, chunk_overlap=token_overlap, **TOKEN_WINDOW_FORMATS[file_format])
+            if file_format == "markdown":
+                for chunked_content, chunk_size in splitter.split_text_with_sizes(content): # chunk the original content
+                    chunk_doc = Document(content=parser.parse_chunk(chunked_content), title=doc.title)
+                    yield chunk_doc.content, chunk_size, chunk_doc
+            else:
+                for chunked_content, chunk_size in splitter.split_text_with_sizes(doc.content):
+                    yield chunked_content, chunk_size, doc
+        elif file_format == "markdown":
+            splitter = MarkdownTextSplitter(
+                chunk_size=num_tokens, chunk_overlap=token_overlap, length_function=TOKEN_ESTIMATOR.estimate_tokens)
             chunked_content_list = splitter.split_text(
                 content)  # chunk the original content
             for chunked_content, chunk_size in merge_chunks_serially(chunked_content_list, num_tokens):
-                chunk_doc = parser.parse(chunked_content, file_name=file_name)
-                chunk_doc.title = doc.title
+                chunk_doc = Document(content=parser.parse_chunk(chunked_content), title=doc.title)
                 yield chunk_doc.content, chunk_size, chunk_doc
         else:
             if file_format == "python":
-                splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
-                    chunk_size=num_tokens, chunk_overlap=token_overlap)
+                splitter = PythonCodeTextSplitter(
+                    chunk_size=num_tokens, chunk_overlap=token_overlap, length_function=TOKEN_ESTIMATOR.estimate_tokens)
             else:
                 if file_format == "html_pdf": # cracked pdf converted to html
                     splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
                 else:
-                    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                    splitter = RecursiveCharacterTextSplitter(
                             separators=SENTENCE_ENDINGS + WORDS_BREAKS,
-                            chunk_size=num_tokens, chunk_overlap=token_overlap)
+                            chunk_size=num_tokens, chunk_overlap=token_overlap, length_function=TOKEN_ESTIMATOR.estimate_tokens)
             chunked_content_list = splitter.split_text(doc.content)
-            for chunked_content in chunked_content_list:
-                chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
+            chunk_sizes = TOKEN_ESTIMATOR.estimate_tokens_batch(chunked_content_list)
+            for chunked_content, chunk_size in zip(chunked_content_list, chunk_sizes):
                 yield chunked_content, chunk_size, doc
 
 def chunk_content(
@@ -850,7 +2768,8 @@ def chunk_content(
     add_embeddings = False,
     azure_credential = None,
     embedding_endpoint = None,
-    image_mapping = {}
+    image_mapping = {},
+    use_token_window = False
 ) -> ChunkingResult:
     """Chunks the given content. If ignore_errors is true, returns None
         in case of an error
@@ -862,6 +2781,7 @@ def chunk_content(
         num_tokens (int): The number of tokens in each chunk.
         min_chunk_size (int): The minimum chunk size below which chunks will be filtered.
         token_overlap (int): The number of tokens to overlap between chunks.
+        use_token_window (bool): If true, splits text, markdown and cracked pdfs into token windows with real token overlap.
     Returns:
         List[Document]: List of chunked documents.
     """
@@ -882,40 +2802,47 @@ def chunk_content(
             file_name=file_name,
             file_format=file_format,
             num_tokens=num_tokens,
-            token_overlap=token_overlap
+            token_overlap=token_overlap,
+            use_token_window=use_token_window
         )
         chunks = []
         skipped_chunks = 0
+        embedding_cache = EmbeddingCache.from_env() if add_embeddings else None
+        cache_hits, cache_misses = (embedding_cache.hits, embedding_cache.misses) if embedding_cache else (0, 0)
+        kept_chunks = []
         for chunk, chunk_size, doc in chunked_context:
             if chunk_size >= min_chunk_size:
-                if add_embeddings:
-                    for i in range(RETRY_COUNT):
-                        try:
-                            doc.contentVector = get_embedding(chunk, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint)
-                            break
-                        except Exception as e:
-                            print(f"Error getting embedding for chunk with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-                            time.sleep(30)
-                    if doc.contentVector is None:
-                        raise Exception(f"Error getting embedding for chunk={chunk}")
-                    
-                doc.image_mapping = {}
-                for key, value in image_mapping.items():
-                    if key in chunk:
-                        doc.image_mapping[key] = value
-                chunks.append(
-                    Document(
-                        content=chunk,
-                        title=doc.title,
-                        url=url,
-                        contentVector=doc.contentVector,
-                        metadata=doc.metadata,
-                        image_mapping=doc.image_mapping
-                    )
-                )
+                kept_chunks.append((chunk, chunk_size, doc))
             else:
                 skipped_chunks += 1
 
+        # the helper can yield the same doc for several chunks, so the embeddings are kept apart from it
+        embeddings = [None] * len(kept_chunks)
+        embedding_latencies = []
+        if add_embeddings and kept_chunks:
+            engine = get_embedding_engine(embedding_endpoint, azure_credential=azure_credential)
+            num_requests = engine.num_requests
+            embeddings = get_embeddings_with_cache([chunk for chunk, _, _ in kept_chunks], embedding_cache,
+                                                   embedding_model_endpoint=embedding_endpoint, azure_credential=azure_credential,
+                                                   token_counts=[chunk_size for _, chunk_size, _ in kept_chunks])
+            embedding_latencies = engine.latencies_since(num_requests)
+
+        for (chunk, _, doc), embedding in zip(kept_chunks, embeddings):
+            doc.image_mapping = {}
+            for key, value in image_mapping.items():
+                if key in chunk:
+                    doc.image_mapping[key] = value
+            chunks.append(
+                Document(
+                    content=chunk,
+                    title=doc.title,
+                    url=url,
+                    contentVector=embedding,
+                    metadata=doc.metadata,
+                    image_mapping=doc.image_mapping
+                )
+            )
+
     except UnsupportedFormatError as e:
         if ignore_errors:
             return ChunkingResult(
@@ -932,6 +2859,10 @@ def chunk_content(
         chunks=chunks,
         total_files=1,
         skipped_chunks=skipped_chunks,
+        embedding_cache_hits=embedding_cache.hits - cache_hits if embedding_cache else 0,
+        embedding_cache_misses=embedding_cache.misses - cache_misses if embedding_cache else 0,
+        embedding_latencies=embedding_latencies,
+        chunk_sizes=[chunk_size for _, chunk_size, _ in kept_chunks],
     )
 
 def image_content_to_tag(image_content: str) -> str:
@@ -941,9 +2872,51 @@ def image_content_to_tag(image_content: str) -> str:
     img_tag = f'<img src="IMG_{random_id}.jpg">{image_content.replace("<img>", "&lt;img&gt;").replace("</img>", "&lt;/img&gt;")}</img>'
     return img_tag
 
+def downscale_image(image_bytes: bytes, file_ext: str, max_pixels: int = CAPTION_MAX_PIXELS, max_short_side: int = CAPTION_MAX_SHORT_SIDE) -> Tuple[bytes, str]:
+    """Scales an image down to the resolution the vision model works at: within max_pixels on both sides, and at most max_short_side
+    on its shorter side. Returns the scaled image as a jpeg, or the image and its format if it is small enough or cannot be read.
+    """
+    try:
+        pixmap = fitz.Pixmap(image_bytes)
+    except Exception:
+        return image_bytes, file_ext
+    scale = min(1.0, max_pixels / max(pixmap.width, pixmap.height), max_short_side / min(pixmap.width, pixmap.height))
+    if scale >= 1.0:
+        return image_bytes, file_ext
+    if pixmap.alpha:
+        pixmap = fitz.Pixmap(pixmap, 0)
+    if pixmap.colorspace and pixmap.colorspace.n not in (1, 3):
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    scaled = fitz.Pixmap(pixmap, max(1, round(pixmap.width * scale)), max(1, round(pixmap.height * scale)), None)
+    return scaled.tobytes(output="jpg", jpg_quality=CAPTION_JPEG_QUALITY), "jpeg"
+
 def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
-    encoded_image = base64.b64encode(open(image_path, 'rb').read()).decode('ascii')
+    """Captions an image with a vision model, and returns its image tag and the mapping of the tag to the image.
+    The image is scaled down with downscale_image first. Captions are looked up in and added to the CaptionCache, if
+    CAPTION_CACHE_PATH is set. Failed requests are retried with backoff_delay, and rate limited ones also pause the
+    captioning RateLimiter of every process.
+    """
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
     file_ext = image_path.split(".")[-1]
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    image_bytes, file_ext = downscale_image(image_bytes, file_ext)
+    encoded_image = base64.b64encode(image_bytes).decode('ascii')
+
+    caption_cache = CaptionCache.from_env()
+    cache_key = CaptionCache.key(image_hash, CAPTION_SYSTEM_PROMPT + CAPTION_USER_PROMPT, captioning_model_endpoint) if caption_cache else None
+    caption = caption_cache.get(cache_key) if caption_cache else None
+    if caption is None:
+        caption = _request_caption(encoded_image, file_ext, captioning_model_endpoint, captioning_model_key)
+        if caption_cache:
+            caption_cache.put(cache_key, caption)
+
+    img_tag = image_content_to_tag(caption)
+    mapping = {img_tag: f"data:image/{file_ext};base64,{encoded_image}"}
+
+    return img_tag, mapping
+
+def _request_caption(encoded_image: str, file_ext: str, captioning_model_endpoint: str, captioning_model_key: str) -> str:
     headers = {
         "Content-Type": "application/json",
         "api-key": captioning_model_key,
@@ -956,7 +2929,7 @@ def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
             "content": [
                 {
                 "type": "text",
-                "text": "You are a captioning model that helps uses find descriptive captions."
+                "text": CAPTION_SYSTEM_PROMPT
                 }
             ]
             },
@@ -965,7 +2938,7 @@ def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
             "content": [
                 {
                 "type": "text",
-                "text": "Describe this image as if you were describing it to someone who can't see it. "
+                "text": CAPTION_USER_PROMPT
                 },
                 {
                 "type": "image_url",
@@ -979,23 +2952,70 @@ def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
         "temperature": 0
     }
 
+    limiter = RateLimiter.get("captioning")
     for i in range(RETRY_COUNT):
+        if limiter:
+            limiter.acquire(CAPTION_PROMPT_TOKENS + CAPTION_IMAGE_TOKENS)
+        response = None
         try:
-            response = requests.post(captioning_model_endpoint, headers=headers, json=payload)
+            response = EmbeddingClientPool.session(captioning_model_endpoint).post(captioning_model_endpoint, headers=headers, json=payload, timeout=120)
             response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-            break
+            return response.json()["choices"][0]["message"]["content"]
         except Exception as e:
-            print(f"Error getting caption with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-            time.sleep(15)
+            error = e
+        status_code = getattr(response, "status_code", None)
+        if status_code is not None and status_code not in RETRYABLE_STATUS_CODES and status_code < 500:
+            break
+        if i + 1 < RETRY_COUNT:
+            delay = backoff_delay(i, getattr(response, "headers", None))
+            if limiter and status_code == 429:
+                # the other caption requests of every process would be throttled as well
+                limiter.pause(delay)
+            print(f"Error getting caption with error={error}, retrying in {delay:.1f}s, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
+            time.sleep(delay)
 
-    if response.status_code != 200:
-        raise Exception(f"Error getting caption with status_code={response.status_code}")
-    
-    caption = response.json()["choices"][0]["message"]["content"]
-    img_tag = image_content_to_tag(caption)
-    mapping = {img_tag: f"data:image/{file_ext};base64,{encoded_image}"}
+    raise Exception(f"Error getting caption with error={error}")
 
-    return img_tag, mapping
+def crack_file(
+    file_path: str,
+    file_format: str,
+    form_recognizer_client = None,
+    use_layout = False,
+    captioning_model_endpoint = None,
+    captioning_model_key = None
+) -> Tuple[str, Dict[str, str], bool]:
+    """Reads the content of a file, cracking pdf and office files with Document Intelligence and captioning images.
+    Args:
+        file_path (str): The file to read.
+        file_format (str): The format of the file, see FILE_FORMAT_DICT.
+    Returns:
+        Tuple[str, Dict[str, str], bool]: The content, the images of its image tags, and whether the file was cracked.
+    """
+    image_mapping = {}
+    cracked_pdf = False
+    if file_format in ["pdf", "docx", "pptx"]:
+        ranges = pdf_analysis_ranges(file_path, os.path.getsize(file_path))
+        # pdf pages read from their text layer do not need the service
+        if form_recognizer_client is None and any(not local for _, _, local in ranges):
+            raise UnsupportedFormatError("form_recognizer_client is required for pdf files")
+        content, image_mapping = extract_pdf_content(file_path, form_recognizer_client, use_layout=use_layout, ranges=ranges)
+        cracked_pdf = True
+    elif file_format in ["png", "jpg", "jpeg", "webp"]:
+        # Make call to LLM for a descriptive caption
+        if captioning_model_endpoint is None or captioning_model_key is None:
+            raise Exception("CAPTIONING_MODEL_ENDPOINT and CAPTIONING_MODEL_KEY are required for images")
+        content, image_mapping = get_caption(file_path, captioning_model_endpoint, captioning_model_key)
+    else:
+        try:
+            with open(file_path, "r", encoding="utf8") as f:
+                content = f.read()
+        except UnicodeDecodeError:
+            from chardet import detect
+            with open(file_path, "rb") as f:
+                binary_content = f.read()
+                encoding = detect(binary_content).get('encoding', 'utf8')
+                content = binary_content.decode(encoding)
+    return content, image_mapping, cracked_pdf
 
 def chunk_file(
     file_path: str,
@@ -1011,7 +3031,8 @@ def chunk_file(
     azure_credential = None,
     embedding_endpoint = None,
     captioning_model_endpoint = None,
-    captioning_model_key = None
+    captioning_model_key = None,
+    use_token_window = False
 ) -> ChunkingResult:
     """Chunks the given file.
     Args:
@@ -1021,7 +3042,6 @@ def chunk_file(
     """
     file_name = os.path.basename(file_path)
     file_format = _get_file_format(file_name, extensions_to_process)
-    image_mapping = {}
     if not file_format:
         if ignore_errors:
             return ChunkingResult(
@@ -1030,28 +3050,9 @@ def chunk_file(
         else:
             raise UnsupportedFormatError(f"{file_name} is not supported")
 
-    cracked_pdf = False
-    if file_format in ["pdf", "docx", "pptx"]:
-        if form_recognizer_client is None:
-            raise UnsupportedFormatError("form_recognizer_client is required for pdf files")
-        content, image_mapping = extract_pdf_content(file_path, form_recognizer_client, use_layout=use_layout)
-        cracked_pdf = True
-    elif file_format in ["png", "jpg", "jpeg", "webp"]:
-        # Make call to LLM for a descriptive caption
-        if captioning_model_endpoint is None or captioning_model_key is None:
-            raise Exception("CAPTIONING_MODEL_ENDPOINT and CAPTIONING_MODEL_KEY are required for images")
-        content, image_mapping = get_caption(file_path, captioning_model_endpoint, captioning_model_key)
-    else:
-        try:
-            with open(file_path, "r", encoding="utf8") as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            from chardet import detect
-            with open(file_path, "rb") as f:
-                binary_content = f.read()
-                encoding = detect(binary_content).get('encoding', 'utf8')
-                content = binary_content.decode(encoding)
-        
+    content, image_mapping, cracked_pdf = crack_file(file_path, file_format, form_recognizer_client=form_recognizer_client, use_layout=use_layout,
+                                                     captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
+
     return chunk_content(
         content=content,
         file_name=file_name,
@@ -1066,10 +3067,48 @@ def chunk_file(
         add_embeddings=add_embeddings,
         azure_credential=azure_credential,
         embedding_endpoint=embedding_endpoint,
-        image_mapping=image_mapping
+        image_mapping=image_mapping,
+        use_token_window=use_token_window
     )
 
 
+def estimate_file_cost(file_path: str) -> float:
+    """Estimates the relative cost of processing a file, from its size and format and, for pdfs, its number of pages."""
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        return 0
+    file_format = _get_file_format(os.path.basename(file_path), FILE_FORMAT_DICT.keys())
+    if file_format == "pdf":
+        try:
+            with fitz.open(file_path) as pdf:
+                return pdf.page_count * PDF_PAGE_COST
+        except Exception:
+            return size
+    if file_format in ["png", "jpg", "jpeg", "webp"]:
+        return IMAGE_FILE_COST
+    return size * FILE_FORMAT_COST_FACTORS.get(file_format, 1)
+
+@contextmanager
+def _time_limit(seconds: Optional[float], file_path: str):
+    """Raises FileTimeoutError in the block once it runs for longer than seconds.
+    Only the main thread of a process can be interrupted, on platforms with SIGALRM; elsewhere the block is not limited.
+    """
+    if not seconds or not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise FileTimeoutError(f"File ({file_path}) timed out after {seconds}s")
+
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
 def process_file(
         file_path: str, # !IMP: Please keep this as the first argument
         directory_path: str,
@@ -1085,40 +3124,38 @@ def process_file(
         azure_credential = None,
         embedding_endpoint = None,
         captioning_model_endpoint = None,
-        captioning_model_key = None
+        captioning_model_key = None,
+        use_token_window = False,
+        file_timeout: Optional[float] = None
     ):
 
     if not form_recognizer_client:
-        form_recognizer_client = SingletonFormRecognizerClient()
+        form_recognizer_client = get_form_recognizer_client()
 
     is_error = False
     try:
-        url_path = None
-        rel_file_path = os.path.relpath(file_path, directory_path)
-        if url_prefix:
-            url_path = url_prefix + rel_file_path
-            url_path = convert_escaped_to_posix(url_path)
-
-        result = chunk_file(
-            file_path,
-            ignore_errors=ignore_errors,
-            num_tokens=num_tokens,
-            min_chunk_size=min_chunk_size,
-            url=url_path,
-            token_overlap=token_overlap,
-            extensions_to_process=extensions_to_process,
-            form_recognizer_client=form_recognizer_client,
-            use_layout=use_layout,
-            add_embeddings=add_embeddings,
-            azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint,
-            captioning_model_endpoint=captioning_model_endpoint,
-            captioning_model_key=captioning_model_key
-        )
-        for chunk_idx, chunk_doc in enumerate(result.chunks):
-            chunk_doc.filepath = rel_file_path
-            chunk_doc.metadata = json.dumps({"chunk_id": str(chunk_idx)})
-            chunk_doc.image_mapping = json.dumps(chunk_doc.image_mapping) if chunk_doc.image_mapping else None
+        rel_file_path, url_path = _file_paths(file_path, directory_path, url_prefix)
+
+        with _time_limit(file_timeout, file_path):
+            result = chunk_file(
+                file_path,
+                ignore_errors=ignore_errors,
+                num_tokens=num_tokens,
+                min_chunk_size=min_chunk_size,
+                url=url_path,
+                token_overlap=token_overlap,
+                extensions_to_process=extensions_to_process,
+                form_recognizer_client=form_recognizer_client,
+                use_layout=use_layout,
+                add_embeddings=add_embeddings,
+                azure_credential=azure_credential,
+                embedding_endpoint=embedding_endpoint,
+                captioning_model_endpoint=captioning_model_endpoint,
+                captioning_model_key=captioning_model_key,
+                use_token_window=use_token_window
+            )
+        _set_chunk_metadata(result, rel_file_path)
+        result.peak_rss = peak_rss()
     except Exception as e:
         print(e)
         if not ignore_errors:
@@ -1128,7 +3165,407 @@ def process_file(
         result =None
     return result, is_error
 
-def chunk_blob_container(
+def process_cracked_file(
+        cracked_file: "CrackedFile", # !IMP: Please keep this as the first argument
+        directory_path: str,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = FILE_FORMAT_DICT.keys(),
+        use_layout = False,
+        use_token_window = False,
+        file_timeout: Optional[float] = None
+    ):
+    """Chunks a file cracked by crack_file like process_file does, without embeddings, for the chunking stage of ChunkingPipeline."""
+    is_error = False
+    try:
+        rel_file_path, url_path = _file_paths(cracked_file.file_path, directory_path, url_prefix)
+
+        with _time_limit(file_timeout, cracked_file.file_path):
+            content, image_mapping = cracked_file.content, cracked_file.image_mapping
+            if cracked_file.analysis is not None:
+                content, image_mapping = pdf_content_from_analysis(cracked_file.file_path, AnalyzeResult(cracked_file.analysis), use_layout=use_layout)
+            result = chunk_content(
+                content=content,
+                file_name=os.path.basename(cracked_file.file_path),
+                ignore_errors=ignore_errors,
+                num_tokens=num_tokens,
+                min_chunk_size=min_chunk_size,
+                url=url_path,
+                token_overlap=max(0, token_overlap),
+                extensions_to_process=extensions_to_process,
+                cracked_pdf=cracked_file.cracked_pdf,
+                use_layout=use_layout,
+                image_mapping=image_mapping,
+                use_token_window=use_token_window
+            )
+        _set_chunk_metadata(result, rel_file_path)
+        result.peak_rss = peak_rss()
+    except Exception as e:
+        print(e)
+        if not ignore_errors:
+            raise
+        print(f"File ({cracked_file.file_path}) failed with ", e)
+        is_error = True
+        result =None
+    return result, is_error
+
+def _file_paths(file_path: str, directory_path: str, url_prefix: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Returns the path of a file relative to the directory, and its url if there is a url prefix."""
+    url_path = None
+    rel_file_path = os.path.relpath(file_path, directory_path)
+    if url_prefix:
+        url_path = url_prefix + rel_file_path
+        url_path = convert_escaped_to_posix(url_path)
+    return rel_file_path, url_path
+
+def peak_rss() -> Optional[int]:
+    """Returns the peak resident memory of this process so far, in bytes, or None on platforms without the resource module."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def _set_chunk_metadata(result: ChunkingResult, rel_file_path: str) -> None:
+    for chunk_idx, chunk_doc in enumerate(result.chunks):
+        chunk_doc.filepath = rel_file_path
+        chunk_doc.metadata = json.dumps({"chunk_id": str(chunk_idx)})
+        chunk_doc.image_mapping = json.dumps(chunk_doc.image_mapping) if chunk_doc.image_mapping else None
+
+class _StageQueue(queue.Queue):
+    """A queue between two stages of the ChunkingPipeline that keeps its peak depth."""
+    def __init__(self, maxsize: int = 0) -> None:
+        super().__init__(maxsize)
+        self.peak = 0
+
+    def _put(self, item) -> None:
+        super()._put(item)
+        # the end marker is the last item of a queue, and not a file
+        if item is not _END_OF_FILES:
+            self.peak = max(self.peak, self._qsize())
+
+class _PipelineStopped(Exception):
+    pass
+
+@dataclass
+class _PipelineItem:
+    file_path: str
+    cracked_file: Optional[CrackedFile] = None
+    result: Optional[ChunkingResult] = None
+    is_error: bool = False
+    error: Optional[BaseException] = None
+
+# marks the end of the files in a queue of the ChunkingPipeline
+_END_OF_FILES = object()
+
+class ChunkingPipeline:
+    """Chunks files in stages connected by bounded queues, so that each stage runs at its own concurrency:
+
+    1. discovery puts the files to process in the "discovered" queue, most expensive first (see estimate_file_cost),
+    2. an event loop reads up to crack_concurrency files at a time into the "cracked" queue. Pdf and office files
+       are analyzed with the async Document Intelligence client, so that all their analyses are polled together,
+       and images are captioned,
+    3. njobs processes build the text of the analyzed files, then parse and split the files into the "chunked" queue,
+    4. a thread embeds the chunks of all the files waiting there at once, with EMBEDDING_MAX_CONCURRENCY requests
+       in flight on the AsyncEmbeddingEngine, into the "embedded" queue,
+    5. the sink, i.e. the consumer of run(), uploads or writes the files from there.
+
+    Each queue holds at most queue_size files, so a slow stage holds back the stages before it instead of
+    letting their results pile up in memory. The peak depth of each queue is kept in the stats and the
+    current depths are shown on the progress bar: a full queue points at a slow stage after it, an
+    empty one at a slow stage before it.
+
+    A file that takes longer than file_timeout seconds to crack, or to parse and split, fails with a FileTimeoutError.
+    Embedding is not limited by file_timeout, it is bounded by the retries of the AsyncEmbeddingEngine instead.
+    With max_tasks_per_child the chunking processes are replaced after that many files, to release the memory
+    that parsers hold on to. Recycled processes are started with spawn, which makes each replacement slower.
+    """
+    QUEUES = ("discovered", "cracked", "chunked", "embedded")
+    POLL_SECONDS = 0.1
+
+    def __init__(
+            self,
+            directory_path: str,
+            ignore_errors: bool = True,
+            num_tokens: int = 1024,
+            min_chunk_size: int = 10,
+            url_prefix = None,
+            token_overlap: int = 0,
+            extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+            form_recognizer_client = None,
+            use_layout = False,
+            njobs: int = 4,
+            crack_concurrency: int = 8,
+            queue_size: Optional[int] = None,
+            add_embeddings = False,
+            azure_credential = None,
+            embedding_endpoint = None,
+            captioning_model_endpoint = None,
+            captioning_model_key = None,
+            use_token_window = False,
+            file_timeout: Optional[float] = None,
+            max_tasks_per_child: Optional[int] = None
+    ) -> None:
+        self.ignore_errors = ignore_errors
+        self.extensions_to_process = extensions_to_process
+        self.form_recognizer_client = form_recognizer_client
+        self.use_layout = use_layout
+        self.njobs = njobs
+        self.crack_concurrency = crack_concurrency
+        self.queue_size = queue_size if queue_size else 2 * njobs
+        self.add_embeddings = add_embeddings
+        self.azure_credential = azure_credential
+        self.embedding_endpoint = embedding_endpoint
+        self.captioning_model_endpoint = captioning_model_endpoint
+        self.captioning_model_key = captioning_model_key
+        self.file_timeout = file_timeout
+        self.process_cracked_file = partial(process_cracked_file, directory_path=directory_path, ignore_errors=ignore_errors,
+                                            num_tokens=num_tokens, min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                                            token_overlap=token_overlap, extensions_to_process=extensions_to_process,
+                                            use_layout=use_layout, use_token_window=use_token_window, file_timeout=file_timeout)
+        self.max_tasks_per_child = max_tasks_per_child
+        if max_tasks_per_child and sys.version_info < (3, 11):
+            print("max_tasks_per_child requires Python 3.11 or later, worker processes will not be recycled")
+            self.max_tasks_per_child = None
+
+    def run(self, files: List[str], stats: ChunkingStats) -> Generator[Tuple[str, Optional[ChunkingResult], bool], None, None]:
+        """Yields the file path, result and error flag of each file, in the order the files finish."""
+        self._stop = threading.Event()
+        self._failure = None
+        self._queues = {name: _StageQueue(self.queue_size) for name in self.QUEUES}
+        # the chunked queue is bounded by the slots of the chunking stage instead, see _chunk
+        self._queues["chunked"] = _StageQueue()
+        self._slots = threading.Semaphore(self.queue_size)
+        self._num_chunking = 0
+        self._lock = threading.Condition()
+
+        executor_kwargs = {"max_tasks_per_child": self.max_tasks_per_child} if self.max_tasks_per_child else {}
+        executor = ProcessPoolExecutor(max_workers=self.njobs, initializer=RateLimiter.install, initargs=(RateLimiter.limiters(),), **executor_kwargs)
+        threads = [threading.Thread(target=self._run_stage, args=(self._discover, files))]
+        threads += [threading.Thread(target=self._run_stage, args=(self._crack,))]
+        threads += [threading.Thread(target=self._run_stage, args=(self._chunk, executor)),
+                    threading.Thread(target=self._run_stage, args=(self._embed,))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            with tqdm(total=len(files)) as progress:
+                while True:
+                    item = self._get(self._queues["embedded"])
+                    if item is _END_OF_FILES:
+                        break
+                    progress.update(1)
+                    progress.set_postfix({name: stage_queue.qsize() for name, stage_queue in self._queues.items()}, refresh=False)
+                    if item.error is not None:
+                        raise item.error
+                    yield item.file_path, item.result, item.is_error
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            executor.shutdown(wait=True, cancel_futures=True)
+            stats.queue_depths = {name: stage_queue.peak for name, stage_queue in self._queues.items()}
+
+    def _run_stage(self, stage: Callable, *args) -> None:
+        try:
+            stage(*args)
+        except _PipelineStopped:
+            pass
+        except BaseException as e:
+            # stop the other stages and have the sink raise the error
+            self._failure = e
+            self._stop.set()
+
+    def _get(self, stage_queue: queue.Queue):
+        while True:
+            try:
+                return stage_queue.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                if self._stop.is_set():
+                    raise self._failure if self._failure else _PipelineStopped()
+
+    def _put(self, stage_queue: queue.Queue, item) -> None:
+        while True:
+            try:
+                return stage_queue.put(item, timeout=self.POLL_SECONDS)
+            except queue.Full:
+                if self._stop.is_set():
+                    raise _PipelineStopped()
+
+    def _discover(self, files: List[str]) -> None:
+        # start the most expensive files first, so that a large pdf found last does not set the end of the run
+        for file_path in sorted(files, key=estimate_file_cost, reverse=True):
+            self._put(self._queues["discovered"], file_path)
+        self._put(self._queues["discovered"], _END_OF_FILES)
+
+    def _crack(self) -> None:
+        asyncio.run(self._crack_files())
+
+    async def _crack_files(self) -> None:
+        loop = asyncio.get_running_loop()
+        # threads for the blocking work of the files in flight: queue operations, reading files and captioning
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.crack_concurrency + 2))
+        client = self.form_recognizer_client
+        async_client = None
+        if client is None:
+            async_client = client = create_async_form_recognizer_client()
+        slots = asyncio.Semaphore(self.crack_concurrency)
+        tasks = set()
+        try:
+            while True:
+                file_path = await loop.run_in_executor(None, self._get, self._queues["discovered"])
+                if file_path is _END_OF_FILES:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(self._crack_file(file_path, client, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            if async_client is not None:
+                await async_client.close()
+        await loop.run_in_executor(None, self._put, self._queues["cracked"], _END_OF_FILES)
+
+    async def _crack_file(self, file_path: str, client, slots: asyncio.Semaphore) -> None:
+        # the slot is kept until the file is in the cracked queue, so that a slow chunking stage holds back the cracking
+        try:
+            item = await self._crack_item(file_path, client)
+            await asyncio.get_running_loop().run_in_executor(None, self._put, self._queues["cracked"], item)
+        finally:
+            slots.release()
+
+    async def _crack_item(self, file_path: str, client) -> _PipelineItem:
+        item = _PipelineItem(file_path)
+        file_format = _get_file_format(os.path.basename(file_path), self.extensions_to_process)
+        if not file_format:
+            if self.ignore_errors:
+                item.result = ChunkingResult(chunks=[], total_files=1, num_unsupported_format_files=1)
+            else:
+                item.error = UnsupportedFormatError(f"{os.path.basename(file_path)} is not supported")
+            return item
+        try:
+            try:
+                item.cracked_file = await asyncio.wait_for(self._crack_content(file_path, file_format, client), self.file_timeout)
+            except asyncio.TimeoutError:
+                # a file read or captioned in a thread finishes in the background, but the pipeline moves on
+                raise FileTimeoutError(f"File ({file_path}) timed out after {self.file_timeout}s")
+        except Exception as e:
+            print(e)
+            if not self.ignore_errors:
+                item.error = e
+            else:
+                print(f"File ({file_path}) failed with ", e)
+                item.is_error = True
+        return item
+
+    async def _crack_content(self, file_path: str, file_format: str, client) -> "CrackedFile":
+        loop = asyncio.get_running_loop()
+        if file_format in ["pdf", "docx", "pptx"] and client is not None:
+            # the chunking stage builds the content from the analysis
+            if inspect.iscoroutinefunction(client.begin_analyze_document):
+                analysis = await analyze_document_async(file_path, client, use_layout=self.use_layout)
+            else:
+                analysis = await loop.run_in_executor(None, partial(analyze_document, file_path, client, use_layout=self.use_layout))
+            return CrackedFile(file_path, "", {}, True, analysis=analysis.as_dict())
+        content, image_mapping, cracked_pdf = await loop.run_in_executor(None, partial(
+            crack_file, file_path, file_format, form_recognizer_client=client, use_layout=self.use_layout,
+            captioning_model_endpoint=self.captioning_model_endpoint, captioning_model_key=self.captioning_model_key))
+        return CrackedFile(file_path, content, image_mapping, cracked_pdf)
+
+    def _chunk(self, executor: ProcessPoolExecutor) -> None:
+        while True:
+            item = self._get(self._queues["cracked"])
+            if item is _END_OF_FILES:
+                with self._lock:
+                    while self._num_chunking:
+                        self._lock.wait(self.POLL_SECONDS)
+                        if self._stop.is_set():
+                            raise _PipelineStopped()
+                self._queues["chunked"].put(_END_OF_FILES)
+                return
+            # a slot is taken until the embedding stage takes the file, which bounds the files chunking or chunked
+            while not self._slots.acquire(timeout=self.POLL_SECONDS):
+                if self._stop.is_set():
+                    raise _PipelineStopped()
+            if item.cracked_file is None:
+                self._queues["chunked"].put(item)
+                continue
+            with self._lock:
+                self._num_chunking += 1
+            future = executor.submit(self.process_cracked_file, item.cracked_file)
+            future.add_done_callback(partial(self._on_chunked, item))
+
+    def _on_chunked(self, item: _PipelineItem, future) -> None:
+        try:
+            item.result, item.is_error = future.result()
+        except Exception as e:
+            item.error = e
+        item.cracked_file = None
+        self._queues["chunked"].put(item)
+        with self._lock:
+            self._num_chunking -= 1
+            self._lock.notify_all()
+
+    def _embed(self) -> None:
+        max_items, _ = EMBEDDING_BATCH_LIMITS.get(os.getenv("FLAG_EMBEDDING_MODEL", "AOAI"), (1, None))
+        max_chunks = max_items * max(1, int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8)))
+        is_end = False
+        while not is_end:
+            # embed the chunks of all the files waiting for it at once, in as few requests as possible
+            items = [self._get(self._queues["chunked"])]
+            num_chunks = 0
+            while items[-1] is not _END_OF_FILES:
+                self._slots.release()
+                if items[-1].result is not None:
+                    num_chunks += len(items[-1].result.chunks)
+                if num_chunks >= max_chunks:
+                    break
+                try:
+                    items.append(self._queues["chunked"].get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is _END_OF_FILES:
+                is_end = True
+                items.pop()
+            if self.add_embeddings:
+                self._add_embeddings(items)
+            for item in items:
+                self._put(self._queues["embedded"], item)
+        self._put(self._queues["embedded"], _END_OF_FILES)
+
+    def _add_embeddings(self, items: List[_PipelineItem]) -> None:
+        items = [item for item in items if item.error is None and item.result is not None and item.result.chunks]
+        if not items:
+            return
+        try:
+            embedding_cache = EmbeddingCache.from_env()
+            cache_hits, cache_misses = (embedding_cache.hits, embedding_cache.misses) if embedding_cache else (0, 0)
+            engine = get_embedding_engine(self.embedding_endpoint, azure_credential=self.azure_credential)
+            num_requests = engine.num_requests
+            embeddings = get_embeddings_with_cache([chunk.content for item in items for chunk in item.result.chunks], embedding_cache,
+                                                   embedding_model_endpoint=self.embedding_endpoint, azure_credential=self.azure_credential,
+                                                   token_counts=[size for item in items for size in item.result.chunk_sizes])
+        except Exception as e:
+            print(f"Error getting embeddings for {len(items)} files with error={e}")
+            for item in items:
+                if self.ignore_errors:
+                    item.result = ChunkingResult(chunks=[], total_files=1, num_files_with_errors=1)
+                else:
+                    item.error = e
+            return
+        embeddings = iter(embeddings)
+        for item in items:
+            for chunk in item.result.chunks:
+                chunk.contentVector = next(embeddings)
+        # the totals of the batch are counted with its first file
+        items[0].result.embedding_cache_hits += embedding_cache.hits - cache_hits if embedding_cache else 0
+        items[0].result.embedding_cache_misses += embedding_cache.misses - cache_misses if embedding_cache else 0
+        items[0].result.embedding_latencies.extend(engine.latencies_since(num_requests))
+
+def iter_chunk_blob_container(
         blob_url: str,
         credential,
         ignore_errors: bool = True,
@@ -1142,14 +3579,26 @@ def chunk_blob_container(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
-):
+        embedding_endpoint = None,
+        use_token_window = False,
+        stats: Optional[ChunkingStats] = None,
+        manifest: Optional[IngestionManifest] = None,
+        crack_concurrency: int = 8,
+        queue_size: Optional[int] = None,
+        file_timeout: Optional[float] = None,
+        max_tasks_per_child: Optional[int] = None
+) -> Generator[List[Document], None, None]:
+    """
+    Downloads the given blob container to a temporary folder and yields the chunks of each file as it is processed.
+    The temporary folder is removed once the generator is exhausted or closed.
+    See iter_chunk_directory for the arguments.
+    """
     with tempfile.TemporaryDirectory() as local_data_folder:
         print(f'Downloading {blob_url} to local folder')
         downloadBlobUrlToLocalFolder(blob_url, local_data_folder, credential)
         print(f'Downloaded.')
 
-        result = chunk_directory(
+        yield from iter_chunk_directory(
             local_data_folder,
             ignore_errors=ignore_errors,
             num_tokens=num_tokens,
@@ -1162,13 +3611,98 @@ def chunk_blob_container(
             njobs=njobs,
             add_embeddings=add_embeddings,
             azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
+            embedding_endpoint=embedding_endpoint,
+            use_token_window=use_token_window,
+            stats=stats,
+            manifest=manifest,
+            crack_concurrency=crack_concurrency,
+            queue_size=queue_size,
+            file_timeout=file_timeout,
+            max_tasks_per_child=max_tasks_per_child
         )
 
-    return result
+def chunk_blob_container(
+        blob_url: str,
+        credential,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        use_token_window = False,
+        crack_concurrency: int = 8,
+        queue_size: Optional[int] = None,
+        file_timeout: Optional[float] = None,
+        max_tasks_per_child: Optional[int] = None
+):
+    stats = ChunkingStats()
+    chunks = []
+    for file_chunks in iter_chunk_blob_container(
+            blob_url,
+            credential,
+            ignore_errors=ignore_errors,
+            num_tokens=num_tokens,
+            min_chunk_size=min_chunk_size,
+            url_prefix=url_prefix,
+            token_overlap=token_overlap,
+            extensions_to_process=extensions_to_process,
+            form_recognizer_client=form_recognizer_client,
+            use_layout=use_layout,
+            njobs=njobs,
+            add_embeddings=add_embeddings,
+            azure_credential=azure_credential,
+            embedding_endpoint=embedding_endpoint,
+            use_token_window=use_token_window,
+            stats=stats,
+            crack_concurrency=crack_concurrency,
+            queue_size=queue_size,
+            file_timeout=file_timeout,
+            max_tasks_per_child=max_tasks_per_child
+        ):
+        chunks.extend(file_chunks)
 
+    return _to_chunking_result(chunks, stats)
 
-def chunk_directory(
+
+def _to_chunking_result(chunks: List[Document], stats: ChunkingStats) -> ChunkingResult:
+    return ChunkingResult(
+            chunks=chunks,
+            total_files=stats.total_files,
+            num_unsupported_format_files=stats.num_unsupported_format_files,
+            num_files_with_errors=stats.num_files_with_errors,
+            skipped_chunks=stats.skipped_chunks,
+            embedding_cache_hits=stats.embedding_cache_hits,
+            embedding_cache_misses=stats.embedding_cache_misses,
+            embedding_latencies=stats.embedding_latencies,
+        )
+
+
+def _add_file_result(stats: ChunkingStats, file_path: str, result: Optional[ChunkingResult], is_error: bool) -> List[Document]:
+    """Adds the result of a file to the running totals and returns its chunks."""
+    stats.total_files += 1
+    if is_error:
+        stats.num_files_with_errors += 1
+        return []
+    if result.peak_rss is not None:
+        stats.peak_rss_by_file[file_path] = result.peak_rss
+    stats.num_unsupported_format_files += result.num_unsupported_format_files
+    stats.num_files_with_errors += result.num_files_with_errors
+    stats.skipped_chunks += result.skipped_chunks
+    stats.num_chunks += len(result.chunks)
+    stats.embedding_cache_hits += result.embedding_cache_hits
+    stats.embedding_cache_misses += result.embedding_cache_misses
+    stats.embedding_latencies.extend(result.embedding_latencies)
+    return result.chunks
+
+
+def iter_chunk_directory(
         directory_path: str,
         ignore_errors: bool = True,
         num_tokens: int = 1024,
@@ -1183,10 +3717,18 @@ def chunk_directory(
         azure_credential = None,
         embedding_endpoint = None,
         captioning_model_endpoint = None,
-        captioning_model_key = None
-):
+        captioning_model_key = None,
+        use_token_window = False,
+        stats: Optional[ChunkingStats] = None,
+        manifest: Optional[IngestionManifest] = None,
+        crack_concurrency: int = 8,
+        queue_size: Optional[int] = None,
+        file_timeout: Optional[float] = None,
+        max_tasks_per_child: Optional[int] = None
+) -> Generator[List[Document], None, None]:
     """
-    Chunks the given directory recursively
+    Chunks the given directory recursively, yielding the chunks of each file as soon as it is processed,
+    so that only the files in flight are held in memory.
     Args:
         directory_path (str): The directory to chunk.
         ignore_errors (bool): If true, ignores errors and returns None.
@@ -1199,26 +3741,46 @@ def chunk_directory(
         extensions_to_process (List[str]): The list of extensions to process. 
         form_recognizer_client: Optional form recognizer client to use for pdf files.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
+        njobs (int): The number of processes to chunk the files with. With njobs > 1, the files go through a ChunkingPipeline
+                     and are yielded in the order they finish.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        use_token_window (bool): If true, splits text, markdown and cracked pdfs into token windows with real token overlap.
+        stats (ChunkingStats): Optional running totals, updated before the chunks of each file are yielded.
+        manifest (IngestionManifest): Optional manifest of the files ingested before. Only the added and changed files are
+                                      processed, and the files without errors are recorded in it; the caller commits it.
+        crack_concurrency (int): With njobs > 1, the number of files read, cracked or captioned at a time.
+        queue_size (int): With njobs > 1, the number of files each stage of the pipeline can get ahead of the next. Default: 2 * njobs.
+        file_timeout (float): Optional number of seconds after which the chunking of a file fails. The timeout applies in the main
+                              thread of a process on platforms with SIGALRM, i.e. with njobs > 1 or when called from the main thread.
+                              With njobs > 1 it also limits the cracking of each file, but not its embedding, which is bounded
+                              by the retries of the embedding requests.
+        max_tasks_per_child (int): With njobs > 1, the number of files after which a chunking process is replaced. Requires Python 3.11.
 
     Returns:
-        List[Document]: List of chunked documents.
+        Generator[List[Document], None, None]: The chunks of each file. Files with errors or without chunks yield an empty list.
     """
-    chunks = []
-    total_files = 0
-    num_unsupported_format_files = 0
-    num_files_with_errors = 0
-    skipped_chunks = 0
+    if stats is None:
+        stats = ChunkingStats()
 
     all_files_directory = get_files_recursively(directory_path)
     files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
     print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
 
+    if manifest:
+        files_to_process = manifest.compare(directory_path, files_to_process)
+        stats.num_unchanged_files += len(manifest.report.unchanged)
+        manifest.print_report()
+
+    def add_file_result(file_path, result, is_error):
+        file_chunks = _add_file_result(stats, file_path, result, is_error)
+        if manifest and not is_error and result.num_files_with_errors == 0:
+            manifest.record(os.path.relpath(file_path, directory_path), len(file_chunks))
+        return file_chunks
+
 
     if njobs==1:
         print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
         for file_path in tqdm(files_to_process):
-            total_files += 1
             result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
                                        num_tokens=num_tokens,
                                        min_chunk_size=min_chunk_size, url_prefix=url_prefix,
@@ -1226,63 +3788,87 @@ def chunk_directory(
                                        extensions_to_process=extensions_to_process,
                                        form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
                                        azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-            if is_error:
-                num_files_with_errors += 1
-                continue
-            chunks.extend(result.chunks)
-            num_unsupported_format_files += result.num_unsupported_format_files
-            num_files_with_errors += result.num_files_with_errors
-            skipped_chunks += result.skipped_chunks
+                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key,
+                                       use_token_window=use_token_window, file_timeout=file_timeout)
+            yield add_file_result(file_path, result, is_error)
     elif njobs > 1:
-        print(f"Multiprocessing with njobs={njobs}")
-        process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
-                total_files += 1
-                if is_error:
-                    num_files_with_errors += 1
-                    continue
-                chunks.extend(result.chunks)
-                num_unsupported_format_files += result.num_unsupported_format_files
-                num_files_with_errors += result.num_files_with_errors
-                skipped_chunks += result.skipped_chunks
+        print(f"Multiprocessing with njobs={njobs}, crack_concurrency={crack_concurrency}")
+        pipeline = ChunkingPipeline(directory_path, ignore_errors=ignore_errors, num_tokens=num_tokens, min_chunk_size=min_chunk_size,
+                                    url_prefix=url_prefix, token_overlap=token_overlap, extensions_to_process=extensions_to_process,
+                                    form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
+                                    crack_concurrency=crack_concurrency, queue_size=queue_size, add_embeddings=add_embeddings,
+                                    azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
+                                    captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key,
+                                    use_token_window=use_token_window, file_timeout=file_timeout, max_tasks_per_child=max_tasks_per_child)
+        for file_path, result, is_error in pipeline.run(files_to_process, stats):
+            yield add_file_result(file_path, result, is_error)
 
-    return ChunkingResult(
-            chunks=chunks,
-            total_files=total_files,
-            num_unsupported_format_files=num_unsupported_format_files,
-            num_files_with_errors=num_files_with_errors,
-            skipped_chunks=skipped_chunks,
-        )
 
+def chunk_directory(
+        directory_path: str,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        captioning_model_endpoint = None,
+        captioning_model_key = None,
+        use_token_window = False,
+        manifest: Optional[IngestionManifest] = None,
+        crack_concurrency: int = 8,
+        queue_size: Optional[int] = None,
+        file_timeout: Optional[float] = None,
+        max_tasks_per_child: Optional[int] = None
+):
+    """
+    Chunks the given directory recursively. Use iter_chunk_directory to process the files without holding all the chunks in memory.
+    See iter_chunk_directory for the arguments.
+    If manifest is set, only the files that were added or changed since the last run with the same manifest and chunking
+    config are chunked, their chunks get the stable ids of manifest.document_id, and the result has the ids of the stale
+    chunks to delete. The manifest is not committed: commit it once the chunks are stored, so that files are not lost if
+    storing them fails.
 
-class SingletonFormRecognizerClient:
-    instance = None
-    def __new__(cls, *args, **kwargs):
-        if not cls.instance:
-            print("SingletonFormRecognizerClient: Creating instance of Form recognizer per process")
-            url = os.getenv("FORM_RECOGNIZER_ENDPOINT")
-            key = os.getenv("FORM_RECOGNIZER_KEY")
-            if url and key:
-                cls.instance = DocumentIntelligenceClient(
-                        endpoint=url, credential=AzureKeyCredential(key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
-            else:
-                print("SingletonFormRecognizerClient: Skipping since credentials not provided. Assuming NO form recognizer extensions(like .pdf) in directory")
-                cls.instance = object() # dummy object
-        return cls.instance
-
-    def __getstate__(self):
-        return self.url, self.key
-
-    def __setstate__(self, state):
-        url, key = state
-        self.instance = DocumentIntelligenceClient(endpoint=url, credential=AzureKeyCredential(key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
+    Returns:
+        ChunkingResult: The chunks of all the files and the totals.
+    """
+    stats = ChunkingStats()
+    chunks = []
+    for file_chunks in iter_chunk_directory(
+            directory_path,
+            ignore_errors=ignore_errors,
+            num_tokens=num_tokens,
+            min_chunk_size=min_chunk_size,
+            url_prefix=url_prefix,
+            token_overlap=token_overlap,
+            extensions_to_process=extensions_to_process,
+            form_recognizer_client=form_recognizer_client,
+            use_layout=use_layout,
+            njobs=njobs,
+            add_embeddings=add_embeddings,
+            azure_credential=azure_credential,
+            embedding_endpoint=embedding_endpoint,
+            captioning_model_endpoint=captioning_model_endpoint,
+            captioning_model_key=captioning_model_key,
+            use_token_window=use_token_window,
+            stats=stats,
+            manifest=manifest,
+            crack_concurrency=crack_concurrency,
+            queue_size=queue_size,
+            file_timeout=file_timeout,
+            max_tasks_per_child=max_tasks_per_child
+        ):
+        chunks.extend(file_chunks)
+
+    result = _to_chunking_result(chunks, stats)
+    if manifest:
+        for chunk in chunks:
+            chunk.id = manifest.document_id(chunk.filepath, int(json.loads(chunk.metadata)["chunk_id"]))
+        result.stale_document_ids = manifest.stale_document_ids()
+    return result
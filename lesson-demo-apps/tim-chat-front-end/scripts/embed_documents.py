@@ -1,13 +1,15 @@
 import argparse
-from asyncio import sleep
+from itertools import islice
 import json
+import os
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-from data_utils import get_embedding
+from data_utils import EmbeddingCache, RateLimiter, get_embedding_engine, get_embeddings_with_cache, latency_percentiles
 
-RETRY_COUNT = 5
+# number of documents read at a time for each embedding request in flight, get_embeddings_with_cache packs them into requests
+EMBEDDING_BATCH_SIZE = 2048
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -46,22 +48,45 @@ if __name__ == "__main__":
         if not embedding_endpoint:
             raise ValueError("No embedding endpoint provided in config file. Embeddings will not be generated.")
 
-        # Embed documents
+        # Optional cache of the embeddings of earlier runs
+        embedding_cache = None
+        if index_config.get("embedding_cache_path"):
+            embedding_cache = EmbeddingCache(index_config["embedding_cache_path"], max_bytes=index_config.get("embedding_cache_max_mb", 1024) << 20)
+
+        # Number of embedding requests in flight
+        max_concurrency = index_config.get("embedding_max_concurrency", 8)
+        os.environ["EMBEDDING_MAX_CONCURRENCY"] = str(max_concurrency)
+        RateLimiter.configure("embedding", index_config.get("embedding_requests_per_minute"), index_config.get("embedding_tokens_per_minute"))
+        engine = get_embedding_engine(embedding_endpoint, embedding_key)
+        num_requests = engine.num_requests
+
+        # Embed documents, enough lines at a time to keep every request in flight busy
         print("Generating embeddings...")
+        num_failed = 0
         with open(args.input_data_path) as input_file, open(args.output_file_path, "w") as output_file:
-            for line in input_file:
-                document = json.loads(line)
-                # Sleep/Retry in case embedding model is rate limited.
-                for _ in range(RETRY_COUNT):
-                    try:
-                        embedding = get_embedding(document["content"], embedding_endpoint,  embedding_key)
+            while True:
+                documents = [json.loads(line) for line in islice(input_file, EMBEDDING_BATCH_SIZE * max_concurrency)]
+                if not documents:
+                    break
+                # documents that could not be embedded are still written, without a vector
+                embeddings = get_embeddings_with_cache([document["content"] for document in documents], embedding_cache,
+                                                       embedding_model_endpoint=embedding_endpoint, embedding_model_key=embedding_key,
+                                                       ignore_errors=True)
+                for document, embedding in zip(documents, embeddings):
+                    if embedding is not None:
                         document["contentVector"] = embedding
-                        break
-                    except:
-                        print("Error generating embedding. Retrying...")
-                        sleep(30)
-                
-                output_file.write(json.dumps(document) + "\n")
+                    else:
+                        num_failed += 1
+                        print(f"Error generating embedding for document {document.get('id', document.get('filepath'))}, writing it without a vector")
+                    output_file.write(json.dumps(document) + "\n")
 
         print("Embeddings generated and saved to {}.".format(args.output_file_path))
+        if num_failed:
+            print(f"{num_failed} documents were written without embeddings")
+        if embedding_cache:
+            print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
+        latencies = engine.latencies_since(num_requests)
+        if latencies:
+            percentiles = ", ".join(f"{name}={value * 1000:.0f} ms" for name, value in latency_percentiles(latencies).items())
+            print(f"Embedding requests: {len(latencies)}, latency {percentiles}")
 
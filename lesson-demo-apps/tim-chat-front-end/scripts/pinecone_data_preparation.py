@@ -12,9 +12,9 @@ from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
 
-from typing import List
+from typing import Iterable
 
-from data_utils import chunk_directory
+from data_utils import ChunkingStats, iter_chunk_directory
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -101,7 +101,7 @@ def create_or_update_vector_search_index(
      
 def upsert_documents_to_index(
         index_name: str,
-        docs: List[Document]
+        docs: Iterable[Document]
         ):
     
     index = pinecone.Index(index_name)
@@ -163,21 +163,22 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     print("Chunking directory...")
     add_embeddings = True
 
-    result = chunk_directory(config["data_path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+    stats = ChunkingStats()
+    file_chunks = iter_chunk_directory(config["data_path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                              azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                             add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint)
+                             add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, stats=stats)
 
-    if len(result.chunks) == 0:
-        raise Exception("No chunks found. Please check the data path and chunk size.")
+    # upsert the documents to the index as the files are chunked
+    print("Upserting documents to index...")
+    upsert_documents_to_index(index_name, (chunk for chunks in file_chunks for chunk in chunks))
 
-    print(f"Processed {result.total_files} files")
-    print(f"Unsupported formats: {result.num_unsupported_format_files} files")
-    print(f"Files with errors: {result.num_files_with_errors} files")
-    print(f"Found {len(result.chunks)} chunks")
+    if stats.num_chunks == 0:
+        raise Exception("No chunks found. Please check the data path and chunk size.")
 
-    # upsert documents to index
-    print("Upserting documents to index...")
-    upsert_documents_to_index(index_name, result.chunks)
+    print(f"Processed {stats.total_files} files")
+    print(f"Unsupported formats: {stats.num_unsupported_format_files} files")
+    print(f"Files with errors: {stats.num_files_with_errors} files")
+    print(f"Found {stats.num_chunks} chunks")
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -66,6 +66,8 @@ for key, cfg in tqdm.tqdm(run_config_by_data_path_3_small_512_512.items()):
         FORM_RECOGNIZER_KEY,
     ] + (["--form-rec-use-layout"] if form_rec_use_layout else []) + [
         "--njobs=8",
+        "--analysis-cache-path",
+        "analysis.db",
     ]
     str_command = " ".join(command)
     with open(f"logs/stdout.{key}.txt", "w") as f_stdout, open(f"logs/stderr.{key}.txt", "w") as f_stderr:
@@ -0,0 +1,976 @@
+import asyncio
+import base64
+import json
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "scripts"))
+data_utils = pytest.importorskip("data_utils")
+
+ANALYZE_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "analyze_results")
+
+
+def test_estimate_tokens_batch_matches_single():
+    texts = ["hello world", "", "hello world", "<|endoftext|> special", "Ünïcödé text. " * 20]
+    estimator = data_utils.TokenEstimator()
+    expected = [len(estimator.GPT2_TOKENIZER.encode(text, allowed_special="all")) for text in texts]
+    assert estimator.estimate_tokens_batch(texts) == expected
+    assert [estimator.estimate_tokens(text) for text in texts] == expected
+
+
+def test_estimate_tokens_cache_is_bounded():
+    estimator = data_utils.TokenEstimator(cache_size=2)
+    for text in ["one", "two", "three"]:
+        estimator.estimate_tokens(text)
+    assert len(estimator._cache) == 2
+
+
+def _legacy_cleanup_content(content):
+    output = re.sub(r"\n{2,}", "\n", content)
+    output = re.sub(r"[^\S\n]{2,}", " ", output)
+    output = re.sub(r"-{2,}", "--", output)
+    return output.strip()
+
+
+def test_text_normalizer_matches_the_regex_passes():
+    hypothesis = pytest.importorskip("hypothesis")
+    st = hypothesis.strategies
+    # the characters of the runs, ascii and unicode whitespace that is not, and text around them
+    alphabet = st.sampled_from(["\n", " ", "-", "\t", "\r", "\x0b", "\x1f", "\xa0", " ", " ", "a", "é", "<p>"])
+
+    @hypothesis.settings(max_examples=500, deadline=None)
+    @hypothesis.given(st.lists(st.lists(alphabet).map("".join)))
+    def check(pieces):
+        content = "".join(pieces)
+        expected = _legacy_cleanup_content(content)
+        assert data_utils.cleanup_content(content) == expected
+        assert "".join(data_utils.TEXT_NORMALIZER.normalize_stream(pieces)) == expected
+
+    check()
+
+
+@pytest.mark.parametrize("content", [
+    "<html><head><title>Guide &amp; reference</title></head><body><h1>Overview</h1></body></html>",
+    "<title>  </title><h1>Heading</h1>",
+    "<title>a<b>b</b></title><h1>Heading</h1><h2>Sub</h2>",
+    "<title><b>Bold title</b></title>",
+    "<title><!--comment title--></title>",
+    "<h1>Intro<p>more</h1>tail <title>Late title</title>",
+    "<div><h1>A</div>B</h1>C",
+    "<h1> <script>var h = '<h2>';</script> </h1><p>first &#150; string</p><h2>Sub</h2>",
+    "<br><h2>A</br>&nbsp;B</h2><h1>",
+    "<!DOCTYPE html><template><p>template</p></template><style>p {}</style><![CDATA[data]]>",
+    "<ruby>r<rt>t</rt></ruby>&unknown; &copy",
+    "<!-- only a comment -->",
+    "",
+])
+def test_html_title_extractor_matches_beautifulsoup(content):
+    BeautifulSoup = pytest.importorskip("bs4").BeautifulSoup
+    soup = BeautifulSoup(content, "html.parser")
+    if soup.title and soup.title.string:
+        expected = str(soup.title.string), "title"
+    else:
+        heading = soup.find("h1") or soup.find("h2")
+        expected = (heading.get_text(strip=True), heading.name) if heading else ("", None)
+        if not expected[0]:
+            expected = next(((string, "string") for string in soup.stripped_strings), (None, None))
+    assert data_utils.HTMLTitleExtractor().extract(content) == expected
+
+
+@pytest.mark.parametrize("use_token_window", [False, True])
+def test_markdown_chunks_are_rendered_under_the_document_title(use_token_window):
+    markdown = pytest.importorskip("markdown")
+    sections = [f"## Setup\n\nStep {i} of the guide, see [docs](https://example.com/{i}).\n\n- one\n- two\n\n"
+                f"| a | b |\n| - | - |\n| {i} | x |\n\n```\ncode {i}\n```" for i in range(40)]
+    content = "# Guide\n\n" + "\n\n".join(sections)
+    chunks = list(data_utils.chunk_content_helper(content, "markdown", "guide.md", 0, 128, use_token_window=use_token_window))
+
+    # each chunk is rendered as a document of its own would be, with the title of the whole document
+    if use_token_window:
+        splitter = data_utils.TokenWindowSplitter(chunk_size=128, chunk_overlap=0, **data_utils.TOKEN_WINDOW_FORMATS["markdown"])
+        pieces = splitter.split_text_with_sizes(content)
+    else:
+        splitter = data_utils.MarkdownTextSplitter(chunk_size=128, chunk_overlap=0, length_function=data_utils.TOKEN_ESTIMATOR.estimate_tokens)
+        pieces = list(data_utils.merge_chunks_serially(splitter.split_text(content), 128))
+    extensions = ["fenced_code", "toc", "tables", "sane_lists"]
+    expected = [data_utils.cleanup_content(markdown.markdown(piece, extensions=extensions)) for piece, _ in pieces]
+    assert len(expected) > 1
+    assert [chunk for chunk, _, _ in chunks] == expected
+    assert [size for _, size, _ in chunks] == [size for _, size in pieces]
+    assert all(doc.content == chunk and doc.title == "Guide" for chunk, _, doc in chunks)
+
+
+def test_token_window_splitter_overlap_and_sizes():
+    text = " ".join(f"Sentence number {i} has a link to https://example.com/page/{i} in it." for i in range(200))
+    splitter = data_utils.TokenWindowSplitter(
+        chunk_size=64, chunk_overlap=16, **data_utils.TOKEN_WINDOW_FORMATS["text"])
+    chunks = splitter.split_text_with_sizes(text)
+    assert len(chunks) > 1
+    tokenizer = data_utils.TokenEstimator.GPT2_TOKENIZER
+    previous_start, previous_end = -1, 0
+    for chunk, size in chunks:
+        assert size <= 64
+        assert len(tokenizer.encode(chunk)) == size
+        # every chunk is a slice of the text that overlaps the previous one and never cuts an url
+        start = text.index(chunk, previous_start + 1)
+        assert start <= previous_end
+        assert not chunk.endswith("https://example.com/page")
+        previous_start, previous_end = start, start + len(chunk)
+    assert previous_end == len(text)
+
+
+@pytest.mark.parametrize("file_format", ["text", "markdown", "html_pdf"])
+def test_token_window_splitter_smallest_chunk_size(file_format):
+    # multi-byte characters split over several tokens make chunks start inside a token
+    text = "Café 東京 naïve 🙂 résumé. <tr><td>Zürich</td></tr> https://example.com/ü 日本語のテキスト。"
+    splitter = data_utils.TokenWindowSplitter(chunk_size=1, chunk_overlap=0, **data_utils.TOKEN_WINDOW_FORMATS[file_format])
+    chunks = splitter.split_text_with_sizes(text)
+    assert chunks and all(1 <= size <= 2 for _, size in chunks)
+    # the chunks are slices of the text, in order, up to its end
+    position = 0
+    for chunk, _ in chunks:
+        position = text.index(chunk, max(0, position - len(chunk))) + len(chunk)
+    assert position == len(text)
+    with pytest.raises(ValueError, match="chunk_size"):
+        data_utils.TokenWindowSplitter(chunk_size=0, chunk_overlap=0)
+
+def test_merge_chunks_serially_unmasks_placeholders():
+    content_dict = {"##URL0##": "https://example.com/a", "##URL10##": "https://example.com/b", "##IMG0##": '<img src="IMG_1.jpg">x</img>'}
+    pieces = ["see ##URL0## and ##URL10##. ", "plain text. ", "##IMG0## figure"]
+    # the size of the plain piece is reused, the pieces with placeholders are recounted after unmasking
+    merged = list(data_utils.merge_chunks_serially(pieces, 1000, content_dict, chunk_sizes=[1, 7, 1]))
+    assert merged == [(
+        'see https://example.com/a and https://example.com/b. plain text. <img src="IMG_1.jpg">x</img> figure',
+        data_utils.TOKEN_ESTIMATOR.estimate_tokens("see https://example.com/a and https://example.com/b. ")
+        + 7
+        + data_utils.TOKEN_ESTIMATOR.estimate_tokens('<img src="IMG_1.jpg">x</img> figure'),
+    )]
+
+
+def test_mask_urls_and_imgs_single_pass():
+    text = 'Go to https://a.com/x, then https://a.com/xyz and https://a.com/x. <img src="IMG_1.jpg">see https://b.com/y</img>'
+    content_dict, masked_text = data_utils.mask_urls_and_imgs(text)
+    assert masked_text == "Go to ##URL0##, then ##URL1## and ##URL0##. ##IMG0##"
+    assert content_dict["##IMG0##"] == '<img src="IMG_1.jpg">see https://b.com/y</img>'
+    assert data_utils.unmask_urls_and_imgs(masked_text, content_dict) == text
+
+
+
+def _table(rows, cols):
+    cells = [
+        SimpleNamespace(row_index=r, column_index=c, content=f"r{r} c{c} <x>", kind="columnHeader" if r == 0 else "content",
+                        row_span=1, column_span=2 if (r, c) == (1, 0) else 1)
+        for r in range(rows) for c in range(cols)
+    ]
+    return SimpleNamespace(row_count=rows, column_count=cols, cells=list(reversed(cells)))
+
+
+def test_table_to_html_groups_cells_by_row():
+    assert data_utils.table_to_html(_table(2, 2)) == (
+        "<table><tr><th>r0 c0 &lt;x&gt;</th><th>r0 c1 &lt;x&gt;</th></tr>"
+        "<tr><td colSpan=2>r1 c0 &lt;x&gt;</td><td>r1 c1 &lt;x&gt;</td></tr></table>"
+    )
+
+
+def test_table_headers_match_the_regex_on_the_joined_rows():
+    hypothesis = pytest.importorskip("hypothesis")
+    st = hypothesis.strategies
+    alphabet = st.sampled_from(["<th>", "<th colSpan=2>", "</th>", "<th", "<td>", "</td>", "</tr>", ">", "\n", "a"])
+
+    @hypothesis.settings(max_examples=500, deadline=None)
+    @hypothesis.given(st.lists(st.lists(alphabet).map("".join), min_size=1))
+    def check(parts):
+        table_headers = data_utils._TableHeaders()
+        for i, part in enumerate(parts):
+            table_headers.add("<tr>" + part if i else part)
+            match = re.search("<th.*>.*</th>", "<tr>".join(parts[:i + 1]))
+            assert table_headers.headers == (match.group() if match else "")
+
+    check()
+
+
+def test_chunk_table_repeats_the_headers():
+    table = _table(60, 4)
+    splitter = data_utils.PdfTextSplitter(separator=data_utils.SENTENCE_ENDINGS, chunk_size=128, chunk_overlap=0)
+    minitables = splitter.chunk_table(data_utils.table_to_html(table), "Caption")
+    assert len(minitables) > 1
+    header = "<th>r0 c0 &lt;x&gt;</th><th>r0 c1 &lt;x&gt;</th><th>r0 c2 &lt;x&gt;</th><th>r0 c3 &lt;x&gt;</th>"
+    for minitable in minitables[1:]:
+        assert minitable.startswith("Caption\n<table>\n" + header + "<tr>")
+        assert minitable.endswith("</tr></table>")
+
+
+def test_iter_chunk_directory_yields_per_file_with_running_totals(tmp_path):
+    for i in range(3):
+        (tmp_path / f"doc{i}.txt").write_text(f"Document {i} sentence. " * 200)
+    (tmp_path / "image.unknown").write_text("not a document")
+
+    stats = data_utils.ChunkingStats()
+    num_chunks = 0
+    for file_chunks in data_utils.iter_chunk_directory(str(tmp_path), num_tokens=128, njobs=1, stats=stats):
+        num_chunks += len(file_chunks)
+        # the totals are updated before the chunks of each file are yielded
+        assert stats.num_chunks == num_chunks
+    assert stats.total_files == 4
+    assert stats.num_unsupported_format_files == 1
+    assert num_chunks > 3
+    if data_utils.resource is not None:
+        assert len(stats.peak_rss_by_file) == 4 and min(stats.peak_rss_by_file.values()) > 0
+
+    result = data_utils.chunk_directory(str(tmp_path), num_tokens=128, njobs=1)
+    assert [chunk.content for chunk in result.chunks] == [
+        chunk.content for chunks in data_utils.iter_chunk_directory(str(tmp_path), num_tokens=128, njobs=1) for chunk in chunks]
+    assert result.total_files == 4
+
+
+def test_chunking_pipeline_matches_single_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_utils.AsyncEmbeddingEngine, "_pid", None)
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    requests = []
+
+    async def fake_request(self, texts):
+        requests.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr(data_utils.AsyncEmbeddingEngine, "_request", fake_request)
+    for i in range(6):
+        (tmp_path / f"doc{i}.txt").write_text(f"Document {i} sentence. " * 50 * (i + 1))
+    (tmp_path / "image.unknown").write_text("not a document")
+    kwargs = dict(num_tokens=128, add_embeddings=True,
+                  embedding_endpoint="https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01")
+
+    expected = data_utils.chunk_directory(str(tmp_path), njobs=1, **kwargs)
+    num_requests = len(requests)
+    stats = data_utils.ChunkingStats()
+    chunks = [chunk for file_chunks in data_utils.iter_chunk_directory(str(tmp_path), njobs=2, crack_concurrency=2, queue_size=2, stats=stats, **kwargs)
+              for chunk in file_chunks]
+
+    def key(chunk):
+        return chunk.filepath, json.loads(chunk.metadata)["chunk_id"]
+
+    assert [(key(chunk), chunk.content, chunk.contentVector) for chunk in sorted(chunks, key=key)] == [
+        (key(chunk), chunk.content, chunk.contentVector) for chunk in sorted(expected.chunks, key=key)]
+    assert (stats.total_files, stats.num_unsupported_format_files, stats.num_chunks) == (7, 1, len(expected.chunks))
+    # the chunks of several files are embedded together
+    assert len(requests) - num_requests <= num_requests
+    assert set(stats.queue_depths) == {"discovered", "cracked", "chunked", "embedded"}
+    assert all(depth <= 2 for depth in stats.queue_depths.values())
+
+    # closing the generator early stops the pipeline
+    file_chunks = data_utils.iter_chunk_directory(str(tmp_path), njobs=2, queue_size=1, **kwargs)
+    next(file_chunks)
+    file_chunks.close()
+
+
+def test_chunking_pipeline_keeps_analyses_in_flight(tmp_path):
+    models = pytest.importorskip("azure.ai.documentintelligence.models")
+    with open(os.path.join(ANALYZE_RESULTS_DIR, "layout_report.json")) as f:
+        result = models.AnalyzeResult(json.load(f))
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    for i in range(6):
+        (data_path / f"report{i}.pdf").write_bytes(b"")
+    kwargs = dict(num_tokens=256, use_layout=True)
+    expected = data_utils.chunk_directory(str(data_path), njobs=1, form_recognizer_client=_FakeFormRecognizerClient(result), **kwargs)
+
+    client = _FakeAsyncFormRecognizerClient(result)
+    chunks = [chunk for file_chunks in data_utils.iter_chunk_directory(str(data_path), njobs=2, crack_concurrency=3,
+                                                                         form_recognizer_client=client, **kwargs)
+              for chunk in file_chunks]
+    assert client.max_in_flight == 3
+    assert sorted((chunk.filepath, chunk.content) for chunk in chunks) == sorted((chunk.filepath, chunk.content) for chunk in expected.chunks)
+    assert {chunk.filepath for chunk in chunks} == {f"report{i}.pdf" for i in range(6)}
+
+
+def test_estimate_file_cost_orders_large_pdfs_first(tmp_path):
+    fitz = pytest.importorskip("fitz")
+    pdf = fitz.open()
+    for _ in range(3):
+        pdf.new_page()
+    pdf.save(str(tmp_path / "report.pdf"))
+    (tmp_path / "notes.txt").write_text("note " * 1000)
+    (tmp_path / "page.html").write_text("<p>note</p>" * 100)
+    files = [str(tmp_path / name) for name in ["notes.txt", "page.html", "report.pdf"]]
+    assert data_utils.estimate_file_cost(str(tmp_path / "report.pdf")) == 3 * data_utils.PDF_PAGE_COST
+    assert [os.path.basename(f) for f in sorted(files, key=data_utils.estimate_file_cost, reverse=True)] == ["report.pdf", "notes.txt", "page.html"]
+
+
+def test_time_limit_interrupts_slow_files():
+    if not hasattr(data_utils.signal, "SIGALRM"):
+        pytest.skip("SIGALRM is not available")
+    with pytest.raises(data_utils.FileTimeoutError):
+        with data_utils._time_limit(0.05, "slow.txt"):
+            time.sleep(5)
+    # the alarm is cleared once the block finishes in time
+    with data_utils._time_limit(0.05, "fast.txt"):
+        pass
+    time.sleep(0.1)
+
+
+def test_chunking_pipeline_recycles_workers(tmp_path):
+    for i in range(3):
+        (tmp_path / f"doc{i}.txt").write_text(f"Document {i} sentence. " * 100)
+    stats = data_utils.ChunkingStats()
+    chunks = [chunk for file_chunks in data_utils.iter_chunk_directory(str(tmp_path), num_tokens=128, njobs=2, stats=stats,
+                                                                         file_timeout=60, max_tasks_per_child=2)
+              for chunk in file_chunks]
+    assert stats.total_files == 3 and stats.num_files_with_errors == 0
+    assert sorted({chunk.filepath for chunk in chunks}) == [f"doc{i}.txt" for i in range(3)]
+
+
+def test_chunking_pipeline_times_out_slow_cracking(tmp_path, monkeypatch):
+    (tmp_path / "slow.txt").write_text("Slow sentence. " * 100)
+    (tmp_path / "fast.txt").write_text("Fast sentence. " * 100)
+    crack_file = data_utils.crack_file
+
+    def slow_crack_file(file_path, *args, **kwargs):
+        if file_path.endswith("slow.txt"):
+            time.sleep(1)
+        return crack_file(file_path, *args, **kwargs)
+
+    monkeypatch.setattr(data_utils, "crack_file", slow_crack_file)
+    pipeline = data_utils.ChunkingPipeline(str(tmp_path), num_tokens=128, njobs=2, file_timeout=0.2)
+    results = {os.path.basename(file_path): is_error
+               for file_path, _, is_error in pipeline.run([str(tmp_path / "slow.txt"), str(tmp_path / "fast.txt")], data_utils.ChunkingStats())}
+    assert results == {"slow.txt": True, "fast.txt": False}
+
+
+def test_chunk_directory_manifest_skips_unchanged_files(tmp_path):
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    for name in ["a", "b", "c"]:
+        (data_path / f"{name}.txt").write_text(f"Document {name} sentence. " * 100)
+    manifest_path = str(tmp_path / "manifest.db")
+
+    def run(store=True, token_overlap=0, url_prefix=None):
+        manifest = data_utils.IngestionManifest(
+            manifest_path, source=os.path.abspath(data_path),
+            config_fingerprint=data_utils.IngestionManifest.config_fingerprint(128, token_overlap, None, False, url_prefix=url_prefix))
+        result = data_utils.chunk_directory(str(data_path), num_tokens=128, njobs=1, token_overlap=token_overlap, url_prefix=url_prefix,
+                                            manifest=manifest)
+        assert all(chunk.id == manifest.document_id(chunk.filepath, int(json.loads(chunk.metadata)["chunk_id"])) for chunk in result.chunks)
+        # the caller commits the manifest once the chunks are stored
+        if store:
+            manifest.commit()
+        manifest.close()
+        return result, sorted({chunk.filepath for chunk in result.chunks})
+
+    # files whose chunks were not stored are chunked again
+    result, files = run(store=False)
+    assert files == ["a.txt", "b.txt", "c.txt"]
+    result, files = run()
+    assert files == ["a.txt", "b.txt", "c.txt"] and result.stale_document_ids == []
+
+    result, files = run()
+    assert files == [] and result.total_files == 0
+
+    # a new mtime with the same content is not a change
+    os.utime(data_path / "a.txt", ns=(0, 0))
+    (data_path / "b.txt").write_text("Changed document. " * 100)
+    (data_path / "c.txt").unlink()
+    (data_path / "d.txt").write_text("New document. " * 100)
+    manifest = data_utils.IngestionManifest(
+        manifest_path, source=os.path.abspath(data_path),
+        config_fingerprint=data_utils.IngestionManifest.config_fingerprint(128, 0, None, False))
+    files_to_process = manifest.compare(str(data_path), data_utils.get_files_recursively(str(data_path)))
+    assert sorted(os.path.basename(f) for f in files_to_process) == ["b.txt", "d.txt"]
+    assert (manifest.report.added, manifest.report.changed, manifest.report.deleted) == (["d.txt"], ["b.txt"], ["c.txt"])
+    stale_document_ids = manifest.stale_document_ids()
+    assert len(stale_document_ids) == manifest.report.previous_num_chunks["c.txt"]
+    manifest.close()
+
+    result, files = run()
+    assert files == ["b.txt", "d.txt"]
+    # the chunks of the deleted file, and those the changed file no longer has
+    num_b_chunks = sum(chunk.filepath == "b.txt" for chunk in result.chunks)
+    previous_num_b_chunks = manifest.report.previous_num_chunks["b.txt"]
+    assert num_b_chunks < previous_num_b_chunks
+    assert result.stale_document_ids == stale_document_ids + [
+        manifest.document_id("b.txt", i) for i in range(num_b_chunks, previous_num_b_chunks)]
+
+    # a different chunking config changes every file
+    result, files = run(token_overlap=16)
+    assert files == ["a.txt", "b.txt", "d.txt"]
+
+    # so does a new url prefix, which is in the url of every chunk
+    result, files = run(token_overlap=16, url_prefix="https://example.com/docs/")
+    assert files == ["a.txt", "b.txt", "d.txt"]
+    assert all(chunk.url.startswith("https://example.com/docs/") for chunk in result.chunks)
+
+
+def test_manifest_report_lists_a_sample_of_paths(tmp_path, capsys):
+    for i in range(15):
+        (tmp_path / f"doc{i}.txt").write_text(f"Document {i}.")
+    manifest = data_utils.IngestionManifest(str(tmp_path / "manifest.db"), source=str(tmp_path),
+                                            config_fingerprint=data_utils.IngestionManifest.config_fingerprint(128, 0, None, False))
+    manifest.compare(str(tmp_path), [str(tmp_path / f"doc{i}.txt") for i in range(15)])
+    manifest.print_report()
+    manifest.close()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Manifest: 15 added, 0 changed, 0 deleted, 0 unchanged files"
+    assert len(lines) == 2 + data_utils.IngestionManifest.REPORT_SAMPLE_SIZE
+    assert lines[-1] == f"  Added: ... and {15 - data_utils.IngestionManifest.REPORT_SAMPLE_SIZE} more"
+
+def test_embedding_cache_round_trip_and_eviction(tmp_path, monkeypatch):
+    monkeypatch.setenv("FLAG_EMBEDDING_MODEL", "AOAI")
+    endpoint = "https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01"
+    cache = data_utils.EmbeddingCache(str(tmp_path / "embeddings.db"), max_bytes=10 * 8 * 8)
+    key = data_utils.EmbeddingCache.key("some text", endpoint)
+    assert key == data_utils.EmbeddingCache.key("some text", endpoint.replace("2024-02-01", "2024-06-01"))
+    assert key != data_utils.EmbeddingCache.key("some text", endpoint.replace("/ada/", "/large/"))
+    monkeypatch.setenv("VECTOR_DIMENSION", "256")
+    assert key != data_utils.EmbeddingCache.key("some text", endpoint)
+
+    assert cache.get(key) is None
+    vector = [0.1, -0.2, 1 / 3, 1e-300, 0.0, 2.0, 3.0, 4.0]
+    cache.put(key, vector)
+    assert cache.get(key) == vector
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # another connection, e.g. from a worker process, sees the entry
+    assert data_utils.EmbeddingCache(cache.path).get(key) == vector
+
+    for i in range(20):
+        cache.put(str(i), vector)
+    cache.evict()
+    count, total_bytes = cache.connection.execute("SELECT COUNT(*), SUM(LENGTH(vector)) FROM embeddings").fetchone()
+    assert total_bytes <= cache.max_bytes and count > 0
+    assert cache.get("19") == vector
+
+
+def test_chunk_content_consults_embedding_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(tmp_path / "embeddings.db"))
+    monkeypatch.setattr(data_utils.EmbeddingCache, "_instance", None)
+    monkeypatch.setattr(data_utils.AsyncEmbeddingEngine, "_pid", None)
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    requests = []
+
+    async def fake_request(self, texts):
+        requests.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr(data_utils.AsyncEmbeddingEngine, "_request", fake_request)
+    content = "Some sentence about search. " * 100 + "A different ending."
+    kwargs = dict(file_name="doc.txt", num_tokens=64, add_embeddings=True,
+                  embedding_endpoint="https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01")
+
+    first = data_utils.chunk_content(content, **kwargs)
+    # the distinct chunks of the file are embedded in a single request
+    assert len(requests) == 1 and len(requests[0]) == len(set(requests[0])) < len(first.chunks)
+    assert first.embedding_cache_misses == len(requests[0]) and first.embedding_cache_hits == 0
+    assert len(first.embedding_latencies) == 1
+    assert all(chunk.contentVector == [float(len(chunk.content))] for chunk in first.chunks)
+
+    second = data_utils.chunk_content(content, **kwargs)
+    assert len(requests) == 1
+    assert second.embedding_cache_hits == len(requests[0]) and second.embedding_cache_misses == 0
+    assert second.embedding_latencies == []
+    assert [chunk.contentVector for chunk in second.chunks] == [chunk.contentVector for chunk in first.chunks]
+
+
+def test_pack_embedding_batches_respects_item_and_token_limits():
+    texts = ["word " * 10] * 7 + ["word " * 100] + ["word"] * 3
+    batches = data_utils.pack_embedding_batches(texts, max_items=4, max_tokens=50)
+    assert [index for batch in batches for index in batch] == list(range(len(texts)))
+    sizes = data_utils.TOKEN_ESTIMATOR.estimate_tokens_batch(texts)
+    for batch in batches:
+        assert len(batch) <= 4
+        assert len(batch) == 1 or sum(sizes[i] for i in batch) <= 50
+    assert [7] in batches
+    assert data_utils.pack_embedding_batches(texts, max_items=96) == [list(range(len(texts)))]
+
+
+def test_embedding_client_pool_reuses_clients_and_tokens(monkeypatch):
+    monkeypatch.setattr(data_utils.EmbeddingClientPool, "_pid", None)
+    endpoint = "https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01"
+    client, deployment = data_utils.EmbeddingClientPool.aoai_client(endpoint, api_key="key")
+    assert deployment == "ada"
+    assert data_utils.EmbeddingClientPool.aoai_client(endpoint, api_key="key")[0] is client
+    assert data_utils.EmbeddingClientPool.aoai_client(endpoint.replace("2024-02-01", "2024-06-01"), api_key="key")[0] is not client
+    assert data_utils.EmbeddingClientPool.aoai_client(endpoint, api_key="other key")[0] is not client
+    assert data_utils.EmbeddingClientPool.session("https://cohere.example.com/embed") is data_utils.EmbeddingClientPool.session("https://cohere.example.com/embed")
+
+    async def async_clients():
+        return data_utils.EmbeddingClientPool.async_aoai_client(endpoint, api_key="key"), data_utils.EmbeddingClientPool.async_aoai_client(endpoint, api_key="key")
+
+    (async_client, async_deployment), (same_async_client, _) = asyncio.run(async_clients())
+    assert async_deployment == "ada" and async_client is same_async_client and async_client.max_retries == 0
+    # the connections of an async client belong to its event loop
+    assert asyncio.run(async_clients())[0][0] is not async_client
+
+    class FakeCredential:
+        def __init__(self):
+            self.calls = 0
+
+        def get_token(self, scope):
+            self.calls += 1
+            return SimpleNamespace(token=f"token{self.calls}", expires_on=time.time() + self.lifetime)
+
+    credential = FakeCredential()
+    credential.lifetime = 3600
+    provider = data_utils._CachedTokenProvider(credential, data_utils.EmbeddingClientPool.AAD_SCOPE)
+    assert [provider(), provider()] == ["token1", "token1"]
+    # a token close to expiry is refreshed
+    credential.lifetime = 60
+    provider._token = None
+    assert [provider(), provider()] == ["token2", "token3"]
+
+def test_retry_delay_from_headers():
+    assert data_utils.retry_delay_from_headers(None) is None
+    assert data_utils.retry_delay_from_headers({"retry-after": "7"}) == 7
+    assert data_utils.retry_delay_from_headers({"retry-after-ms": "250", "retry-after": "0"}) == 0.25
+    assert data_utils.retry_delay_from_headers({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0.5s"}) == 360.5
+    assert data_utils.retry_delay_from_headers({"x-ratelimit-reset-tokens": "20ms"}) == 0.02
+    assert data_utils.retry_delay_from_headers({"retry-after": "soon", "x-ratelimit-reset-tokens": "1 minute"}) is None
+    http_date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 30))
+    assert 25 < data_utils.retry_delay_from_headers({"retry-after": http_date}) <= 30
+
+
+def test_async_embedding_engine_bounds_concurrency_and_honors_retry_after(monkeypatch):
+    monkeypatch.setitem(data_utils.EMBEDDING_BATCH_LIMITS, "AOAI", (2, None))
+    engine = data_utils.AsyncEmbeddingEngine("https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01",
+                                             "key", max_concurrency=3, base_delay=0.001)
+    counts = {"in_flight": 0, "max_in_flight": 0}
+    throttled = []
+
+    class RateLimited(Exception):
+        response = SimpleNamespace(status_code=429, headers={"retry-after-ms": "20"})
+
+    async def fake_request(texts):
+        counts["in_flight"] += 1
+        counts["max_in_flight"] = max(counts["max_in_flight"], counts["in_flight"])
+        try:
+            await data_utils.asyncio.sleep(0.01)
+            if texts[0] == "text 4" and not throttled:
+                throttled.append(time.perf_counter())
+                raise RateLimited("rate limited")
+            return [[float(text.split()[1])] for text in texts]
+        finally:
+            counts["in_flight"] -= 1
+
+    monkeypatch.setattr(engine, "_request", fake_request)
+    texts = [f"text {i}" for i in range(20)]
+    assert engine.embed(texts) == [[float(i)] for i in range(20)]
+    # at most 3 requests were sent at a time, and the throttled one was retried after its Retry-After
+    assert counts["max_in_flight"] == 3
+    assert len(engine.latencies) == engine.num_requests == 11
+    assert engine.retry_delay(0, {"retry-after-ms": "20"}) >= 0.02
+    assert 0 <= engine.retry_delay(10) <= engine.max_delay
+
+    # errors that retrying cannot fix are raised without a retry
+    class BadRequest(Exception):
+        response = SimpleNamespace(status_code=400, headers={})
+
+    async def bad_request(texts):
+        raise BadRequest("bad request")
+
+    monkeypatch.setattr(engine, "_request", bad_request)
+    num_requests = engine.num_requests
+    with pytest.raises(Exception, match="bad request"):
+        engine.embed(["text"])
+    assert len(engine.latencies_since(num_requests)) == 1
+
+    # only the latest latencies are kept, however long the engine lives
+    engine.latencies = data_utils.deque(engine.latencies, maxlen=4)
+    num_requests = engine.num_requests
+    monkeypatch.setattr(engine, "_request", fake_request)
+    engine.embed(texts)
+    assert len(engine.latencies) == 4 and engine.latencies_since(num_requests) == list(engine.latencies)
+
+
+def test_async_embedding_engine_skips_texts_a_request_is_rejected_for(monkeypatch, tmp_path):
+    monkeypatch.setitem(data_utils.EMBEDDING_BATCH_LIMITS, "AOAI", (4, None))
+    engine = data_utils.AsyncEmbeddingEngine("https://example.openai.azure.com/openai/deployments/ada/embeddings?api-version=2024-02-01",
+                                             "key", max_concurrency=2, base_delay=0.001)
+
+    class BadRequest(Exception):
+        response = SimpleNamespace(status_code=400, headers={})
+
+    async def fake_request(texts):
+        # the endpoint rejects a request with an input that is too long
+        if "text 5" in texts:
+            raise BadRequest("input too long")
+        return [[float(text.split()[1])] for text in texts]
+
+    monkeypatch.setattr(engine, "_request", fake_request)
+    texts = [f"text {i}" for i in range(8)]
+    with pytest.raises(data_utils.EmbeddingRequestError, match="input too long") as error:
+        engine.embed(texts)
+    assert error.value.status_code == 400
+    # the batch of the bad text is split until only the bad text is left without an embedding
+    num_requests = engine.num_requests
+    assert engine.embed(texts, ignore_errors=True) == [[float(i)] if i != 5 else None for i in range(8)]
+    assert engine.num_requests - num_requests == 6
+
+    # texts without an embedding are not cached
+    monkeypatch.setattr(data_utils.AsyncEmbeddingEngine, "get", classmethod(lambda cls, *args: engine))
+    cache = data_utils.EmbeddingCache(str(tmp_path / "embeddings.db"))
+    embeddings = data_utils.get_embeddings_with_cache(texts, cache, embedding_model_endpoint=engine.endpoint, embedding_model_key="key",
+                                                      ignore_errors=True)
+    assert embeddings[5] is None and embeddings[4] == [4.0]
+    assert cache.get(data_utils.EmbeddingCache.key("text 5", engine.endpoint)) is None
+    assert cache.get(data_utils.EmbeddingCache.key("text 4", engine.endpoint)) == [4.0]
+
+def _reserve_in_worker(name, tokens):
+    return data_utils.RateLimiter.get(name).reserve(tokens)
+
+
+def test_rate_limiter_budgets_requests_and_tokens_across_processes(monkeypatch):
+    from concurrent.futures import ProcessPoolExecutor
+
+    monkeypatch.setattr(data_utils.RateLimiter, "_limiters", {})
+    # 60 requests and 600 tokens per minute, bursts of up to 10 seconds of quota
+    limiter = data_utils.RateLimiter.configure("embedding", requests_per_minute=60, tokens_per_minute=600)
+    assert [limiter.reserve(10) for _ in range(10)] == [0] * 10
+    # the buckets are empty, so the next request waits for one more request and 10 more tokens
+    assert 0.9 < limiter.reserve(10) <= 1
+    with ProcessPoolExecutor(max_workers=1, initializer=data_utils.RateLimiter.install,
+                             initargs=(data_utils.RateLimiter.limiters(),)) as executor:
+        # a worker process waits behind the requests reserved by the parent
+        assert 1.9 < executor.submit(_reserve_in_worker, "embedding", 100).result() <= 11
+    assert limiter.reserve(0) > 10
+    limiter.pause(60)
+    assert limiter.reserve(0) > 59
+    assert data_utils.RateLimiter.configure("embedding") is None and data_utils.RateLimiter.get("embedding") is None
+
+
+def test_latency_percentiles():
+    assert data_utils.latency_percentiles([]) == {}
+    latencies = [i / 100 for i in range(100, 0, -1)]
+    assert data_utils.latency_percentiles(latencies) == {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+    assert data_utils.latency_percentiles([0.2]) == {"p50": 0.2, "p90": 0.2, "p99": 0.2}
+
+
+def test_get_caption_downscales_retries_and_caches(tmp_path, monkeypatch):
+    fitz = pytest.importorskip("fitz")
+    with fitz.open() as document:
+        page = document.new_page(width=1600, height=1200)
+        page.draw_rect(fitz.Rect(100, 100, 800, 600), fill=(1, 0, 0))
+        image_path = tmp_path / "screenshot.png"
+        image_path.write_bytes(page.get_pixmap().tobytes("png"))
+    monkeypatch.setenv("CAPTION_CACHE_PATH", str(tmp_path / "captions.db"))
+    monkeypatch.setattr(data_utils.time, "sleep", lambda seconds: None)
+    responses = [SimpleNamespace(status_code=429, headers={"Retry-After": "0"}),
+                 SimpleNamespace(status_code=200, headers={}, json=lambda: {"choices": [{"message": {"content": "A red box"}}]})]
+    posted = []
+
+    def fake_post(session, url, headers=None, json=None, timeout=None):
+        posted.append(json)
+        response = responses.pop(0)
+
+        def raise_for_status():
+            if response.status_code != 200:
+                raise Exception(f"status {response.status_code}")
+        response.raise_for_status = raise_for_status
+        return response
+
+    monkeypatch.setattr(data_utils.requests.Session, "post", fake_post)
+    endpoint = "https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions?api-version=2024-04-01-preview"
+    img_tag, mapping = data_utils.get_caption(str(image_path), endpoint, "key")
+    assert "A red box" in img_tag and len(posted) == 2
+    image_url = posted[-1]["messages"][1]["content"][1]["image_url"]["url"]
+    assert image_url.startswith("data:image/jpeg;base64,") and mapping[img_tag] == image_url
+    image = fitz.Pixmap(base64.b64decode(image_url.split(",", 1)[1]))
+    assert (image.width, image.height) == (1024, 768)
+
+    # the same image is not sent again, even with another api version
+    img_tag, _ = data_utils.get_caption(str(image_path), endpoint.replace("2024-04-01", "2024-06-01"), "key")
+    assert "A red box" in img_tag and len(posted) == 2
+
+    # requests that keep failing raise instead of leaving the response unbound
+    monkeypatch.delenv("CAPTION_CACHE_PATH")
+    responses.extend(SimpleNamespace(status_code=500, headers={}) for _ in range(data_utils.RETRY_COUNT))
+    with pytest.raises(Exception, match="Error getting caption"):
+        data_utils.get_caption(str(image_path), endpoint, "key")
+
+
+class _FakePoller:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class _FakeFormRecognizerClient:
+    def __init__(self, result):
+        self._result = result
+        self.num_calls = 0
+
+    def begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        self.num_calls += 1
+        return _FakePoller(self._result)
+
+
+@pytest.mark.parametrize("use_layout", [False, True])
+def test_extract_pdf_content_matches_saved_results(tmp_path, use_layout):
+    models = pytest.importorskip("azure.ai.documentintelligence.models")
+    with open(os.path.join(ANALYZE_RESULTS_DIR, "layout_report.json")) as f:
+        result = models.AnalyzeResult(json.load(f))
+    with open(os.path.join(ANALYZE_RESULTS_DIR, "layout_report.expected.json")) as f:
+        expected = json.load(f)["layout" if use_layout else "read"]
+
+    # the saved result has no figures, so the file is only read to be sent to the (fake) service
+    file_path = tmp_path / "layout_report.bin"
+    file_path.write_bytes(b"")
+    full_text, image_mapping = data_utils.extract_pdf_content(
+        str(file_path), _FakeFormRecognizerClient(result), use_layout=use_layout)
+    assert full_text == expected
+    assert image_mapping == {}
+
+
+def test_analysis_cache_skips_the_service_for_analyzed_files(tmp_path, monkeypatch):
+    models = pytest.importorskip("azure.ai.documentintelligence.models")
+    with open(os.path.join(ANALYZE_RESULTS_DIR, "layout_report.json")) as f:
+        result = models.AnalyzeResult(json.load(f))
+    monkeypatch.setenv("ANALYSIS_CACHE_PATH", str(tmp_path / "analysis.db"))
+    file_path = tmp_path / "layout_report.bin"
+    file_path.write_bytes(b"report")
+    client = _FakeFormRecognizerClient(result)
+
+    expected = data_utils.extract_pdf_content(str(file_path), client, use_layout=True)
+    assert data_utils.extract_pdf_content(str(file_path), client, use_layout=True) == expected
+    assert client.num_calls == 1
+    cache = data_utils.AnalysisCache.from_env()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # another model or another file content is analyzed again
+    data_utils.extract_pdf_content(str(file_path), client, use_layout=False)
+    file_path.write_bytes(b"report v2")
+    data_utils.extract_pdf_content(str(file_path), client, use_layout=True)
+    assert client.num_calls == 3
+
+    cache.max_bytes = 1
+    cache.evict()
+    assert cache.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+
+
+class _FakePdfFormRecognizerClient:
+    """Analyzes the PDF it is sent into one paragraph per page, and a figure on the pages with an odd "Page <i> text"."""
+    def __init__(self):
+        self.page_counts = []
+        self.streamed = []
+
+    def begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        models = pytest.importorskip("azure.ai.documentintelligence.models")
+        fitz = pytest.importorskip("fitz")
+        result = {"modelId": model_id, "content": "", "pages": [], "paragraphs": [], "figures": []}
+        assert kwargs["content_type"] == "application/octet-stream"
+        # whole files are streamed from an open file, shards are sent as bytes
+        self.streamed.append(not isinstance(analyze_request, bytes))
+        body = analyze_request if isinstance(analyze_request, bytes) else analyze_request.read()
+        with fitz.open(stream=body, filetype="pdf") as document:
+            self.page_counts.append(document.page_count)
+            for page_index, page in enumerate(document):
+                text = page.get_text().strip()
+                offset = len(result["content"]) + (1 if result["content"] else 0)
+                result["content"] += ("\n" if result["content"] else "") + text
+                span = {"offset": offset, "length": len(text)}
+                result["pages"].append({"pageNumber": page_index + 1, "spans": [span]})
+                region = {"pageNumber": page_index + 1, "polygon": [1, 1, 3, 1, 3, 2, 1, 2]}
+                result["paragraphs"].append({"content": text, "spans": [span], "boundingRegions": [region]})
+                if int(text.split()[1]) % 2:
+                    result["figures"].append({"id": f"{page_index + 1}.1", "boundingRegions": [region], "spans": [span],
+                                              "elements": [f"/paragraphs/{page_index}"]})
+        return _FakePoller(models.AnalyzeResult(result))
+
+
+def test_pdf_shards_are_stitched_into_one_analysis(tmp_path, monkeypatch):
+    fitz = pytest.importorskip("fitz")
+    file_path = str(tmp_path / "large.pdf")
+    with fitz.open() as document:
+        for i in range(7):
+            document.new_page().insert_text((72, 72), f"Page {i} text")
+        document.save(file_path)
+    expected_client = _FakePdfFormRecognizerClient()
+    expected = data_utils.analyze_document(file_path, expected_client).as_dict()
+    expected_content = data_utils.extract_pdf_content(file_path, expected_client)
+
+    monkeypatch.setenv("PDF_SHARD_PAGES", "3")
+    assert data_utils.pdf_shard_ranges(file_path, 0) == [(0, 3), (3, 6), (6, 7)]
+    client = _FakePdfFormRecognizerClient()
+    assert data_utils.analyze_document(file_path, client).as_dict() == expected
+    assert sorted(client.page_counts) == [1, 3, 3]
+    assert all(expected_client.streamed) and not any(client.streamed)
+    # image tags are named at random, so the figures are compared in order of appearance
+    full_text, image_mapping = data_utils.extract_pdf_content(file_path, client)
+    assert len(image_mapping) == 3
+    assert re.sub(r"IMG_\d+", "", full_text) == re.sub(r"IMG_\d+", "", expected_content[0])
+    assert list(image_mapping.values()) == list(expected_content[1].values())
+
+    # the async client of the crack stage is sharded the same way
+    async_client = SimpleNamespace(begin_analyze_document=_begin_analyze_async(client))
+    assert asyncio.run(data_utils.analyze_document_async(file_path, async_client)).as_dict() == expected
+
+    # shards are built as they are sent, so at most PDF_SHARD_CONCURRENCY of them are in memory at a time
+    monkeypatch.setenv("PDF_SHARD_PAGES", "1")
+    monkeypatch.setattr(data_utils, "PDF_SHARD_CONCURRENCY", 2)
+    shards = {"built": 0, "max_built": 0}
+    pdf_shard = data_utils._pdf_shard
+
+    def counted_pdf_shard(*args):
+        shard = pdf_shard(*args)
+        shards["built"] += 1
+        shards["max_built"] = max(shards["max_built"], shards["built"])
+        return shard
+
+    def sent(begin_analyze_document):
+        def begin(model_id, analyze_request, **kwargs):
+            shards["built"] -= 1
+            return begin_analyze_document(model_id, analyze_request, **kwargs)
+        return begin
+
+    monkeypatch.setattr(data_utils, "_pdf_shard", counted_pdf_shard)
+    assert data_utils.analyze_document(file_path, SimpleNamespace(begin_analyze_document=sent(client.begin_analyze_document))).as_dict() == expected
+    assert asyncio.run(data_utils.analyze_document_async(
+        file_path, SimpleNamespace(begin_analyze_document=sent(async_client.begin_analyze_document)))).as_dict() == expected
+    assert shards["built"] == 0 and shards["max_built"] <= 2
+
+
+def test_pdf_text_layer_is_read_locally_and_scans_are_analyzed(tmp_path, monkeypatch):
+    fitz = pytest.importorskip("fitz")
+    file_path = str(tmp_path / "report.pdf")
+    with fitz.open() as document:
+        page = document.new_page()
+        page.insert_text((72, 72), "Annual report", fontsize=24)
+        page.insert_text((72, 110), "Revenue", fontsize=15, fontname="hebo")
+        page.insert_text((72, 135), "Revenue grew in every region this year, driven by new customers.", fontsize=11)
+        for i in range(4):
+            page.draw_line((72, 160 + i * 20), (372, 160 + i * 20))
+            page.draw_line((72 + i * 100, 160), (72 + i * 100, 220))
+        for r, row in enumerate([["Region", "2023", "2024"], ["East", "10", "12"], ["West", "8", "9"]]):
+            for c, text in enumerate(row):
+                page.insert_text((77 + c * 100, 174 + r * 20), text, fontsize=10)
+        page.insert_text((72, 260), "Costs were flat across the year and every region.", fontsize=11)
+        # a scan, with an invisible OCR layer
+        scan = document.new_page()
+        pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 100, 100), False)
+        pixmap.clear_with(200)
+        scan.insert_image(scan.rect, pixmap=pixmap)
+        scan.insert_text((72, 72), "Page 1 text", render_mode=3)
+        document.save(file_path)
+
+    monkeypatch.setenv("PDF_TEXT_LAYER", "1")
+    assert data_utils.pdf_text_layer_pages(file_path) == [True, False]
+    client = _FakePdfFormRecognizerClient()
+    result = data_utils.analyze_document(file_path, client, use_layout=True)
+    assert client.page_counts == [1]
+    assert [page.page_number for page in result.pages] == [1, 2]
+    assert result.figures[0].bounding_regions[0].page_number == 2
+
+    full_text, image_mapping = data_utils.extract_pdf_content(file_path, client, use_layout=True)
+    assert full_text.startswith(
+        "<h1>Annual report</h1>\n<h2>Revenue</h2>\nRevenue grew in every region this year, driven by new customers.\n"
+        "<table><tr><th>Region</th><th>2023</th><th>2024</th></tr><tr><td>East</td><td>10</td><td>12</td></tr>"
+        "<tr><td>West</td><td>8</td><td>9</td></tr></table>\nCosts were flat across the year and every region.\n")
+    assert re.sub(r"IMG_\d+", "", full_text).endswith('<img src=".jpg">Page 1 text</img> ')
+    assert len(image_mapping) == 1
+
+    async_client = SimpleNamespace(begin_analyze_document=_begin_analyze_async(client))
+    assert asyncio.run(data_utils.analyze_document_async(file_path, async_client, use_layout=True)).as_dict() == result.as_dict()
+
+    # the analyses of the scanned pages are stopped when the text layer cannot be read
+    cancelled = []
+
+    async def begin_analyze_document(model_id, analyze_request, **kwargs):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(model_id)
+            raise
+
+    def broken_text_layer(*args, **kwargs):
+        raise ValueError("broken text layer")
+
+    async def analyze():
+        with pytest.raises(ValueError, match="broken text layer"):
+            await data_utils.analyze_document_async(file_path, SimpleNamespace(begin_analyze_document=begin_analyze_document), use_layout=True)
+        # no analysis is left running once the error is raised
+        return asyncio.all_tasks() == {asyncio.current_task()}
+
+    monkeypatch.setattr(data_utils, "pdf_text_layer_analyses", broken_text_layer)
+    assert asyncio.run(analyze())
+    assert cancelled in ([], ["prebuilt-layout"])
+
+
+def test_pdf_text_layer_needs_no_client_without_scanned_pages(tmp_path, monkeypatch):
+    fitz = pytest.importorskip("fitz")
+    file_path = str(tmp_path / "digital.pdf")
+    with fitz.open() as document:
+        for i in range(2):
+            document.new_page().insert_text((72, 72), f"Page {i} of a document generated with its text layer.")
+        document.save(file_path)
+
+    with pytest.raises(data_utils.UnsupportedFormatError):
+        data_utils.crack_file(file_path, "pdf", form_recognizer_client=None)
+    monkeypatch.setenv("PDF_TEXT_LAYER", "1")
+    content, image_mapping, cracked_pdf = data_utils.crack_file(file_path, "pdf", form_recognizer_client=None)
+    assert content == "Page 0 of a document generated with its text layer.\n Page 1 of a document generated with its text layer.\n "
+    assert image_mapping == {} and cracked_pdf
+    result = asyncio.run(data_utils.analyze_document_async(file_path, None))
+    assert result.content == "Page 0 of a document generated with its text layer.\nPage 1 of a document generated with its text layer.\n"
+
+
+def _begin_analyze_async(client):
+    async def begin_analyze_document(model_id, analyze_request, **kwargs):
+        poller = client.begin_analyze_document(model_id, analyze_request, **kwargs)
+
+        async def result():
+            return poller.result()
+        return SimpleNamespace(result=result)
+    return begin_analyze_document
+
+
+def test_figures_are_substituted_at_their_offset_and_bounded(tmp_path, monkeypatch):
+    models = pytest.importorskip("azure.ai.documentintelligence.models")
+    fitz = pytest.importorskip("fitz")
+    file_path = str(tmp_path / "slides.pdf")
+    with fitz.open() as document:
+        for _ in range(2):
+            document.new_page(width=720, height=540).draw_rect(fitz.Rect(72, 72, 648, 468), color=(1, 0, 0), fill=(0, 0, 1))
+        document.save(file_path)
+    content = "Chart\nIntro\nChart\nEnd"
+    region = {"pageNumber": 2, "polygon": [1, 1, 9, 1, 9, 6.5, 1, 6.5]}
+    result = models.AnalyzeResult({
+        "content": content,
+        "pages": [{"pageNumber": 1, "spans": [{"offset": 0, "length": 11}]}, {"pageNumber": 2, "spans": [{"offset": 12, "length": 9}]}],
+        "paragraphs": [{"role": "title", "spans": [{"offset": 12, "length": 5}]}],
+        "tables": [],
+        "figures": [{"id": "2.1", "boundingRegions": [region], "spans": [{"offset": 12, "length": 5}]}],
+    })
+
+    monkeypatch.setenv("FIGURE_MAX_PIXELS", "200")
+    full_text, image_mapping = data_utils.pdf_content_from_analysis(file_path, result, use_layout=True)
+    (img_tag, image), = image_mapping.items()
+    # the figure text of the second page is replaced, not the same text on the first page
+    assert full_text == f"Chart\nIntro <h1>{img_tag}</h1>\nEnd "
+    rendered = fitz.Pixmap(base64.b64decode(image.split(",", 1)[1]))
+    assert max(rendered.width, rendered.height) == 200
+
+
+class _FakeAsyncPoller:
+    def __init__(self, client, result):
+        self._client = client
+        self._result = result
+
+    async def result(self):
+        self._client.in_flight += 1
+        self._client.max_in_flight = max(self._client.max_in_flight, self._client.in_flight)
+        await asyncio.sleep(0.05)
+        self._client.in_flight -= 1
+        return self._result
+
+
+class _FakeAsyncFormRecognizerClient:
+    def __init__(self, result):
+        self._result = result
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        return _FakeAsyncPoller(self, self._result)